@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Offline end-to-end benchmark of `ChatBot.on_message`.
+
+Synthetic pyrogram messages go through the router, the scheduler, the
+`CommandHandler` methods and the handlers of plugins against a fake `Client`
+that answers every API call locally. Weather, search and translate requests
+are served by an httpx
+`MockTransport` replaying payloads from `benchmarks.fixtures`, and
+`module_site` works on a seeded SQLite database in a temporary directory.
+Optional latencies emulate the network round trips.
+
+Every command runs `--requests` times at each `--concurrency`, spread over as
+many chats as there are concurrent requests, and throughput and latency
+percentiles are reported. Results can be saved and compared with a previous run.
+
+Usage: python -m benchmarks.bench_e2e [--concurrency 1,8,32] [--requests 200]
+    [--commands test,wt,s,tr,short,stat,ps] [--save FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+
+from contextlib import AsyncExitStack, redirect_stdout
+from datetime import datetime
+from itertools import count
+from pathlib import Path
+from time import perf_counter
+
+import anyio
+
+from httpx import URL, MockTransport, Response
+
+from benchmarks import fixtures
+
+_WORKDIR = Path(tempfile.mkdtemp(prefix="pyrobot-bench-"))
+
+fixtures.offline_settings(_WORKDIR / "database.db")
+
+import main as pyrobot  # noqa: E402  the settings are read at import time
+
+from config import get_env  # noqa: E402
+from modules import (  # noqa: E402
+    accounts, host_info, instrumentation, loop_monitor, metrics_history, module_site, plugins, profiler,
+    scheduler, screenshots, upstreams,
+)
+from pyrogram import enums, types as pyrogram_types  # noqa: E402
+
+
+COMMANDS = {
+    "test": ".test",
+    "wt": ".wt Kemerovo 4",
+    "s": ".s python&3&duckduckgo",
+    "tr": ".tr Привет, мир!",
+    "short": ".short https://bench.example.com",
+    "stat": ".stat {short_link}",
+    "ps": ".ps mem",
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+class FakeClient:
+    """
+    Answers the API calls of the handlers locally after `latency` seconds.
+    """
+    name = "bench"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._ids = count(1_000_000)
+        self._me = pyrogram_types.User(id=1, is_self=True, first_name="bench")
+
+    def on_message(self, *args, **kwargs):
+        return lambda func: func
+
+    async def _call(self):
+        self.calls += 1
+
+        if self.latency:
+            await anyio.sleep(self.latency)
+
+    def message(self, chat_id: int, text: str, message_id: int = None) -> pyrogram_types.Message:
+        return pyrogram_types.Message(
+            client=self,
+            id=next(self._ids) if message_id is None else message_id,
+            chat=pyrogram_types.Chat(id=chat_id, type=enums.ChatType.SUPERGROUP),
+            from_user=self._me,
+            outgoing=True,
+            text=text,
+        )
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._call()
+        return self.message(chat_id, text, message_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        return self.message(chat_id, text)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        await self._call()
+        return True
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._call()
+        return self.message(chat_id, "")
+
+    send_photo = send_voice = send_media_group = send_document
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self._call()
+        return True
+
+
+def mock_upstreams(config, latency: float = 0.0) -> MockTransport:
+    """
+    An httpx transport that replays the fixtures by the hosts of the settings.
+    """
+    payloads = {
+        URL(config.MODULES_WEATHER_URL).host: (fixtures.forecast(), "application/json"),
+        URL(config.MODULES_SEARCH_HOST).host: (fixtures.search_results(), "application/json"),
+        "translate.google.com": (fixtures.translate_page(), "text/html"),
+    }
+
+    async def handler(request):
+        if latency:
+            await anyio.sleep(latency)
+
+        if (payload := payloads.get(request.url.host)) is None:
+            return Response(404)
+
+        text, content_type = payload
+        return Response(200, text=text, headers={"Content-Type": content_type})
+
+    return MockTransport(handler)
+
+
+def create_sessions(config, upstream_latency: float = 0.0) -> dict:
+    """
+    The sessions of one account of `main.async_main` without Telegram, the browser, TTS and the Python workers.
+    """
+    shared = dict(
+        footprint=accounts.Footprint(),
+        http=upstreams.Clients(transport=mock_upstreams(config, upstream_latency)),
+        tts_session=None,
+        browser_session=None,
+        python_pool=None,
+        host_sampler=host_info.Sampler.from_settings(
+            config, history=metrics_history.History(config.HOST_SAMPLER_INTERVAL)
+        ),
+        loop_monitor=loop_monitor.LoopMonitor.from_settings(config),
+        profiler=profiler.Profiler.from_settings(config),
+        screenshot_cache=screenshots.ScreenshotCache.from_settings(config),
+        plugins=plugins.Registry.from_settings(config),
+        scheduler=scheduler.Scheduler.from_settings(config),
+    )
+
+    return {**shared, **pyrobot.create_account_sessions(config)}
+
+
+def create_bot(config, sessions: dict, client: FakeClient) -> pyrobot.ChatBot:
+    # Skip ChatBot.__init__, which creates a real pyrogram Client
+    bot = pyrobot.ChatBot.__new__(pyrobot.ChatBot)
+    bot.__attrs_init__(client, config, sessions)
+
+    return bot
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def run_command(bot, client, command: str, text: str, requests: int, concurrency: int) -> dict:
+    latencies = []
+    pending = iter(range(requests))
+    errors = instrumentation.metrics.histogram("command", command).errors
+
+    async def worker(chat_id: int):
+        for _ in pending:
+            message = client.message(chat_id, text)
+            start = perf_counter()
+            await bot.on_message(client, message)
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+
+    async with anyio.create_task_group() as tasks:
+        for chat_id in range(concurrency):
+            tasks.start_soon(worker, -1_000_000_000_000 - chat_id)
+
+    elapsed = perf_counter() - start
+
+    return {
+        "throughput": requests / elapsed,
+        **{f"p{q}": percentile(latencies, q) for q in PERCENTILES},
+        "max": max(latencies),
+        "errors": instrumentation.metrics.histogram("command", command).errors - errors,
+    }
+
+
+async def run(args) -> dict:
+    config = get_env()
+    client = FakeClient(args.telegram_latency)
+    sessions = create_sessions(config, args.upstream_latency)
+    bot = create_bot(config, sessions, client)
+    results = {}
+
+    async with AsyncExitStack() as stack:
+        for name in ("loop_monitor", "shell_sessions", "host_sampler"):
+            await stack.enter_async_context(sessions[name])
+
+        await stack.enter_async_context(bot.tasks)
+        await stack.enter_async_context(sessions["http"])
+
+        short_link = module_site.generate_short_link_for_url("https://bench.example.com")
+
+        for command in args.commands:
+            text = COMMANDS[command].format(short_link=short_link)
+            results[command] = {}
+
+            for concurrency in args.concurrency:
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    # Warm up caches and lazy imports
+                    await run_command(bot, client, command, text, min(args.requests, 10), concurrency)
+                    result = await run_command(bot, client, command, text, args.requests, concurrency)
+
+                results[command][str(concurrency)] = result
+                report(command, concurrency, result, args.baseline)
+
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "telegram_latency": args.telegram_latency,
+            "upstream_latency": args.upstream_latency,
+        },
+        "results": results,
+    }
+
+
+def report(command: str, concurrency: int, result: dict, baseline: dict = None):
+    line = (
+        f"{command:>6} x{concurrency:<4} {result['throughput']:9.1f} req/s  "
+        + "  ".join(f"p{q} {result[f'p{q}'] * 1000:8.2f}ms" for q in PERCENTILES)
+        + f"  errors {result['errors']}"
+    )
+
+    if baseline is not None:
+        previous = baseline.get("results", {}).get(command, {}).get(str(concurrency))
+
+        if previous is not None:
+            change = (result["p95"] - previous["p95"]) / previous["p95"] * 100 if previous["p95"] else 0.0
+            line += f"  p95 {change:+.1f}% vs baseline"
+
+    print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--concurrency", default="1,8,32", type=lambda text: [int(x) for x in text.split(",")])
+    parser.add_argument("--requests", default=200, type=int)
+    parser.add_argument("--commands", default=",".join(COMMANDS), type=lambda text: text.split(","))
+    parser.add_argument("--telegram-latency", default=0.0, type=float, help="seconds per Telegram API call")
+    parser.add_argument("--upstream-latency", default=0.0, type=float, help="seconds per HTTP request")
+    parser.add_argument("--save", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="a JSON file of a previous run to compare with")
+
+    args = parser.parse_args(argv)
+    args.baseline = json.loads(args.compare.read_text()) if args.compare else None
+
+    if unknown := set(args.commands) - set(COMMANDS):
+        parser.error(f"unknown commands: {', '.join(sorted(unknown))}")
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = anyio.run(run, args)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
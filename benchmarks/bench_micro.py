@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Micro-benchmarks of the formatting and parsing hot paths with regression thresholds.
+
+Every case is timed over several repeats, and the peak of traced memory, in
+bytes, during one call is recorded. The results are compared with a baseline
+file; a case whose best time or memory peak exceeds the baseline by more than
+the threshold fails the run with exit status 1, so the suite can gate changes.
+
+Timings depend on the machine, so no baseline is committed: record one with
+`--update` on the machine that runs the comparison, before the change. Without
+a baseline the run fails with exit status 2 rather than pass unchecked.
+
+Usage: python -m benchmarks.bench_micro [--baseline FILE] [--update]
+    [--threshold 0.2] [--peak-threshold 0.1] [--repeat 7] [--only NAME,...]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import tracemalloc
+
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+from attrs import field, frozen
+
+from benchmarks import bench_routing, fixtures
+
+_WORKDIR = Path(tempfile.mkdtemp(prefix="pyrobot-bench-"))
+fixtures.offline_settings(_WORKDIR / "database.db")
+
+from main import ChatBot  # noqa: E402  the settings are read at import time
+from modules import host_info, limit_symbols, plugins, pretty_json, rasterizer, search, weather  # noqa: E402
+
+
+BASELINE = Path(__file__).with_name("baseline_micro.json")
+
+# Growth of the memory peak below this many bytes is noise
+_PEAK_FLOOR = 4096
+
+
+@frozen
+class Case:
+    name = field()
+    func = field()
+    setup = field(default=None)
+    number = field(default=1)
+
+
+def _drive(coro):
+    """
+    Run a coroutine that never suspends without an event loop.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+    raise RuntimeError("The coroutine suspended")
+
+
+def make_cases() -> list:
+    forecast = fixtures.forecast(40)
+    search_results = fixtures.search_results(count=50)
+    disks = {"disk": fixtures.disk_map(1000)}
+    nested = fixtures.nested_dict()
+    processes = fixtures.process_dump(500)
+    sizes = [7 ** power for power in range(22)] * 50
+    reply = pretty_json.pretty_dumps(fixtures.nested_dict(depth=4, width=5))
+    fonts = rasterizer.load_fonts("DejaVuSansMono.ttf", "DejaVuSansMono-Bold.ttf", 16)
+
+    html_path = _WORKDIR / "file.html"
+    image = fixtures.screenshot(_WORKDIR / "screenshot.jpg")
+    flt = type("Filter", (), {"plugins": plugins.Registry()})()
+    traffic = bench_routing.make_traffic(1000)
+
+    def filter_traffic():
+        for message in traffic:
+            _drive(ChatBot.is_relevant_message(flt, None, message))
+
+    cases = [
+        Case("pretty_dumps.nested", lambda: pretty_json.pretty_dumps(nested)),
+        Case("pretty_dumps.processes500", lambda: pretty_json.pretty_dumps(processes)),
+        Case("pretty_write.processes500.4096", lambda: pretty_json.pretty_write(processes, [].append, budget=4096)),
+        Case("weather.wrapper_data.40", lambda: weather.wrapper_data(forecast, limit=40)),
+        Case("search.parse_raw.50", lambda: search.Model.parse_raw(search_results)),
+        Case("host_info.get_size", lambda: [host_info.get_size(size) for size in sizes], number=10),
+        Case("host_info.full_info.disk1000", lambda: host_info.full_info("disk", snapshot=disks)),
+        Case("limit_symbols.gen_html", lambda: limit_symbols.gen_html(html_path, reply)),
+        Case("limit_symbols.crop_image.4k", lambda: limit_symbols.crop_image(image)),
+        Case("limit_symbols.crop_image.4k.step8", lambda: limit_symbols.crop_image(image, step=8)),
+        Case("is_relevant_message.1000", filter_traffic, number=10),
+    ]
+
+    # Without DejaVu the rasterizer is not used by the bot either
+    if fonts is not None:
+        cases.append(Case("rasterizer.render", lambda: rasterizer.render(reply, fonts)))
+
+    return cases
+
+
+def measure(case: Case, repeat: int) -> dict:
+    times = []
+
+    for _ in range(repeat):
+        if case.setup is not None:
+            case.setup()
+
+        start = perf_counter()
+
+        for _ in range(case.number):
+            case.func()
+
+        times.append((perf_counter() - start) / case.number)
+
+    if case.setup is not None:
+        case.setup()
+
+    tracemalloc.start()
+
+    try:
+        case.func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"min": min(times), "median": median(times), "peak": peak}
+
+
+def compare(result: dict, previous: dict, threshold: float, peak_threshold: float) -> list:
+    """
+    :return: descriptions of the regressions of the result against the baseline
+    """
+    regressions = []
+
+    # The minimum is the least noisy estimate of the cost of the code itself
+    if result["min"] > previous["min"] * (1 + threshold):
+        regressions.append(f"time {(result['min'] / previous['min'] - 1) * 100:+.0f}%")
+
+    if result["peak"] > max(previous["peak"] * (1 + peak_threshold), previous["peak"] + _PEAK_FLOOR):
+        regressions.append(f"memory peak {(result['peak'] / max(previous['peak'], 1) - 1) * 100:+.0f}%")
+
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--baseline", default=BASELINE, type=Path)
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", default=0.2, type=float, help="allowed relative slowdown of the best time")
+    parser.add_argument("--peak-threshold", default=0.1, type=float, help="allowed relative growth of the memory peak")
+    parser.add_argument("--repeat", default=7, type=int)
+    parser.add_argument("--only", type=lambda text: set(text.split(",")))
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text())
+    elif args.update:
+        baseline = {}
+    else:
+        print(f"No baseline at {args.baseline}, record one first with --update", file=sys.stderr)
+        return 2
+
+    results = {}
+    failed = False
+
+    for case in make_cases():
+        if args.only and case.name not in args.only:
+            continue
+
+        results[case.name] = result = measure(case, args.repeat)
+        line = (
+            f"{case.name:<32} median {result['median'] * 1e3:9.3f}ms  "
+            f"min {result['min'] * 1e3:9.3f}ms  peak {host_info.get_size(result['peak'])}"
+        )
+
+        if (previous := baseline.get("cases", {}).get(case.name)) is not None:
+            if regressions := compare(result, previous, args.threshold, args.peak_threshold):
+                failed = True
+                line += f"  REGRESSION: {', '.join(regressions)}"
+            else:
+                line += f"  ok ({(result['min'] / previous['min'] - 1) * 100:+.0f}%)"
+
+        print(line)
+
+    if args.update:
+        cases = {**baseline.get("cases", {}), **results}
+        args.baseline.write_text(json.dumps({"python": platform.python_version(), "cases": cases}, indent=2))
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Cost of `pretty_dumps` on large host and process dumps.
+
+Compares the previous recursive implementation, which checked the
+`Mapping`/`Sequence`/`Set` ABCs at every node through a generator per level,
+with the iterative `modules.pretty_json`, and shows how early `pretty_write`
+stops at the budget used for overflow detection.
+
+Usage: python -m benchmarks.bench_pretty_json [repeat]
+"""
+
+import sys
+
+from collections.abc import Mapping, Sequence, Set
+from timeit import repeat as timeit_repeat
+
+from benchmarks import fixtures
+from modules import pretty_json
+
+
+def legacy_isunwrappable(value):
+    if isinstance(value, str):
+        return False
+
+    return isinstance(value, (Mapping, Sequence, Set))
+
+
+def legacy_pretty_lines(data, sort_keys=False, sort_sets=False, indent=0):
+    if legacy_isunwrappable(data):
+        if isinstance(data, Mapping):
+            items = data.items()
+
+            if sort_keys:
+                items = sorted(items)
+
+            for key, value in items:
+                if legacy_isunwrappable(value):
+                    yield indent, f"{key}:"
+                    yield from legacy_pretty_lines(value, sort_keys, sort_sets, indent + 1)
+                else:
+                    yield indent, f"{key}: {value}"
+        elif isinstance(data, Sequence):
+            for value in data:
+                if legacy_isunwrappable(value):
+                    yield from legacy_pretty_lines(value, sort_keys, sort_sets, indent + 1)
+                else:
+                    yield indent, f"{value}"
+        else:
+            values = list(data)
+
+            if sort_sets:
+                values.sort()
+
+            yield from legacy_pretty_lines(values, sort_keys, sort_sets, indent)
+    else:
+        yield indent, f"{data}"
+
+
+def legacy_pretty_dumps(data, indent=4):
+    indent = ' ' * indent
+
+    return '\n'.join(f"{indent * level}{string}" for level, string in legacy_pretty_lines(data))
+
+
+def main(repeat: int = 5):
+    payloads = {
+        "disk map (1000 partitions)": fixtures.disk_map(1000),
+        "process dump (500 processes)": fixtures.process_dump(500),
+        "nested (6 levels x 6)": fixtures.nested_dict(),
+    }
+
+    for name, data in payloads.items():
+        assert legacy_pretty_dumps(data) == pretty_json.pretty_dumps(data)
+
+        candidates = (
+            ("legacy", lambda: legacy_pretty_dumps(data)),
+            ("iterative", lambda: pretty_json.pretty_dumps(data)),
+            ("budget 4096", lambda: pretty_json.pretty_write(data, list().append, budget=4096)),
+        )
+
+        print(name)
+
+        for label, func in candidates:
+            best = min(timeit_repeat(func, number=1, repeat=repeat))
+            print(f"{label:>14}: {best * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
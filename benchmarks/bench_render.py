@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Benchmark of the renderers of long replies: `modules.rasterizer` against the
+Chromium path of `modules.limit_symbols` (markdown to HTML, a screenshot and a crop).
+
+Every reply size is rendered `--repeat` times by each renderer. Latency is
+reported as min/median, memory as the tracemalloc peak of the Python process
+for the rasterizer and as the peak RSS of the browser processes for Chromium.
+The Chromium path is skipped when playwright is not installed.
+
+Usage: python -m benchmarks.bench_render [--sizes 5,50,500] [--repeat 5] [--output DIR]
+"""
+
+import argparse
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import anyio
+import psutil
+
+from benchmarks import fixtures
+
+_WORKDIR = Path(tempfile.mkdtemp(prefix="pyrobot-bench-"))
+fixtures.offline_settings(_WORKDIR / "database.db")
+
+from config import get_env  # noqa: E402  the settings are read at import time
+from modules import host_info, limit_symbols, pretty_json, rasterizer  # noqa: E402
+
+
+def make_reply(processes: int) -> str:
+    """
+    A reply like the one of `.ps` for `processes` processes.
+    """
+    dump = pretty_json.pretty_dumps(fixtures.process_dump(processes))
+    return f"<strong>Processes:</strong>\n<code>{dump}</code>"
+
+
+class RSSPeak:
+    """
+    Samples the RSS of the children of this process in a thread, where the browser runs.
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process()
+
+        while not self._stop.wait(self.interval):
+            rss = 0
+
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+
+            self.peak = max(self.peak, rss)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+async def run_rasterizer(config, text: str, output: Path) -> dict:
+    start = perf_counter()
+    image = await rasterizer.render_image(text, config)
+    elapsed = perf_counter() - start
+
+    # Tracing slows the allocations down, so the peak is taken from a separate run
+    tracemalloc.start()
+
+    try:
+        await rasterizer.render_image(text, config)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    output.write_bytes(image)
+
+    return {"time": elapsed, "peak": peak, "bytes": len(image)}
+
+
+async def run_browser(config, text: str, output: Path) -> dict:
+    html_path = _WORKDIR / "file.html"
+
+    with RSSPeak() as rss:
+        start = perf_counter()
+        limit_symbols.gen_html(html_path=html_path, text=text)
+        screenshot = await limit_symbols.gen_pictures(browser_session=None, html_path=html_path)
+        image = limit_symbols.crop_image(screenshot).getvalue()
+        elapsed = perf_counter() - start
+
+    output.write_bytes(image)
+
+    return {"time": elapsed, "peak": rss.peak, "bytes": len(image)}
+
+
+def have_browser() -> bool:
+    try:
+        import playwright  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+
+async def run(args):
+    config = get_env()
+    renderers = {}
+
+    if rasterizer.load_fonts(config.RENDER_FONT, config.RENDER_FONT_BOLD, config.RENDER_FONT_SIZE) is not None:
+        renderers["rasterizer"] = (run_rasterizer, "png")
+    else:
+        print(f"{config.RENDER_FONT} is not found, the rasterizer is skipped", file=sys.stderr)
+
+    if have_browser():
+        renderers["chromium"] = (run_browser, "jpg")
+    else:
+        print("playwright is not installed, the Chromium path is skipped", file=sys.stderr)
+
+    for size in args.sizes:
+        text = make_reply(size)
+
+        for name, (func, extension) in renderers.items():
+            output = args.output / f"{name}-{size}.{extension}"
+            results = [await func(config, text, output) for _ in range(args.repeat)]
+            times = [result["time"] for result in results]
+
+            print(
+                f"{name:>10} {len(text):>8} chars  min {min(times) * 1e3:9.1f}ms  median {median(times) * 1e3:9.1f}ms  "
+                f"peak {host_info.get_size(max(result['peak'] for result in results))}  "
+                f"image {host_info.get_size(results[-1]['bytes'])}"
+            )
+
+    print(f"Images written to {args.output}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--sizes", default="5,50,500", type=lambda text: [int(x) for x in text.split(",")],
+                        help="numbers of processes in the rendered replies")
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--output", default=_WORKDIR, type=Path, help="where to write the rendered images")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    anyio.run(run, parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Filter cost per message at high group traffic.
+
+Compares the previous eager `is_relevant_message` + `format_text` pair with
+the `modules.routing.Router` of the core commands and the built-in plugins on
+a synthetic mix where most messages come from other users and only a few are
+own commands.
+
+Usage: python -m benchmarks.bench_routing [messages]
+"""
+
+import sys
+import tempfile
+
+from pathlib import Path
+from random import Random
+from timeit import repeat
+from types import SimpleNamespace
+
+from benchmarks import fixtures
+from utils import Commands
+
+
+def legacy_is_relevant(m) -> bool:
+    if m.text is not None and isinstance(m.text, str):
+        try:
+            first_char = m.text[0]
+        except UnicodeDecodeError:
+            return False
+    else:
+        return False
+
+    return all([
+        m.from_user and m.from_user.is_self or getattr(m, "outgoing", False),
+        first_char in "./!*"
+    ])
+
+
+def legacy_format_text(text):
+    prefix = text.lstrip("/").split()[0][1:]
+    try:
+        return getattr(Commands, prefix), text[len(prefix) + 1:].strip()
+    except AttributeError:
+        return None
+
+
+def make_traffic(count: int, seed: int = 0x42) -> list:
+    random = Random(seed)
+    stranger = SimpleNamespace(is_self=False)
+    me = SimpleNamespace(is_self=True)
+    texts = (
+        "hello there", "ok", "/start@some_bot", ".not_a_command", "!!!", "lol " * 40,
+        ".wt Kemerovo 3", ".test", ".s python&3&duckduckgo", ".ps mem", ".py print(1)",
+    )
+    traffic = []
+
+    for _ in range(count):
+        own = random.random() < 0.05
+        text = random.choice(texts[5:] if own else texts)
+
+        traffic.append(SimpleNamespace(
+            text=None if random.random() < 0.1 else text,
+            from_user=me if own else stranger,
+            outgoing=own,
+        ))
+
+    return traffic
+
+
+def main(count: int = 100_000):
+    traffic = make_traffic(count)
+    fixtures.offline_settings(Path(tempfile.mkdtemp(prefix="pyrobot-bench-")) / "database.db")
+
+    # The built-in plugins read the settings at import time
+    from modules.plugins import Registry
+
+    router = Registry().router
+
+    def legacy():
+        for m in traffic:
+            if legacy_is_relevant(m):
+                legacy_format_text(m.text)
+
+    def routed():
+        for m in traffic:
+            if router.is_relevant(m):
+                router.match(m.text)
+
+    for name, func in (("legacy", legacy), ("router", routed)):
+        best = min(repeat(func, number=1, repeat=5))
+        print(f"{name:>8}: {best / count * 1e9:8.1f} ns/message  ({count / best:,.0f} messages/s)")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
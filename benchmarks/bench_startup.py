@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Import-time budget of the bot.
+
+`import main` runs in a fresh interpreter under `-X importtime`, and the total
+import time, the slowest modules and the heavy dependencies that got imported
+eagerly are reported. The run fails with exit status 1 when the best of the
+repeats exceeds the budget or a heavy dependency is imported by `main` itself,
+so the suite can gate changes that slow the startup down.
+
+Usage: python -m benchmarks.bench_startup [--budget 1.0] [--repeat 5] [--top 15]
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+from benchmarks import fixtures
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that must only be imported by the commands that use them
+HEAVY = ("torch", "torchaudio", "playwright", "lxml", "PIL", "markdown", "numpy")
+
+
+def import_times(module: str = "main") -> list:
+    """
+    :return: (depth, name, cumulative seconds) of the module and of everything it imported, in import order
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=False,
+    )
+
+    if process.returncode:
+        raise RuntimeError(f"import {module} failed:\n{process.stderr[-2000:]}")
+
+    imports = []
+
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+
+        if not cumulative.strip().isdigit():
+            continue
+
+        # The name is preceded by a space and indented by two more per nesting level
+        name = name[1:].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((depth, name.strip(), int(cumulative) / 1e6))
+
+    # A module is reported after its imports, which follow the previous module of its depth
+    end = max(index for index, (depth, name, _) in enumerate(imports) if depth == 0 and name == module)
+    start = end
+
+    while start and imports[start - 1][0] > 0:
+        start -= 1
+
+    return imports[start:end + 1]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--budget", default=1.0, type=float, help="seconds allowed for `import main`")
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--top", default=15, type=int)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    fixtures.offline_settings(Path(tempfile.mkdtemp(prefix="pyrobot-bench-")) / "database.db")
+
+    runs = [import_times() for _ in range(args.repeat)]
+    best = min(runs, key=lambda imports: imports[-1][2])
+    total = best[-1][2]
+    top_level = sorted((item for item in best if item[0] == 1), key=lambda item: -item[2])
+
+    for _, name, seconds in top_level[:args.top]:
+        print(f"{name:<40} {seconds * 1000:9.1f}ms")
+
+    eager = sorted({name for _, name, _ in best if name.split(".")[0] in HEAVY})
+
+    print(f"{'import main':<40} {total * 1000:9.1f}ms (budget {args.budget * 1000:.0f}ms)")
+
+    failed = False
+
+    if total > args.budget:
+        print(f"OVER BUDGET by {(total - args.budget) * 1000:.1f}ms")
+        failed = True
+
+    if eager:
+        print(f"Heavy modules imported eagerly: {', '.join(eager)}")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
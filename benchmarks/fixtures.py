@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Deterministic inputs for the benchmarks: payloads shaped like the recorded
+responses of OpenWeatherMap, searx and Google Translate, a seeded
+`module_site` database and the large inputs of the formatting hot paths.
+"""
+
+import json
+import os
+import sqlite3
+
+from random import Random
+
+from PIL import Image, ImageDraw
+
+
+__all__ = (
+    "offline_settings",
+    "forecast",
+    "search_results",
+    "translate_page",
+    "urls_database",
+    "disk_map",
+    "process_dump",
+    "nested_dict",
+    "screenshot",
+)
+
+
+def offline_settings(database_path):
+    """
+    Fill the settings without defaults, so that the modules import without a .env,
+    and point `module_site` at a database seeded by `urls_database`.
+    Must run before the modules that read the settings at import time are imported.
+    """
+    os.environ.setdefault("TG_APP_ID", "1")
+    os.environ.setdefault("TG_APP_HASH", "0" * 32)
+    os.environ.setdefault("PLUGINS", '{"root": "plugins"}')
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("MODULE_SITE_HOST", "https://s.example.com/")
+    os.environ.setdefault("MODULE_SITE_SALT", "bench")
+    os.environ.setdefault("MODULES_SEARCH_HOST", "http://searx.example.com/search")
+    os.environ.setdefault("MODULES_WEATHER_TOKEN", "bench")
+    os.environ["MODULE_SITE_DATABASE_MY_SITE_PATH"] = str(database_path)
+
+    urls_database(database_path)
+
+
+_DESCRIPTIONS = ("ясно", "небольшой снег", "пасмурно", "облачно с прояснениями", "небольшой дождь")
+
+
+def forecast(count: int = 40, city: str = "Kemerovo", seed: int = 0x42) -> str:
+    """
+    A 5 day / 3 hour forecast of `count` items as returned by `/data/2.5/forecast`.
+    """
+    random = Random(seed)
+    start = 1_680_000_000
+    items = []
+
+    for index in range(count):
+        temp = random.uniform(-25.0, 25.0)
+        items.append({
+            "dt": start + index * 3 * 60 * 60,
+            "main": {
+                "temp": temp,
+                "feels_like": temp - random.uniform(0.0, 6.0),
+                "temp_min": temp - 1.0,
+                "temp_max": temp + 1.0,
+                "pressure": random.randint(990, 1040),
+                "sea_level": random.randint(990, 1040),
+                "grnd_level": random.randint(970, 1010),
+                "humidity": random.randint(20, 100),
+                "temp_kf": 0.0,
+            },
+            "weather": [{"id": 800, "main": "Clear", "description": random.choice(_DESCRIPTIONS), "icon": "01d"}],
+            "clouds": {"all": random.randint(0, 100)},
+            "wind": {
+                "speed": random.uniform(0.0, 12.0),
+                "deg": random.randint(0, 359),
+                "gust": random.uniform(0.0, 20.0),
+            },
+            "visibility": 10000,
+            "pop": random.random(),
+            "sys": {"pod": "d" if index % 8 < 4 else "n"},
+            "dt_txt": f"2023-03-28 {index * 3 % 24:02d}:00:00",
+        })
+
+    return json.dumps({
+        "cod": "200",
+        "message": 0,
+        "cnt": count,
+        "list": items,
+        "city": {
+            "id": 1503901,
+            "name": city,
+            "coord": {"lat": 55.3333, "lon": 86.0833},
+            "country": "RU",
+            "population": 477090,
+            "timezone": 25200,
+            "sunrise": start - 20_000,
+            "sunset": start + 20_000,
+        },
+    })
+
+
+def search_results(query: str = "python", count: int = 10, engine: str = "duckduckgo") -> str:
+    """
+    A searx JSON answer with `count` results.
+    """
+    results = [
+        {
+            "title": f"{query} result {index}",
+            "content": f"Content of the result {index} about {query}, long enough to be cut in the reply.",
+            "url": f"https://example.com/{query}/{index}",
+            "engine": engine,
+            "parsed_url": ["https", "example.com", f"/{query}/{index}", "", "", ""],
+            "engines": [engine],
+            "positions": [index + 1],
+            "score": 1.0 / (index + 1),
+            "category": "general",
+            "pretty_url": f"https://example.com/{query}/{index}",
+        }
+        for index in range(count)
+    ]
+
+    return json.dumps({
+        "query": query,
+        "number_of_results": count,
+        "results": results,
+        "answers": [],
+        "corrections": [],
+        "infoboxes": [],
+        "suggestions": [],
+        "unresponsive_engines": [],
+    })
+
+
+def translate_page(text: str = "Hello, world!") -> str:
+    """
+    The part of the `translate.google.com/m` page that `modules.translate` reads.
+    """
+    return (
+        "<!DOCTYPE html><html><head><title>Google Translate</title></head><body>"
+        "<div class=\"root-container\"><div class=\"result-container\">"
+        f"{text}</div></div></body></html>"
+    )
+
+
+def urls_database(path, rows: int = 1000, seed: int = 0x42):
+    """
+    Create the `urls` table of `module_site` at `path` with `rows` short links.
+    """
+    random = Random(seed)
+
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+            "original_url TEXT NOT NULL, "
+            "clicks INTEGER NOT NULL DEFAULT 0)"
+        )
+        connection.executemany(
+            "INSERT INTO urls (original_url, clicks) VALUES (?, ?)",
+            ((f"https://example.com/page/{index}", random.randint(0, 1000)) for index in range(rows)),
+        )
+
+    connection.close()
+
+
+def disk_map(partitions: int = 1000, seed: int = 0x42) -> dict:
+    """
+    A `host_info.disk_info` result with `partitions` entries, like on a host with many container mounts.
+    """
+    random = Random(seed)
+    disks = {}
+
+    for index in range(partitions):
+        total = random.randint(1, 4096) * 1024 ** 3
+        used = random.randint(0, total)
+
+        disks[f"/dev/loop{index}"] = {
+            "<strong>mountpoint</strong>": f"/var/lib/containers/storage/overlay/{index:064x}/merged",
+            "<strong>file_system_type</strong>": random.choice(("ext4", "overlay", "xfs", "squashfs")),
+            "<strong>total_space</strong>": f"{total / 1024 ** 3:.1f} GB",
+            "<strong>used_space</strong>": f"{used / 1024 ** 3:.1f} GB",
+            "<strong>free_space</strong>": f"{(total - used) / 1024 ** 3:.1f} GB",
+            "<strong>space_percent_used</strong>": f"{used / total * 100:.1f}%",
+        }
+
+    return disks
+
+
+def process_dump(processes: int = 500, seed: int = 0x42) -> dict:
+    """
+    Details of `processes` processes keyed by pid, like `psutil.Process.as_dict()` for every process.
+    """
+    random = Random(seed)
+    dump = {}
+
+    for pid in range(1, processes + 1):
+        name = random.choice(("python3", "chromium", "postgres", "nginx", "sshd", "bash", "containerd-shim"))
+        rss = random.randint(1 << 20, 4 << 30)
+
+        dump[pid] = {
+            "name": name,
+            "username": random.choice(("root", "www-data", "postgres", "bot")),
+            "status": random.choice(("running", "sleeping", "idle")),
+            "cpu_percent": round(random.uniform(0.0, 100.0), 1),
+            "memory_percent": round(random.uniform(0.0, 20.0), 2),
+            "memory_info": (rss, rss * 2, random.randint(0, rss), 0, 0, random.randint(0, rss), 0),
+            "cmdline": [f"/usr/bin/{name}", *(f"--option-{index}=value" for index in range(random.randint(0, 6)))],
+            "open_files": [
+                {"path": f"/var/lib/{name}/file-{index}", "fd": index + 3, "mode": "r"}
+                for index in range(random.randint(0, 5))
+            ],
+            "environ": {f"VARIABLE_{index}": f"value-{random.getrandbits(32):08x}" for index in range(12)},
+        }
+
+    return dump
+
+
+def nested_dict(depth: int = 6, width: int = 6, seed: int = 0x42):
+    """
+    A nested structure of dicts, lists and scalars with about `width ** depth` leaves.
+    """
+    random = Random(seed)
+
+    def build(level: int):
+        if level == depth:
+            return random.choice((random.random(), random.randint(0, 1 << 32), "leaf " * random.randint(1, 5)))
+
+        if level % 2:
+            return [build(level + 1) for _ in range(width)]
+
+        return {f"key_{level}_{index}": build(level + 1) for index in range(width)}
+
+    return build(0)
+
+
+def screenshot(path, size: tuple = (3840, 2160), content: tuple = (1200, 1600)) -> bytes:
+    """
+    Save a JPEG like the screenshots of long replies: a block of content on a plain background.
+
+    :return: the encoded image, to restore the file after it was cropped in place
+    """
+    random = Random(0x42)
+    image = Image.new("RGB", size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    left, top = 40, 40
+
+    for line in range(0, content[1], 24):
+        width = random.randint(content[0] // 3, content[0])
+        draw.rectangle((left, top + line, left + width, top + line + 14), fill=(30, 30, 30))
+
+    image.save(path, format="JPEG", quality=100)
+
+    with open(path, "rb") as file:
+        return file.read()
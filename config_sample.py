@@ -3,7 +3,9 @@
 # Copyright 2022 Andrew Ivanov <okolefleef@disr.it>
 # All rights reserved
 
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 
 from pydantic import BaseSettings, SecretStr
 
@@ -12,7 +14,7 @@ path: Path = Path(__file__).resolve().parent
 
 class Settings(BaseSettings):
     TG_APP_ID:              int
-    PLUGINS:                dict  # ex: = {"root": "plugins"}
+    PLUGINS:                dict  # ex: = {"root": "plugins"}, a package of plugins besides the built-in ones
     DEBUG:                  bool = False
 
     # MODULES_WEATHER_URL:    str
@@ -28,18 +30,79 @@ class Settings(BaseSettings):
 
     HANDLERS_CHECK_SESSION_PATH:        Path = path / "tmp"
     HANDLERS_FILE_OGG_PATH:             Path = path / "files" / "voice.ogg"
-    IMAGE_LIMITER_PATH:                 Path = path / "files" / "screenshot.jpg"
     HTML_LIMITER_PATH:                  Path = path / "files" / "file.html"
     SESSION_NAME:                       Path = path / "data" / "sn"
+    ACCOUNTS:                           list = []  # more accounts, ex: = [{"session_name": "work", "api_id": 1, "api_hash": "..."}]
     PRIVATE_DATABASE_PATH:              Path = path / "data" / "private.sqlite"
     MODULE_SITE_DATABASE_MY_SITE_PATH:  Path = Path('/var/site/data/database.db')
     MODULE_SITE_DATABASE_PATH:          Path = MODULE_SITE_DATABASE_MY_SITE_PATH
 
+    SCHEDULER_MAX_ACTIVE:               int = 8
+    SCHEDULER_MAX_QUEUED:               int = 32
+    SCHEDULER_CLASS_LIMITS:             dict = {"cheap": 8, "normal": 4, "heavy": 2}
+
+    SHELL_TIMEOUT:                      float = 60.0
+    SHELL_OUTPUT_CAP:                   int = 1 << 20
+    SHELL_INLINE_LIMIT:                 int = 3000
+    SHELL_EDIT_INTERVAL:                float = 2.0
+    SHELL_SESSION_PROGRAM:              str = "/bin/sh"
+    SHELL_SESSION_IDLE_TIMEOUT:         float = 900.0
+
+    HOST_SAMPLER_INTERVAL:              float = 5.0
+    HOST_SAMPLER_TOP:                   int = 3
+    HOST_DISK_PROBE_TIMEOUT:            float = 2.0
+    PS_WATCH_INTERVAL:                  float = 5.0
+    PS_WATCH_MAX_DURATION:              float = 600.0
+
+    LAG_INTERVAL:                       float = 0.1
+    LAG_THRESHOLD:                      float = 0.25
+    LAG_KEEP:                           int = 10
+
+    PROFILE_INTERVAL:                   float = 0.005
+    PROFILE_BACKGROUND_INTERVAL:        float = 0.0  # always-on sampling of the main thread, 0 disables
+    PROFILE_TOP:                        int = 20
+
+    METRICS_PORT:                       Optional[int] = None  # serve Prometheus metrics on 127.0.0.1
+
+    HTTP_UPSTREAMS:                     dict = {}  # per upstream, ex: = {"search": {"read_timeout": 30.0, "http2": False}}
+    HTTP_DNS_TTL:                       float = 300.0
+    HTTP_CACHE_PATH:                    Optional[Path] = path / "data" / "http_cache.sqlite"  # None disables it
+    HTTP_CACHE_BYTES:                   int = 64 << 20
+    HTTP_CACHE_POLICIES:                dict = {}  # per upstream, ex: = {"weather": {"ttl": 300.0, "stale": 600.0}}
+
+    TTS_PRELOAD:                        bool = True  # build the TTS model in the background after login
+    STARTUP_IMPORT_BUDGET:              float = 1.0  # seconds, a warning is logged when the imports take longer
+
+    OVERFLOW_MODE:                      str = "image"  # long replies: "image", "pages" or "document"
+    OVERFLOW_MODES:                     dict = {}  # per command, ex: = {"ps": "document", "s": "pages"}
+    IMAGE_RENDERER:                     str = "pil"  # or "browser" to screenshot the text with Chromium
+    RENDER_FONT:                        str = "DejaVuSansMono.ttf"  # a file name in the system fonts or a path
+    RENDER_FONT_BOLD:                   str = "DejaVuSansMono-Bold.ttf"
+    RENDER_FONT_SIZE:                   int = 16
+    RENDER_COLUMNS:                     int = 100
+
+    SCREEN_VIEWPORT:                    dict = {"width": 1280, "height": 720}
+    SCREEN_CACHE_TTL:                   float = 300.0
+    SCREEN_CACHE_BYTES:                 int = 64 << 20
+    SCREEN_PAGES:                       int = 4  # pages open at once in the shared browser
+    SCREEN_MAX_URLS:                    int = 30
+
+    PYTHON_WORKERS:                     int = 2  # 0 runs every snippet inside the bot process
+    PYTHON_TIMEOUT:                     float = 30.0
+    PYTHON_MEMORY_LIMIT:                int = 512 << 20
+    PYTHON_OUTPUT_CAP:                  int = 1 << 16
+    PYTHON_NAMESPACE_IDLE_TIMEOUT:      float = 600.0
+    PYTHON_NAMESPACE_MEMORY_CAP:        int = 64 << 20
+
     class Config:
         env_file: Path = path / "data" / ".env"
 
 
+@lru_cache(maxsize=None)
 def get_env() -> Settings:
+    """
+    Parse the settings once, every caller shares the same object.
+    """
     return Settings()
 
 
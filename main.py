@@ -8,20 +8,26 @@
 # Python-Requires:
 #   >=3.8
 
-import sys
+from time import perf_counter
+
+_imports_started = perf_counter()
+
+import sys  # noqa: E402  the imports are timed
+import gzip
 import shlex
 import logging
-import subprocess
 
 from weakref import WeakMethod
 from contextlib import AsyncExitStack, asynccontextmanager
 from collections import defaultdict, deque
 from contextvars import ContextVar
-from functools import lru_cache
-from io import BytesIO, StringIO
+from datetime import datetime
+from functools import lru_cache, partial
+from html import escape
+from io import BytesIO
+from math import isfinite
 from random import choice
 # from re import DOTALL, search as re_search
-from time import perf_counter
 from traceback import format_exc
 from typing import Optional
 
@@ -30,16 +36,26 @@ import anyio
 from attrs import field, frozen, mutable, setters
 from anyio import (
     Event,
+    CancelScope,
     sleep,
+    to_thread,
     move_on_after,
     create_task_group,
 )
 from pyrogram import Client, enums, filters, idle, errors as pyrogram_errors, types as pyrogram_types
-from playwright.async_api import async_playwright, Error as pw_Error
 
 from config import get_env, Settings
+from modules import (
+    accounts, browser, dd_message, host_info, instrumentation, loop_monitor, metrics_history, plugins,
+    pretty_json, profiler, pyexec, routing, scheduler, screenshots, shell, startup, tts, upstreams,
+)
 from utils import Commands
-from modules import (dd_message, host_info, limit_symbols, module_site, pretty_json, search, translate, tts, weather)
+
+# Heavy dependencies, imported on the first use
+playwright = startup.lazy_import("playwright.async_api")
+limit_symbols = startup.lazy_import("modules.limit_symbols")
+
+startup.timings.add("imports", perf_counter() - _imports_started)
 
 
 @mutable(eq=False)
@@ -153,49 +169,110 @@ class OrderLock:
 class Capturing(list):
     """
     A context manager that captures the output of the executed code.
+    Only the output of the current task is captured, concurrent tasks keep printing to the real stdout.
     """
     def __enter__(self):
-        self._stdout = sys.stdout
-        sys.stdout = self._stringio = StringIO()
+        self._token = pyexec.capture()
         return self
 
     def __exit__(self, *args):
-        self.extend(self._stringio.getvalue().splitlines())
-        del self._stringio
-        sys.stdout = self._stdout
+        self.extend(pyexec.release(self._token).splitlines())
 
 
 class CommandHandler:
-    def __init__(self, client: Client, message: pyrogram_types.Message, sessions: dict, config: Settings, orders):
+    def __init__(
+            self, client: Client, message: pyrogram_types.Message, sessions: dict, config: Settings, orders,
+            args: Optional[dict] = None, command: Optional[Commands] = None):
         """
         Initialize a new CommandHandler instance.
         :param client: the Telegram API Client
         :param message: the incoming Telegram message
+        :param args: the command arguments parsed by the router, if the command has a schema
+        :param command: the command being handled: a member of `Commands` or a `plugins.Command`
         """
         self.client = client
         self.message = message
-        self.weather_session = sessions["weather_session"]
+        self.args = args or {}
+        self.command = command
+        self.http = sessions["http"]
         self.tts_session = sessions["tts_session"]
         self.browser_session = sessions["browser_session"]
+        self.scheduler = sessions["scheduler"]
+        self.python_pool = sessions["python_pool"]
+        self.python_namespaces = sessions["python_namespaces"]
+        self.shell_sessions = sessions["shell_sessions"]
+        self.host_sampler = sessions["host_sampler"]
+        self.watches = sessions["watches"]
+        self.loop_monitor = sessions["loop_monitor"]
+        self.profiler = sessions["profiler"]
+        self.screenshot_cache = sessions["screenshot_cache"]
+        self.plugins = sessions["plugins"]
+        self.footprint = sessions["footprint"]
+        self.sessions = sessions
         self.config = config
         self.orders = orders
+        # Work to run in the background once the command returned, outside of its admission
+        self.deferred = None
+
+    async def run(self) -> None:
+        """
+        Run the handler of the command: a method of this class for the core commands,
+        a function of the plugin that declares it otherwise.
+        """
+        if isinstance(self.command, plugins.Command):
+            return await self.command.handler(self)
+
+        return await getattr(self, self.command.value)()
+
+    @staticmethod
+    def _split_flag(text: str, flags: str) -> tuple:
+        """
+        Split a leading single-letter flag such as `-p` off the command text.
+        Letters other than `flags` are left in the text, as `-x + 1` is valid code.
+
+        :param flags: the letters of the flags of the command
+        :return: the flag letter or None, and the rest of the text
+        """
+        if text[:1] == "-" and text[1:2] in flags and text[1:2].isalpha() and not text[2:3].strip():
+            return text[1], text[3:]
+
+        return None, text
 
     @lru_cache(5)
-    def _text_to_speech(self, /, text: str):
-        return tts.synthesize_audio(self.tts_session, text, choice(('aidar', 'baya', 'kseniya', 'xenia')))
+    def _text_to_speech(self, /, model, text: str):
+        with instrumentation.metrics.timer("dependency", "tts"):
+            return tts.synthesize_audio(model, text, choice(('aidar', 'baya', 'kseniya', 'xenia')))
+
+    def _screen_options(self, /, proxy: str) -> dict:
+        return dict(
+            proxy=proxy,
+            viewport=self.config.SCREEN_VIEWPORT,
+            geolocation=dict(latitude=0, longitude=0),
+            locale="en-US",
+            permissions=["geolocation"],
+            timezone_id="Europe/Moscow",
+            user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                       "Chrome/109.0.5392.103 Safari/537.36"
+        )
 
-    async def limit_message(self, reply: bool = False, tti: bool = True, expire: int = 0) -> None:
+    async def limit_message(
+            self, reply: bool = False, tti: bool = True, expire: int = 0, overflow: Optional[str] = None) -> None:
         """
         Limit the message's symbol count and set an expiration time if specified.
         :param reply: whether to reply to the original message
         :param tti: whether to use Telegram's time-to-live feature
         :param expire: time in seconds for the message to be deleted, 0 for no expiration
+        :param overflow: the overflow mode of the handler, OVERFLOW_MODES of the settings take precedence
+            and OVERFLOW_MODE is the fallback
         """
+        if self.command is not None and self.command.name in self.config.OVERFLOW_MODES:
+            overflow = self.config.OVERFLOW_MODES[self.command.name]
 
         await self.orders.wait()
         msg = await limit_symbols.limit_symbols_message(
             settings=self.config, browser_session=self.browser_session,
-            message=self.message, client=self.client, reply=reply, tti=tti
+            message=self.message, client=self.client, reply=reply, tti=tti,
+            overflow=overflow or self.config.OVERFLOW_MODE
         )
         if bool(expire):
             await sleep(expire)
@@ -225,7 +302,7 @@ class CommandHandler:
             await self.limit_message(expire=5)
 
             start: float = perf_counter()
-            voice = self._text_to_speech(text)
+            voice = self._text_to_speech(await self.tts_session.get(), text)
             await self.client.send_voice(chat_id=self.message.chat.id, voice=voice,
                                          reply_to_message_id=reply_to_message_id)
 
@@ -235,65 +312,75 @@ class CommandHandler:
 
         await self.limit_message(reply=True)
 
-    async def shorten_url(self) -> None:
-        """
-        Shorten a URL.
-        """
-        message = self.message
-        reply_message = message.reply_to_message
-        url = reply_message.text if reply_message else message.text
-        try:
-            self.message.text = module_site.generate_short_link_for_url(url.strip())
-        except BaseException as error:
-            self.message.text = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
+    async def _host_frame(self, /, type_output: str) -> str:
+        if (snapshot := self.host_sampler.snapshot) is not None:
+            return host_info.full_info(type_output=type_output, snapshot=snapshot)
 
-        await self.limit_message()
+        return await to_thread.run_sync(host_info.full_info, type_output)
 
-    async def retrieve_url_statistics(self) -> None:
+    async def _watch_host(self, /, scope: CancelScope, type_output: str, duration: float) -> None:
         """
-        Retrieve statistics for a short URL.
+        Keep editing the message with fresh host information, like `top`.
+        Frames equal to the previous one are skipped. The watch stops after `duration` seconds
+        or when `scope` is cancelled by a new command in the same chat.
+
+        It runs on the task group of the bot, so errors such as a deleted message or a flood wait
+        end the watch and are logged instead of stopping the bot.
         """
-        message = self.message
-        reply_message = message.reply_to_message
-        url = reply_message.text if reply_message else message.text
+        cid = self.message.chat.id
+        interval = self.config.PS_WATCH_INTERVAL
+        header = f"<code>Watching {type_output} every {interval:g}s for {duration:g}s</code>\n\n"
 
-        try:
-            self.message.text = module_site.retrieve_usage_statistics_for_short_link(url.strip())
-        except BaseException as error:
-            self.message.text = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
+        with scope:
+            try:
+                with move_on_after(duration):
+                    shown = None
 
-        await self.limit_message()
+                    while True:
+                        frame = await self._host_frame(type_output)
+
+                        if frame != shown:
+                            await self.orders.wait()
+                            await self.message.edit(header + frame)
+                            shown = frame
+
+                        await sleep(interval)
+            except Exception:
+                logging.exception("The watch of chat %s failed", cid)
+            finally:
+                if self.watches.get(cid) is scope:
+                    del self.watches[cid]
 
     async def host_information(self) -> None:
         """
         Retrieve information about the host.
+        `.ps trend <cpu|mem|io>` shows the history of the metric over the last 5 minutes, hour and day.
+        `.ps watch <type> <seconds>` keeps the message updated with fresh information for a while.
         """
-        text = self.message.text
-        if text:
-            output_host_info = host_info.full_info(type_output=text)
-        else:
-            output_host_info = host_info.full_info(type_output="all")
+        type_output = self.args["type_output"]
 
-        await self.orders.wait()
-        await self.message.edit(str(output_host_info))
+        if type_output == "watch":
+            duration = self.args["duration"] or 60.0
 
-    async def translate_text(self) -> None:
-        """
-        Translate text to a specified language
-        """
-        message = self.message
-        options = {
-            "q": message.text,
-            "sl": "auto",
-            "tl": "en"
-        }
+            if not isfinite(duration) or duration <= 0:
+                raise routing.ArgumentError("Usage: .ps watch <type> <seconds>, the duration must be positive")
 
-        if reply_message := message.reply_to_message:
-            options["q"] = reply_message.text
-            options["tl"] = "ru"
+            duration = min(duration, self.config.PS_WATCH_MAX_DURATION)
+            # Registered now, so that a command arriving before the watch starts still cancels it
+            self.watches[self.message.chat.id] = scope = CancelScope()
+            self.deferred = partial(self._watch_host, scope, self.args["target"] or "cpu", duration)
+            return None
 
-        self.message.text = await translate.translate(self.weather_session, options)
-        await self.limit_message()
+        if type_output == "trend":
+            history = self.host_sampler.history
+            self.message.text = pretty_json.pretty_dumps(history.trend(self.args["target"] or "cpu"))
+            await self.limit_message(tti=False)
+            return None
+
+        output_host_info = await self._host_frame(type_output)
+
+        await self.orders.wait()
+        await self.message.edit(str(output_host_info))
 
     async def ban_user(self) -> None:
         """
@@ -363,86 +450,89 @@ class CommandHandler:
         :type self: object
         :return: None
         """
-        message, text = self.message, self.message.text
-        text_split = text.split()
-        options = {"reply": bool(getattr(message, "reply_to_message"))}
+        message = self.message
+        options = {"reply": bool(getattr(message, "reply_to_message")), **self.args}
 
-        if not text or len(text_split) > 2:
+        if options["limit"] is None:
             return
 
-        options["limit"] = int(text_split[0]) if text_split else None
-        options["over"] = len(text_split) == 2
-
         self.message.text = await dd_message.start(self.client, message, **options)
         await message.delete()
         await self.limit_message(reply=True, expire=5)
 
-    async def _weath(self, city: str, limit: int = 4) -> str:
-        """
-        Get the weather forecast for the given city.
-        :param city: the city to get the forecast for
-        :param limit: number of forecasts to return
-        :return: the weather forecast
+    async def _run_code(self, /, code: str) -> tuple:
         """
-        try:
-            self.message.text = "<code>Parsing weather...</code>"
-            await self.limit_message(tti=False)
-
-            start = perf_counter()
-            response_weather = await weather.get_response(session=self.weather_session, city=city)
-            output_weather_ = weather.wrapper_data(json_string=response_weather, limit=limit)
-            output_weather = f"{output_weather_}\n\n<code>Completed in: {perf_counter() - start:f}s</code>"
-        except BaseException as error:
-            output_weather = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
-
-        return output_weather
-
-    async def weather(self) -> None:
-        """
-        Handle weather command
-        """
-        try:
-            self.message.text = await self._weath(*self.message.text.split())
-            expire = 0
-        except TypeError:
-            self.message.text = "<code>Error input value</code>"
-            expire = 4
-
-        await self.limit_message(expire=expire)
-
-    async def _run_code(self, /) -> str:
-        """
-        Asynchronously execute the code in the message and return the code.
+        Asynchronously execute the code in the bot process and return the code.
 
         :param self: an instance of the class containing the message to be executed
-        :return: the code
+        :param code: the code to execute, it can use `self` and the other handler locals
+        :return: the code, the compile time and the run time
         """
-        code = '\n\t'.join(self.message.text.splitlines())
+        code = '\n\t'.join(code.splitlines())
         exec_vars = {**locals()}
-        exec(f'async def func():\n\t{code}', exec_vars, exec_vars)
-        try:
-            await exec_vars['func']()
-            return code
-        except Exception as e:
-            raise e
+
+        start_time = perf_counter()
+        exec(pyexec.code_cache.compile(f'async def func():\n\t{code}', flags=0), exec_vars, exec_vars)
+        compile_time = perf_counter() - start_time
+
+        await exec_vars['func']()
+        return code, compile_time, perf_counter() - start_time - compile_time
 
     async def execute_python(self) -> None:
         """
         Asynchronously execute the given python code in the message, capturing the output and execution time.
 
+        The code runs in a warm worker process with a timeout and a memory limit.
+        Flags change where it runs:
+            `-i` runs it inside the bot process, where it can access the handler as `self`
+                (also the default when the worker pool is disabled);
+            `-p` runs it inside the bot process in a namespace of the chat that keeps imports and variables
+                between calls until it is idle for `PYTHON_NAMESPACE_IDLE_TIMEOUT` seconds;
+            `-r` drops the namespace of the chat.
+
         :return: None
         """
+        flag, code = self._split_flag(self.message.text, "rpi")
+        cid = self.message.chat.id
+        namespaces = self.python_namespaces
+        info = {}
+
         try:
-            start_time = perf_counter()
-            with Capturing() as output_runcode:
-                code = await self._run_code()
+            if flag == "r":
+                dropped = namespaces.drop(cid)
+                self.message.text = f"<code>Namespace {'dropped' if dropped else 'is empty'}</code>"
+                await self.limit_message()
+                return None
+
+            if flag == "p":
+                namespace = namespaces.get(cid)
+                namespace.update(self=self, client=self.client, message=self.message)
+
+                with Capturing() as output_runcode:
+                    compile_time, run_time = await pyexec.run_async(code, namespace)
+
+                execution_output = "\n".join(output_runcode)
+                size = namespaces.account(cid)
+                info["\nNamespace"] = f"`{host_info.get_size(size)}`" if size else "`dropped, over the memory cap`"
+            elif flag == "i" or self.python_pool is None:
+                with Capturing() as output_runcode:
+                    code, compile_time, run_time = await self._run_code(code)
+
+                execution_output = "\n".join(output_runcode)
+            else:
+                result = await self.python_pool.run(code)
+                compile_time, run_time = result.compile_time, result.run_time
+                execution_output = result.output
+
+                if result.error:
+                    execution_output = f"{execution_output}\n{result.error}"
 
-            execution_time = perf_counter() - start_time
             self.message.text = pretty_json.pretty_dumps({
                 "Code": f"`{code}`",
-                "\nExecution Output": "\n" + "\n".join(output_runcode),
-                "\nExecution Time": f"`{execution_time:.6f}s`"
-
+                "\nExecution Output": "\n" + execution_output,
+                "\nCompile Time": f"`{compile_time:.6f}s`",
+                "\nExecution Time": f"`{run_time:.6f}s`",
+                **info,
             })
             print(self.message.text)
         except Exception as error:
@@ -450,45 +540,102 @@ class CommandHandler:
 
         await self.limit_message()
 
+    async def _watch_shell(self, /, code: str, output: shell.Output) -> None:
+        """
+        Keep editing the message with the tail of the output while the command runs.
+        """
+        interval = self.config.SHELL_EDIT_INTERVAL
+        shown = 0
+
+        while True:
+            await sleep(interval)
+
+            if output.total == shown:
+                continue
+
+            shown = output.total
+            await self.orders.wait()
+            await self.message.edit(
+                f"<strong>Running:</strong> <code>{escape(code, quote=False)}</code>\n\n"
+                f"<code>{escape(output.tail(self.config.SHELL_INLINE_LIMIT), quote=False)}</code>"
+            )
+
     async def execute_shell(self) -> None:
         """
         Executes a shell command and returns the result to the user.
 
         The method retrieves the shell command from the `message.text` attribute.
-        If the command starts with a list of unauthorized commands \
+        If any command of it starts with a list of unauthorized commands \
             (`"rm", "unlink", "poweroff", "reboot", "shutdown"`), \
             the method sends a "Unauthorized stack" message to the user and returns.
 
-        Otherwise, the method uses the `subprocess.run` method to execute the command and capture the output.
-        The execution time is also measured and included in the result.
-        The result is then formatted as a JSON string and stored in the `message.text` attribute.
+        Otherwise, the command runs in a subprocess without blocking the event loop.
+        With the `-s` flag it runs in a persistent shell session of the chat instead, which keeps
+        the working directory and shell state between commands and supports pipelines and builtins;
+        `-x` closes the session. Sessions are closed after `SHELL_SESSION_IDLE_TIMEOUT` idle seconds.
+
+        While the command runs, the message is edited with the tail of its output at most once per
+        `SHELL_EDIT_INTERVAL` seconds. The process group is killed after `SHELL_TIMEOUT` seconds
+        and at most `SHELL_OUTPUT_CAP` bytes of output are kept in memory.
 
-        The method finally calls the `limit_message` method to send the result to the user.
+        Short results are sent inline through the `limit_message` method,
+        longer ones as a gzip-compressed document.
         If an exception occurs during the execution, an error message is stored in the `message.text` \
         attribute and sent to the user.
 
         :return: None
         """
         try:
-            code = self.message.text
-            if code.startswith(("rm", "unlink", "poweroff", "reboot", "shutdown")):
+            flag, code = self._split_flag(self.message.text, "sx")
+            cid = self.message.chat.id
+
+            if flag == "x":
+                closed = self.shell_sessions.close(cid)
+                self.message.text = f"<code>Shell session {'closed' if closed else 'is not running'}</code>"
+                await self.limit_message()
+                return None
+
+            if shell.is_denied(code):
                 self.message.text = "Unauthorized stack"
                 await self.limit_message()
                 return None
 
-            start_time = perf_counter()
-            output_runcode = subprocess.run(
-                shlex.split(code),
-                input="",
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                text=True, check=True
-            ).stdout
-            execution_time = perf_counter() - start_time
+            output = shell.Output(cap=self.config.SHELL_OUTPUT_CAP)
+            timeout = self.config.SHELL_TIMEOUT
+
+            async with create_task_group() as tg:
+                tg.start_soon(self._watch_shell, code, output)
+
+                if flag == "s":
+                    session = await self.shell_sessions.get(cid)
+                    result = await session.run(code, timeout=timeout, output=output)
+                else:
+                    result = await shell.run(shlex.split(code), timeout=timeout, output=output)
+
+                tg.cancel_scope.cancel()
+
+            status = f"exit code {result.returncode}"
+            if result.timed_out:
+                status = f"killed after {timeout}s timeout"
+
+            if output.total > self.config.SHELL_INLINE_LIMIT:
+                document = BytesIO(gzip.compress(output.data))
+                document.name = "output.txt.gz"
+
+                await self.orders.wait()
+                await self.message.edit(
+                    f"<strong>Code:</strong> <code>{escape(code, quote=False)}</code>\n"
+                    f"<strong>Execution Output:</strong> {host_info.get_size(output.total)} ({status}) \U0001F447\n"
+                    f"<strong>Execution Time:</strong> <code>{result.elapsed:.6f}s</code>"
+                )
+                await self.client.send_document(chat_id=cid, document=document)
+                return None
 
             self.message.text = pretty_json.pretty_dumps({
-                "<strong>Code<strong>": f"`{self.message.text}`",
-                "\n<strong>Execution Output</strong>": f"\n `{output_runcode}`",
-                "\n<strong>Execution Time</strong>": f"`{execution_time:.6f}s`"
+                "<strong>Code<strong>": f"`{code}`",
+                "\n<strong>Execution Output</strong>": f"\n `{output.text}`",
+                "\n<strong>Execution Status</strong>": status,
+                "\n<strong>Execution Time</strong>": f"`{result.elapsed:.6f}s`"
 
             })
         except Exception as error:
@@ -496,41 +643,14 @@ class CommandHandler:
 
         await self.limit_message()
 
-    async def searchig(self) -> None:
-        message = self.message
-        if not message:
-            return None
-
-        await self.orders.wait()
-        await message.edit("<strong>Fetching...</strong>")
-        text = message.text.split("&")
-
-        if not text or text[0] != "engines":
-            self.message.text = await search.request(self.weather_session, *text)
-        else:
-            self.message.text = "<strong>Engines: </strong>\n" + " ".join(search.engines)
-
-        await self.limit_message(tti=False)
-
     async def screen_2ip(self, proxy: str) -> Optional[BytesIO]:
         url = r"https://2ip.ru/privacy/"
         start = perf_counter()
 
-        async with self.browser_session as p:
-            browser = await p.chromium.launch()
-            context = await browser.new_context(
-                proxy=dict(server=proxy),
-                geolocation=dict(latitude=0, longitude=0),
-                locale="en-US",
-                permissions=["geolocation"],
-                timezone_id="Europe/Moscow",
-                user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                           "Chrome/109.0.5392.103 Safari/537.36"
-            )
-            page = await context.new_page()
+        async with self.browser_session.page(**self._screen_options(proxy)) as page:
             try:
                 await page.goto(url)
-            except pw_Error as er:
+            except playwright.Error as er:
                 self.message.text = f"<strong>Error:</strong>\n<code>{er.message.split(' ')[0]}</code>"
                 await self.limit_message(expire=10)
                 return None
@@ -553,17 +673,62 @@ class CommandHandler:
         await self.message.delete()
         await self.client.send_photo(chat_id=self.message.chat.id, photo=binary_image, caption=caption_screen)
 
+    async def _capture(self, /, proxy: str, url: str) -> screenshots.Shot:
+        # Requests served from the cache never get here, so they do not start the browser
+        async with self.browser_session.page(**self._screen_options(proxy)) as page:
+            start = perf_counter()
+
+            await page.goto(url)
+
+            image = await page.screenshot(type="jpeg", caret="initial", quality=100)
+            title = await page.title()
+
+        return screenshots.Shot(image, title, perf_counter() - start)
+
+    async def _screenshots(self, /, urls: list, proxy: str, fresh: bool) -> list:
+        """
+        Capture the URLs concurrently in the shared browser, on at most SCREEN_PAGES pages at once.
+
+        :return: (url, shot, cached, error) for every URL, in order
+        """
+        results = [None] * len(urls)
+
+        async def screenshot(index: int, url: str):
+            key = self.screenshot_cache.key(url, proxy, self.config.SCREEN_VIEWPORT)
+            capture = partial(self._capture, proxy, url)
+
+            try:
+                shot, cached = await self.screenshot_cache.get(key, capture, fresh=fresh)
+            except playwright.Error as error:
+                results[index] = (url, None, False, error.message.split(" ")[0])
+            else:
+                results[index] = (url, shot, cached, None)
+
+        async with create_task_group() as tasks:
+            for index, url in enumerate(urls):
+                tasks.start_soon(screenshot, index, url)
+
+        return results
+
     async def screen(self) -> None:
+        """
+        Send screenshots of the websites in the message or in the replied message, from the cache if they
+        were taken recently. `-f` takes fresh screenshots, a `socks5://` address or a `proxy=` token
+        such as `proxy=http://host:port` sets the proxy.
+        Several websites are captured concurrently and sent as albums.
+        """
         message = self.message
         reply_message = message.reply_to_message
-        url = reply_message.text if reply_message else message.text
-        try:
-            url, proxy = url.split(" ")
-        except ValueError:
-            url = url.lstrip()
-            proxy = "socks5://127.0.0.1:9050"
+        flag, text = self._split_flag(message.text, "f")
+        proxy, text = screenshots.split_proxy(text)
+
+        if reply_message and reply_message.text:
+            reply_proxy, reply_text = screenshots.split_proxy(reply_message.text)
+            proxy, text = proxy or reply_proxy, f"{text} {reply_text}"
+
+        proxy = proxy or "socks5://127.0.0.1:9050"
 
-        if url == "anon":
+        if text.split() == ["anon"]:
             self.message.text = "<strong>[TEST APPLICATION | NON-STABLE]</strong>\n<code>Anonymity check." \
                                 "Wait approximately 10 seconds.</code>"
             await self.limit_message()
@@ -571,45 +736,194 @@ class CommandHandler:
             await message.delete()
             return None
 
-        if not url.startswith("http"):
-            url = f"https://{url}"
+        urls = screenshots.extract_urls(text, self.config.SCREEN_MAX_URLS)
 
-        self.message.text = f"<code>Upload site screenshot: {url}...</code>"
+        if not urls and text.strip():
+            urls = [screenshots.normalize_url(text.split()[0])]
+
+        if not urls:
+            raise routing.ArgumentError("Usage: .screen [-f] <url> [<url> ...] [socks5://proxy | proxy=http://host:port]")
+
+        self.message.text = f"<code>Upload site screenshot{'s' if len(urls) > 1 else ''}: {', '.join(urls)}...</code>"
         await self.limit_message()
 
         start = perf_counter()
-        async with self.browser_session as p:
-            browser = await p.chromium.launch(proxy=dict(server=proxy))
-            context = await browser.new_context(
-                proxy=dict(server=proxy),
-                geolocation=dict(latitude=0, longitude=0),
-                locale="en-US",
-                permissions=["geolocation"],
-                timezone_id="Europe/Moscow",
-                user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                           "Chrome/109.0.5392.103 Safari/537.36"
-            )
-            page = await context.new_page()
-            try:
-                await page.goto(url)
-            except pw_Error as er:
-                self.message.text = f"<strong>Error:</strong>\n`{er.message.split(' ')[0]}`"
+        results = await self._screenshots(urls, proxy, fresh=flag == "f")
+        failures = [f"<strong>Failed:</strong> {url} <code>{error}</code>" for url, _, _, error in results if error]
+        shots = [(url, shot, cached) for url, shot, cached, error in results if not error]
+
+        if len(results) == 1:
+            if failures:
+                self.message.text = f"<strong>Error:</strong>\n`{results[0][3]}`"
                 await self.limit_message(expire=10)
                 return None
 
-            binary_image = await page.screenshot(type="jpeg", caret="initial", quality=100)
-            binary_image = BytesIO(binary_image)
-            if title := await page.title():
-                url = f"[{title}]({url})"
+            url, shot, cached = shots[0]
+            if shot.title:
+                url = f"[{shot.title}]({url})"
 
             caption_screen = "\n".join([
                 f"<strong>Website:</strong> {url}",
-                f"<strong>Completed in:</strong> {perf_counter() - start:2f}s",
+                f"<strong>Completed in:</strong> {shot.elapsed:2f}s" + (" (cached)" if cached else ""),
                 f"<strong>Proxy:</strong> {proxy}",
             ])
 
+            await self.message.delete()
+            await self.client.send_photo(chat_id=message.chat.id, photo=BytesIO(shot.image), caption=caption_screen)
+            return None
+
+        header = [
+            f"<strong>Websites:</strong> {len(shots)}/{len(results)} in {perf_counter() - start:.2f}s",
+            f"<strong>Proxy:</strong> {proxy}",
+        ]
+
+        if not shots:
+            self.message.text = "\n".join([*header, *failures])
+            await self.limit_message()
+            return None
+
+        media = [
+            pyrogram_types.InputMediaPhoto(
+                BytesIO(shot.image),
+                caption=f"[{(shot.title or url)[:100]}]({url})\n<code>{shot.elapsed:.2f}s</code>"
+                        + (" (cached)" if cached else ""),
+            )
+            for url, shot, cached in shots
+        ]
+
+        # The first album carries the summary, within the 1024 characters of a caption
+        budget = 1024 - len(media[0].caption) - 64
+        shown = len(failures)
+
+        while shown and len("\n".join([*header, *failures[:shown]])) > budget:
+            shown -= 1
+
+        summary = [*header, *failures[:shown]]
+
+        if shown < len(failures):
+            summary.append(f"<strong>Failed:</strong> {len(failures) - shown} more")
+
+        media[0].caption = "\n".join([*summary, "", media[0].caption])
+
         await self.message.delete()
-        await self.client.send_photo(chat_id=message.chat.id, photo=binary_image, caption=caption_screen)
+
+        for index in range(0, len(media), 10):
+            await self.client.send_media_group(chat_id=message.chat.id, media=media[index:index + 10])
+
+    async def statistics(self) -> None:
+        """
+        Show latency percentiles and error counts per command and per dependency,
+        and the memory of the shared sessions and of every account.
+        """
+        self.message.text = pretty_json.pretty_dumps({
+            "<strong>Commands</strong>": instrumentation.metrics.summary("command") or "no data",
+            "<strong>Dependencies</strong>": instrumentation.metrics.summary("dependency") or "no data",
+            "<strong>HTTP</strong>": self.http.statistics(),
+            "<strong>Screenshots</strong>": self.screenshot_cache.statistics(),
+            "<strong>Browser</strong>": self.browser_session.statistics(),
+            "<strong>Memory</strong>": self.footprint.statistics(),
+        })
+        await self.limit_message()
+
+    async def loop_lag(self) -> None:
+        """
+        Show the event loop lag and the worst stalls with the stack of the blocking call.
+        """
+        text = pretty_json.pretty_dumps({"<strong>Loop lag</strong>": self.loop_monitor.statistics()})
+
+        for stall in self.loop_monitor.worst():
+            commands = ", ".join(stall.commands) or "no command"
+            at = datetime.fromtimestamp(stall.at).strftime("%H:%M:%S")
+            text += (
+                f"\n\n<strong>{stall.lag * 1000:.0f}ms at {at} during {commands}</strong>"
+                f"\n<code>{escape(stall.stack, quote=False)}</code>"
+            )
+
+        self.message.text = text
+        await self.limit_message()
+
+    async def profile_command(self) -> None:
+        """
+        Run a command under the profiler, e.g. `.prof wt London`,
+        or send the always-on samples with `.prof dump` and clear them with `.prof reset`.
+        """
+        text = self.message.text.strip()
+        cid = self.message.chat.id
+
+        if text == "reset":
+            self.profiler.reset()
+            self.message.text = "<code>Background samples cleared</code>"
+            await self.limit_message()
+            return None
+
+        if text == "dump":
+            collapsed, samples = self.profiler.dump()
+
+            if not samples:
+                self.message.text = "<code>No background samples, see PROFILE_BACKGROUND_INTERVAL</code>"
+                await self.limit_message()
+                return None
+
+            document = BytesIO(collapsed.encode())
+            document.name = "background.collapsed"
+
+            await self.orders.wait()
+            await self.message.edit(f"<strong>Background profile:</strong> <code>{samples}</code> samples \U0001F447")
+            await self.client.send_document(chat_id=cid, document=document)
+            return None
+
+        match = self.plugins.router.match(f".{text}")
+
+        if match is None or match.command is Commands.prof:
+            raise routing.ArgumentError("Usage: .prof <command> [arguments], .prof dump or .prof reset")
+
+        self.message.text = match.text
+        handler = CommandHandler(
+            self.client, self.message, self.sessions, self.config, self.orders, match.args, match.command
+        )
+        report = await self.profiler.run(handler.run())
+        self.deferred = handler.deferred
+
+        summary = (
+            f"<strong>Profile of .{match.command.name}:</strong> <code>{report.elapsed:.3f}s</code>, "
+            f"<code>{report.samples}</code> samples\n"
+        )
+
+        if report.error is not None:
+            summary += f"<strong>Error:</strong> <code>{escape(report.error, quote=False)}</code>\n"
+
+        summary += f"<code>{escape(report.stats[:3000], quote=False)}</code>"
+
+        document = BytesIO(report.collapsed().encode())
+        document.name = f"{match.command.name}.collapsed"
+
+        await self.orders.wait()
+        await self.message.reply(summary, disable_web_page_preview=True)
+        await self.client.send_document(chat_id=cid, document=document)
+
+    async def reload_plugin(self) -> None:
+        """
+        Reload the code of a plugin, e.g. `.reload weather`, or list the plugins without a name.
+        The sessions stay alive, and commands already running finish on the previous code.
+        """
+        if name := self.message.text.strip():
+            start = perf_counter()
+            plugin = self.plugins.reload(name)
+            self.message.text = (
+                f"<strong>Reloaded {plugin.name}</strong> in <code>{perf_counter() - start:.3f}s</code>: "
+                + " ".join(f".{command.name}" for command in plugin.commands)
+            )
+        else:
+            self.message.text = pretty_json.pretty_dumps({"<strong>Plugins</strong>": self.plugins.statistics()})
+
+        await self.limit_message()
+
+    async def queue_statistics(self) -> None:
+        """
+        Show the command scheduler load and queue wait times per cost class.
+        """
+        self.message.text = pretty_json.pretty_dumps(self.scheduler.statistics())
+        await self.limit_message()
 
     #
     # async def rewrite_code(self) -> None:
@@ -671,6 +985,15 @@ class CommandHandler:
     #     await self.limit_message()
 
 
+class InstrumentedClient(Client):
+    """
+    A pyrogram client that times every Telegram API call as the dependency `telegram:<method>`.
+    """
+    async def invoke(self, query, *args, **kwargs):
+        with instrumentation.metrics.timer("dependency", f"telegram:{type(query).__name__}"):
+            return await super().invoke(query, *args, **kwargs)
+
+
 @frozen(eq=False)
 class ChatBot:
     app = field()
@@ -690,11 +1013,11 @@ class ChatBot:
         return defaultdict(dict)
 
     def __init__(self, /, config, sessions, *args, **kwargs):
-        self.__attrs_init__(Client(*args, **kwargs), config, sessions)
+        self.__attrs_init__(InstrumentedClient(*args, **kwargs), config, sessions)
 
     def __attrs_post_init__(self, /):
         @self.app.on_message(
-            filters.create(self.is_relevant_message)
+            filters.create(self.is_relevant_message, plugins=self.sessions["plugins"])
         )
         async def _(*args, func=WeakMethod(self.on_message)):
             await func()(*args)
@@ -704,7 +1027,8 @@ class ChatBot:
 
         try:
             for obj in self.to_stack:
-                await stack.enter_async_context(obj)
+                with startup.timings.step(type(obj).__name__):
+                    await stack.enter_async_context(obj)
         except:
             if not await self.stack.__aexit__(*sys.exc_info()):
                 raise
@@ -713,24 +1037,18 @@ class ChatBot:
 
     async def __aexit__(self, /, exc_type, exc_value, traceback):
         print("Exiting program...")
-        await self.sessions["weather_session"].aclose()
 
         return await self.stack.__aexit__(exc_type, exc_value, traceback)
 
-    @staticmethod
-    def is_relevant_message(_, __, m: pyrogram_types.Message) -> bool:
-        if m.text is not None and isinstance(m.text, str):
-            try:
-                first_char = m.text[0]
-            except UnicodeDecodeError:
-                return False
-        else:
-            return False
+    @property
+    def router(self, /):
+        # Replaced by every reload of a plugin
+        return self.sessions["plugins"].router
 
-        return all([
-            m.from_user and m.from_user.is_self or getattr(m, "outgoing", False),
-            first_char in "./!*"
-        ])
+    @staticmethod
+    async def is_relevant_message(flt, _, m: pyrogram_types.Message) -> bool:
+        # A coroutine function, so that pyrogram does not hop to its thread pool for every update
+        return flt.plugins.router.is_relevant(m)
 
     @staticmethod  # !!!
     async def check_group_type(message):
@@ -740,32 +1058,37 @@ class ChatBot:
 
         return True
 
-    @staticmethod
-    def format_text(text, message):
-        prefix = text.lstrip("/").split()[0][1:]
-        message.text = text[len(prefix) + 1:].strip()
-        try:
-            return getattr(Commands, prefix)
-        except AttributeError:
-            return None
-
     async def on_message(self, /, client, message):
         cid = message.chat.id
         text = message.text
 
-        with self.orders[cid]:
-            async with self.writing(cid):
-                command = self.format_text(text, message)
-                if command is None:
-                    return None
+        # A new command in the chat ends a running `.ps watch`
+        if (watch := self.sessions["watches"].pop(cid, None)) is not None:
+            watch.cancel()
 
+        handler = None
 
+        with self.orders[cid]:
+            async with self.writing(cid):
                 try:
-                    print(command)
-                    await getattr(
-                        CommandHandler(client, message, self.sessions, self.config, self.orders[cid]),
-                        command.value
-                    )()
+                    match = self.router.match(text)
+                    if match is None:
+                        return None
+
+                    command = match.command
+                    message.text = match.text
+
+                    async with self.sessions["scheduler"].admit(cid, command, message.text, self.app.name):
+                        print(command)
+                        with instrumentation.metrics.timer("command", command.name), \
+                                self.sessions["loop_monitor"].running(command.name):
+                            handler = CommandHandler(
+                                client, message, self.sessions, self.config, self.orders[cid], match.args, command
+                            )
+                            await handler.run()
+                except (routing.ArgumentError, scheduler.Rejected) as error:
+                    await self.orders[cid].wait()
+                    await message.edit(f"<code>{error}</code>")
                 except Exception as error:
                     await self.orders[cid].wait()
                     await message.reply(f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>")
@@ -778,6 +1101,10 @@ class ChatBot:
                         enums.ChatAction.TYPING,
                     )
 
+        # Long-running work like `.ps watch` holds no scheduler slot, order lock or typing indicator
+        if handler is not None and handler.deferred is not None:
+            self.tasks.start_soon(handler.deferred)
+
     async def progress(self, /, chat_id, event):
         info = self.writers[chat_id]
 
@@ -791,9 +1118,6 @@ class ChatBot:
                 with move_on_after(3):
                     await event.wait()
         finally:
-            del info['event']
-            del info['count']
-
             await self.app.send_chat_action(
                 chat_id,
                 enums.ChatAction.CANCEL,
@@ -820,16 +1144,82 @@ class ChatBot:
                 info['count'] = count = count - 1
 
                 if not count:
+                    # A command arriving before `progress` exits starts a new indicator
+                    del info['event']
+                    del info['count']
+
                     event.set()
 
     @property
     def to_stack(self, /):
+        # The shared sessions are entered once for all the accounts, see `shared_stack`
+        yield self.sessions["shell_sessions"]
+
         yield self.app
         yield self.tasks
 
 
+def shared_stack(config: Settings, sessions: dict):
+    """
+    The context managers of the sessions shared by all the accounts, in the order to enter them.
+    """
+    if config.METRICS_PORT is not None:
+        yield instrumentation.MetricsServer(config.METRICS_PORT)
+
+    yield sessions["loop_monitor"]
+    yield sessions["profiler"]
+    yield sessions["http"]
+    yield sessions["browser_session"]
+
+    if sessions["python_pool"] is not None:
+        yield sessions["python_pool"]
+
+    yield sessions["host_sampler"]
+
+
+def create_sessions(config: Settings) -> dict:
+    """
+    The sessions shared by all the accounts: the heavy models, pools and caches.
+    """
+    return dict(
+        # First, to measure the memory before the others
+        footprint=accounts.Footprint(),
+        http=upstreams.Clients.from_settings(config),
+        tts_session=tts.Model(),
+        browser_session=browser.BrowserPool.from_settings(config),
+        python_pool=pyexec.WorkerPool.from_settings(config) if config.PYTHON_WORKERS else None,
+        host_sampler=host_info.Sampler.from_settings(
+            config, history=metrics_history.History(config.HOST_SAMPLER_INTERVAL)
+        ),
+        loop_monitor=loop_monitor.LoopMonitor.from_settings(config),
+        profiler=profiler.Profiler.from_settings(config),
+        screenshot_cache=screenshots.ScreenshotCache.from_settings(config),
+        plugins=plugins.Registry.from_settings(config),
+        # One cap for the commands of all the accounts, they run on the same loop and share the pools
+        scheduler=scheduler.Scheduler.from_settings(config),
+    )
+
+
+def create_account_sessions(config: Settings) -> dict:
+    """
+    The sessions of one account: the state it keeps per chat, as the chat IDs of two accounts may be the same.
+    """
+    return dict(
+        python_namespaces=pyexec.Namespaces.from_settings(config),
+        shell_sessions=shell.Sessions.from_settings(config),
+        watches={},
+    )
+
+
+async def preload_model(sessions: dict):
+    with sessions["footprint"].measure("tts_session"):
+        await sessions["tts_session"].preload()
+
+
 async def async_main():
-    config = get_env()
+    with startup.timings.step("config"):
+        config = get_env()
+
     if config.DEBUG:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -840,19 +1230,38 @@ async def async_main():
     ]) or sys.version_info[:3] < (3, 8, 0):
         raise ValueError("Missing required settings or unsupported Python version")
 
-    sessions = dict(
-        weather_session=weather.create_session(),
-        tts_session=tts.load_model(),
-        browser_session=async_playwright()
-    )
-    bot = ChatBot(
-        config=config,
-        sessions=sessions,
-        name=str(config.SESSION_NAME),
-        api_id=config.TG_APP_ID,
-        api_hash=config.TG_APP_HASH.get_secret_value(),
-    )
-    async with bot:
+    with startup.timings.step("sessions"):
+        sessions = create_sessions(config)
+        bots = {
+            account.name: ChatBot(
+                config=config,
+                sessions={**sessions, **create_account_sessions(config)},
+                name=str(account.session_name),
+                api_id=account.api_id,
+                api_hash=account.api_hash,
+            )
+            for account in accounts.from_settings(config)
+        }
+
+    async with AsyncExitStack() as stack:
+        for obj in shared_stack(config, sessions):
+            with startup.timings.step(type(obj).__name__):
+                await stack.enter_async_context(obj)
+
+        sessions["footprint"].record_shared()
+
+        for name, bot in bots.items():
+            await stack.enter_async_context(bot)
+            sessions["footprint"].record_account(name)
+
+        print(f"Started {len(bots)} account(s) in:\n{startup.timings.report()}")
+        print(pretty_json.pretty_dumps(sessions["footprint"].statistics()))
+        startup.timings.check_budget("imports", config.STARTUP_IMPORT_BUDGET)
+
+        if config.TTS_PRELOAD:
+            # The model is shared, it is built once for all the accounts
+            next(iter(bots.values())).tasks.start_soon(preload_model, sessions)
+
         await idle()
 
 
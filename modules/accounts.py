@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Several Telegram accounts in one process.
+
+The account of SESSION_NAME is always run, and ACCOUNTS lists the others.
+Every account gets its own `ChatBot` with its own pyrogram client, ordering
+locks, Python namespaces, shell sessions and `.ps watch` tasks, while the
+scheduler, the TTS model, the Python workers, the browser, the HTTP clients
+and their cache, the screenshot cache and the plugins are created once and
+shared by all. The scheduler caps the commands of all the accounts together,
+and its queue tells the chats of the accounts apart by the account name.
+
+`Footprint` records the resident memory of the process before the shared
+sessions, after them and after the login of every account, so the cost of
+one more account can be told apart from the cost of the shared part. What
+is built after the logins, like the preloaded TTS model, is measured with
+`Footprint.measure` and added to the shared part, and the Python workers and
+the browser, being other processes, are reported on their own as children.
+A TTS model built on its first use when TTS_PRELOAD is off is not counted.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+
+import psutil
+
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "Account",
+    "from_settings",
+    "Footprint",
+)
+
+
+@frozen
+class Account:
+    """
+    :param name: the label of the account in the reports
+    :param session_name: the pyrogram session file, without the extension
+    """
+    name = field()
+    session_name = field()
+    api_id = field()
+    api_hash = field(repr=False)
+
+
+def from_settings(settings, /) -> tuple:
+    """
+    The account of SESSION_NAME first, then ACCOUNTS. The API ID and hash default to TG_APP_ID and TG_APP_HASH,
+    and a relative session name is taken from the directory of SESSION_NAME.
+
+    :raises ValueError: two accounts share a session or a name
+    """
+    default = Path(settings.SESSION_NAME)
+    accounts = [Account(default.name, default, settings.TG_APP_ID, settings.TG_APP_HASH.get_secret_value())]
+
+    for options in settings.ACCOUNTS:
+        session_name = default.parent / Path(options["session_name"]).expanduser()
+        accounts.append(Account(
+            options.get("name", session_name.name),
+            session_name,
+            options.get("api_id", settings.TG_APP_ID),
+            options.get("api_hash", settings.TG_APP_HASH.get_secret_value()),
+        ))
+
+    sessions = {account.session_name.resolve() for account in accounts}
+    names = {account.name for account in accounts}
+
+    if len(sessions) != len(accounts) or len(names) != len(accounts):
+        raise ValueError("Every account needs its own session_name and name")
+
+    return tuple(accounts)
+
+
+def _rss() -> int:
+    return psutil.Process().memory_info().rss
+
+
+def _children_rss() -> int:
+    total = 0
+
+    # The fork server, the Python workers, the Playwright driver and Chromium
+    for child in psutil.Process().children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+
+    return total
+
+
+@mutable(eq=False)
+class Footprint:
+    """
+    Resident memory of the process at the steps of the startup.
+    """
+    started = field(factory=_rss)
+    shared = field(default=None)
+    accounts = field(init=False, factory=dict)
+    late = field(init=False, factory=dict)
+
+    def record_shared(self, /):
+        self.shared = _rss()
+
+    def record_account(self, name: str, /):
+        self.accounts[name] = _rss()
+
+    @contextmanager
+    def measure(self, name: str, /):
+        """
+        Count the growth of the memory during the block as a shared resource built after the logins.
+        """
+        start = _rss()
+
+        try:
+            yield
+        finally:
+            self.late[name] = _rss() - start
+
+    def statistics(self, /) -> dict:
+        """
+        :return: the memory of the process now, of the shared sessions, of the child processes,
+            and of every account at its login
+        """
+        mib = 1 << 20
+        shared = self.shared or self.started
+        late = sum(self.late.values())
+        previous = shared
+        accounts = {}
+
+        for name, rss in self.accounts.items():
+            # The growth since the previous step, that is the login of this account
+            accounts[name] = f"{(rss - previous) / mib:+.1f}MB"
+            previous = rss
+
+        per_account = (previous - shared) / len(self.accounts) if self.accounts else 0.0
+
+        return {
+            "accounts": len(self.accounts),
+            "rss": f"{_rss() / mib:.1f}MB",
+            "shared": f"{(shared - self.started + late) / mib:.1f}MB",
+            **{name: f"{growth / mib:+.1f}MB" for name, growth in self.late.items()},
+            "children": f"{_children_rss() / mib:.1f}MB",
+            "per_account": f"{per_account / mib:.1f}MB",
+            **accounts,
+        }
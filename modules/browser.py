@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+One Chromium shared by the renders of long replies and `.screen`, for all the accounts.
+
+The Playwright driver and the browser are started by the first capture, not
+at startup, and kept running until the bot exits. Every capture gets its own
+browser context, so cookies and the proxy are not shared between captures,
+and at most `max_pages` pages are open at once; further captures wait.
+A browser that crashed or disconnected is started again by the next capture.
+"""
+
+from contextlib import asynccontextmanager
+
+from anyio import CancelScope, Lock, Semaphore
+from attrs import field, mutable
+
+from modules.instrumentation import metrics
+
+
+__all__ = (
+    "BrowserPool",
+)
+
+
+@mutable(eq=False)
+class BrowserPool:
+    """
+    :param max_pages: pages open at once in the browser
+    """
+    max_pages = field(default=4)
+
+    _lock = field(init=False, factory=Lock)
+    _pages = field(init=False, default=None)
+    _playwright = field(init=False, default=None)
+    _browser = field(init=False, default=None)
+    _launches = field(init=False, default=0)
+    _captures = field(init=False, default=0)
+    _active = field(init=False, default=0)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(max_pages=settings.SCREEN_PAGES)
+
+    async def _get_browser(self, /):
+        async with self._lock:
+            if self._browser is not None and self._browser.is_connected():
+                return self._browser
+
+            await self._stop()
+
+            # Imported on the first capture
+            from playwright.async_api import async_playwright
+
+            self._playwright = await async_playwright().start()
+
+            try:
+                # The proxies are set per context, which Chromium supports without a global one on Linux
+                self._browser = await self._playwright.chromium.launch()
+            except BaseException:
+                await self._stop()
+                raise
+
+            self._launches += 1
+
+            return self._browser
+
+    async def _stop(self, /):
+        browser, self._browser = self._browser, None
+        driver, self._playwright = self._playwright, None
+
+        try:
+            if browser is not None and browser.is_connected():
+                await browser.close()
+        finally:
+            if driver is not None:
+                await driver.stop()
+
+    @asynccontextmanager
+    async def page(self, /, proxy: str = None, **options):
+        """
+        A page in a new context of the shared browser, closed with the context after the block.
+
+        :param proxy: the proxy server of the context, None for none
+        :param options: the options of `Browser.new_context`
+        """
+        if self._pages is None:
+            self._pages = Semaphore(self.max_pages)
+
+        async with self._pages:
+            with metrics.timer("dependency", "browser"):
+                browser = await self._get_browser()
+
+                if proxy:
+                    options["proxy"] = dict(server=proxy)
+
+                context = await browser.new_context(**options)
+                self._captures += 1
+                self._active += 1
+
+                try:
+                    yield await context.new_page()
+                finally:
+                    self._active -= 1
+
+                    with CancelScope(shield=True):
+                        await context.close()
+
+    def statistics(self, /) -> dict:
+        return {
+            "running": self._browser is not None and self._browser.is_connected(),
+            "launches": self._launches,
+            "captures": self._captures,
+            "pages": f"{self._active}/{self.max_pages}",
+        }
+
+    async def __aenter__(self, /):
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        async with self._lock:
+            await self._stop()
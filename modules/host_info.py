@@ -3,13 +3,22 @@
 # Copyright 2022 Andrew Ivanov <okolefleef@disr.it>
 # All rights reserved
 
+import heapq
+import logging
+import threading
+
+from time import monotonic
+
 import arrow
 import psutil
 
+from attrs import field, mutable
+
 from modules.pretty_json import pretty_dumps
 
 __all__ = [
-    "full_info"
+    "full_info",
+    "Sampler",
 ]
 
 
@@ -52,20 +61,46 @@ def cpu_info() -> dict:
         "<strong>cpu_load_15min</strong>": f"{load_15min:.1f}%",
     }
 
-def memory_info() -> dict:
+def _process() -> psutil.Process:
+    global _PROCESS
+
+    if _PROCESS is None:
+        _PROCESS = psutil.Process()
+
+    return _PROCESS
+
+
+_PROCESS = None
+
+
+def most_hungry_processes(top: int = 3) -> list:
+    """
+    Get the processes with the largest RSS in a single pass over the process table.
+    Processes that exit or deny access during the scan are skipped.
+    :param top: number of processes
+    :return: list of process info dicts with pid, name and memory_info
+    """
+
+    return heapq.nlargest(
+        top,
+        (p.info for p in psutil.process_iter(attrs=["pid", "name", "memory_info"]) if p.info["memory_info"]),
+        key=lambda info: info["memory_info"].rss,
+    )
+
+
+def memory_info(top: int = 3) -> dict:
     """
     Get information about RAM.
-    :param lib: tuple
+    :param top: number of the most memory hungry processes to list
     :return: dict
     """
 
-    proc = psutil.Process()
+    proc = _process()
     memory_rss = proc.memory_info().rss / 1024 / 1024
     memory_percent = proc.memory_percent()
 
-    most_hungry_processes = sorted(psutil.process_iter(), key=lambda p: p.memory_info().rss, reverse=True)[:3]
-    most_hungry_processes_info = [f"{p.name()} (pid {p.pid}): {p.memory_info().rss / (1024 ** 2):.1f} MB"
-                                  for p in most_hungry_processes]
+    most_hungry_processes_info = [f"{info['name']} (pid {info['pid']}): {info['memory_info'].rss / (1024 ** 2):.1f} MB"
+                                  for info in most_hungry_processes(top)]
 
     virtual_memory = psutil.virtual_memory()
     swap_memory = psutil.swap_memory()
@@ -89,19 +124,68 @@ def memory_info() -> dict:
         }
     }
 
-def disk_info() -> dict:
+def _probe(mountpoint: str, results: dict):
+    try:
+        results[mountpoint] = psutil.disk_usage(mountpoint)
+    except OSError as e:
+        results[mountpoint] = e
+
+
+_PENDING_PROBES = {}
+
+
+def probe_usage(mountpoints: list, timeout: float = 2.0) -> dict:
+    """
+    Get the usage of every mountpoint, giving up on those that do not answer within the timeout,
+    such as stale network mounts. A hung mountpoint is not probed again until its probe returns.
+    :param mountpoints: list of mountpoints
+    :param timeout: total time to wait for the probes in seconds
+    :return: dict of mountpoint to usage, or to the exception raised by the probe
+    """
+
+    results = {}
+    threads = []
+
+    for mountpoint in mountpoints:
+        if (thread := _PENDING_PROBES.get(mountpoint)) is not None and thread.is_alive():
+            results[mountpoint] = TimeoutError("the previous probe has not returned yet")
+            continue
+
+        _PENDING_PROBES[mountpoint] = thread = threading.Thread(
+            target=_probe, args=(mountpoint, results), name=f"disk-probe {mountpoint}", daemon=True
+        )
+        thread.start()
+        threads.append((mountpoint, thread))
+
+    deadline = monotonic() + timeout
+
+    for mountpoint, thread in threads:
+        thread.join(max(0.0, deadline - monotonic()))
+
+        if thread.is_alive():
+            results[mountpoint] = TimeoutError(f"no answer within {timeout}s")
+        else:
+            del _PENDING_PROBES[mountpoint]
+
+    return results
+
+
+def disk_info(timeout: float = 2.0) -> dict:
     """
     Get information about all disk partitions.
-    :param lib: ...
+    :param timeout: how long to wait for the usage of all partitions in seconds
     :return: dict
     """
 
     disk_partitions = psutil.disk_partitions()
+    disk_usages = probe_usage([partition.mountpoint for partition in disk_partitions], timeout)
     disk_usage = {}
 
     for partition in disk_partitions:
         try:
-            usage = psutil.disk_usage(partition.mountpoint)
+            usage = disk_usages[partition.mountpoint]
+            if isinstance(usage, BaseException):
+                raise usage
 
             disk_usage[partition.device] = {
                 "<strong>mountpoint</strong>": partition.mountpoint,
@@ -111,7 +195,7 @@ def disk_info() -> dict:
                 "<strong>free_space</strong>": f"{usage.free / 1024 ** 3:.1f} GB",
                 "<strong>space_percent_used</strong>": f"{usage.percent}%"
             }
-        except PermissionError as e:
+        except OSError as e:
             disk_usage[partition.device] = {
                 "<strong>error</strong>": str(e)
             }
@@ -135,27 +219,95 @@ def sys_info() -> dict:
         "<strong>Available RAM</strong>": f'{psutil.virtual_memory().total / (1024**3):.1f}Gb'
     }
 
-def full_info(type_output: str = None) -> dict:
+HANDLERS = {"disk": disk_info, "cpu": cpu_info, "mem": memory_info, "sys": sys_info}
+
+
+def full_info(type_output: str = None, snapshot: dict = None) -> str:
     """
-    The function returns information about the system in the form of a dictionary.
-    Takes as input a tuple of two elements, the first of which contains the name of the function,
-    the second is the name of the module, as well as a string specifying the type of information output.
-    Returns information as a dictionary.
+    The function returns information about the system as pretty printed text.
+    Takes a string specifying the type of information output and, optionally,
+    a snapshot taken by `Sampler` to format instead of scanning the system.
 
-    :param lib: tuple
     :param type_output: str
-    :return: dict
+    :param snapshot: dict
+    :return: str
     """
 
-    handler = {"disk": disk_info, "cpu": cpu_info, "mem": memory_info}
+    if type_output not in HANDLERS:
+        type_output = "sys"
 
-    if type_output not in handler:
-        host_info_dict = sys_info()
+    if snapshot is not None:
+        host_info_dict = snapshot[type_output]
     else:
-        host_info_dict = handler[type_output]()
+        host_info_dict = HANDLERS[type_output]()
 
     return pretty_dumps(host_info_dict)
 
 
+@mutable(eq=False)
+class Sampler:
+    """
+    Samples host metrics in a background thread, so that `.ps` reads the latest snapshot instantly.
+
+    :param interval: seconds between samples
+    :param top: number of the most memory hungry processes to keep
+    :param disk_timeout: how long to wait for the usage of all partitions in seconds
+    :param history: a `metrics_history.History` to record on every sample, if any
+    """
+    interval = field(default=5.0)
+    top = field(default=3)
+    disk_timeout = field(default=2.0)
+    history = field(default=None)
+    snapshot = field(init=False, default=None)
+
+    _stop = field(init=False, factory=threading.Event)
+    _thread = field(init=False, default=None)
+
+    @classmethod
+    def from_settings(cls, settings, /, history=None):
+        return cls(
+            interval=settings.HOST_SAMPLER_INTERVAL,
+            top=settings.HOST_SAMPLER_TOP,
+            disk_timeout=settings.HOST_DISK_PROBE_TIMEOUT,
+            history=history,
+        )
+
+    def sample(self, /) -> dict:
+        return {
+            "cpu": cpu_info(),
+            "mem": memory_info(self.top),
+            "disk": disk_info(self.disk_timeout),
+            "sys": sys_info(),
+        }
+
+    def _run(self, /):
+        while True:
+            try:
+                if self.history is not None:
+                    self.history.record()
+
+                self.snapshot = self.sample()
+            except Exception:
+                logging.exception("Host metrics sampling failed")
+
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self, /):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="host-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self, /):
+        self._stop.set()
+
+    async def __aenter__(self, /):
+        self.start()
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        self.stop()
+
+
 if __name__ == "__main__":
     print(full_info(type_output="mem"))
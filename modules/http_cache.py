@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Disk cache of HTTP responses under the httpx transport of the upstreams.
+
+Caching is opt-in per request: `client.get(url, extensions={"cache": True})`
+applies the policy of the upstream, and a `Policy` in place of True overrides
+it for that call. Only successful GET responses are stored, in SQLite, so the
+cache survives restarts.
+
+A response is fresh for the max-age of its Cache-Control header, or the TTL
+of the policy without one, and `no-store` responses are not kept. A stale
+response is still served for the stale-while-revalidate window while a
+background request revalidates it with its ETag or Last-Modified. It is also
+served when the revalidation fails. Policies with `override` ignore the
+headers of the server.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+
+from email.utils import parsedate_to_datetime
+from hashlib import sha256
+from time import time
+
+from anyio import create_task_group, to_thread
+from attrs import evolve, field, frozen, mutable
+from httpx import AsyncBaseTransport, ByteStream, Request, Response
+
+
+__all__ = (
+    "Policy",
+    "POLICIES",
+    "ResponseCache",
+    "CachingTransport",
+)
+
+# Connection-level headers, meaningless for a stored response
+_HOP_BY_HOP = frozenset(("connection", "keep-alive", "transfer-encoding", "proxy-connection", "upgrade"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    upstream TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    fresh_until REAL NOT NULL,
+    stale_until REAL NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+
+@frozen
+class Policy:
+    """
+    :param ttl: seconds a response is fresh when the server does not say
+    :param stale: seconds a response is served after it expires, while it is revalidated
+    :param override: ignore the caching headers of the server
+    """
+    ttl = field(default=300.0)
+    stale = field(default=0.0)
+    override = field(default=False)
+
+
+POLICIES = {
+    # The forecast is updated every few hours
+    "weather": Policy(ttl=600.0, stale=1800.0),
+    "search": Policy(ttl=900.0, stale=3600.0),
+    # Translations do not change, while the page is sent as uncacheable
+    "translate": Policy(ttl=7 * 86400.0, stale=86400.0, override=True),
+}
+
+
+def _directives(value: str) -> dict:
+    directives = {}
+
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+
+        if name:
+            directives[name.lower()] = argument.strip('"')
+
+    return directives
+
+
+def _seconds(value, default: float) -> float:
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def lifetimes(policy: Policy, headers, /, now: float) -> tuple:
+    """
+    :return: the times until which a response is fresh and may be served stale, None if it must not be stored
+    """
+    if policy.override:
+        return now + policy.ttl, now + policy.ttl + policy.stale
+
+    directives = _directives(headers.get("cache-control", ""))
+
+    if "no-store" in directives:
+        return None
+
+    if "no-cache" in directives:
+        ttl = 0.0
+    elif "max-age" in directives:
+        ttl = _seconds(directives["max-age"], policy.ttl)
+    elif "expires" in headers:
+        try:
+            ttl = max(parsedate_to_datetime(headers["expires"]).timestamp() - now, 0.0)
+        except (TypeError, ValueError):
+            ttl = 0.0
+    else:
+        ttl = policy.ttl
+
+    if "must-revalidate" in directives:
+        stale = 0.0
+    else:
+        stale = _seconds(directives.get("stale-while-revalidate"), policy.stale)
+
+    return now + ttl, now + ttl + stale
+
+
+@frozen
+class _Entry:
+    status = field()
+    headers = field()
+    body = field()
+    fresh_until = field()
+    stale_until = field()
+
+
+@mutable(eq=False)
+class _Counters:
+    hits = field(default=0)
+    stale = field(default=0)
+    revalidated = field(default=0)
+    misses = field(default=0)
+    bytes_saved = field(default=0)
+
+
+@mutable(eq=False)
+class ResponseCache:
+    """
+    :param path: the SQLite database of the responses
+    :param max_bytes: total size of the stored bodies; least recently used responses are dropped to stay below it
+    :param policies: policies per upstream, overriding the fields of `POLICIES`
+    """
+    path = field()
+    max_bytes = field(default=64 << 20)
+    policies = field(factory=dict)
+
+    _db = field(init=False, default=None)
+    _lock = field(init=False, factory=threading.Lock)
+    _tasks = field(init=False, default=None)
+    _revalidating = field(init=False, factory=set)
+    _counters = field(init=False, factory=dict)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(settings.HTTP_CACHE_PATH, settings.HTTP_CACHE_BYTES, settings.HTTP_CACHE_POLICIES)
+
+    def policy(self, upstream: str, /) -> Policy:
+        return evolve(POLICIES.get(upstream, Policy()), **self.policies.get(upstream, {}))
+
+    def counters(self, upstream: str, /) -> _Counters:
+        if (counters := self._counters.get(upstream)) is None:
+            self._counters[upstream] = counters = _Counters()
+
+        return counters
+
+    @staticmethod
+    def key(upstream: str, request: Request, /) -> str:
+        # Hashed, the query strings may carry API keys
+        return sha256(f"{upstream} {request.url}".encode()).hexdigest()
+
+    def _connect(self, /) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+
+        return self._db
+
+    def _load(self, key: str, /):
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT status, headers, body, fresh_until, stale_until FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute("UPDATE responses SET used = ? WHERE key = ?", (time(), key))
+
+        status, headers, body, fresh_until, stale_until = row
+
+        return _Entry(status, json.loads(headers), body, fresh_until, stale_until)
+
+    def _store(self, key: str, upstream: str, entry: _Entry, /):
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, upstream, entry.status, json.dumps(entry.headers), entry.body,
+                 entry.fresh_until, entry.stale_until, len(entry.body), time()),
+            )
+
+            size, = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+            if size > self.max_bytes:
+                # Drop the least recently used responses, down to 3/4 of the budget
+                db.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC) AS kept"
+                    " FROM responses) WHERE kept > ?)",
+                    (self.max_bytes * 3 // 4,),
+                )
+
+    async def load(self, key: str, /):
+        # A broken cache must not break the requests
+        try:
+            return await to_thread.run_sync(self._load, key)
+        except sqlite3.Error:
+            logging.warning("HTTP cache lookup failed", exc_info=True)
+            return None
+
+    async def store(self, key: str, upstream: str, entry: _Entry, /):
+        try:
+            await to_thread.run_sync(self._store, key, upstream, entry)
+        except sqlite3.Error:
+            logging.warning("HTTP cache store failed", exc_info=True)
+
+    def revalidate_later(self, key: str, revalidate, /) -> bool:
+        """
+        Revalidate in the background, once per key at a time.
+
+        :return: False when the cache is not entered and there is no background to revalidate in
+        """
+        if self._tasks is None:
+            return False
+
+        if key in self._revalidating:
+            return True
+
+        async def run():
+            try:
+                await revalidate()
+            except Exception:
+                logging.debug("Revalidation failed", exc_info=True)
+            finally:
+                self._revalidating.discard(key)
+
+        self._revalidating.add(key)
+        self._tasks.start_soon(run)
+
+        return True
+
+    def clear(self, /):
+        with self._lock:
+            self._connect().execute("DELETE FROM responses")
+
+    async def __aenter__(self, /):
+        self._tasks = await create_task_group().__aenter__()
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        tasks, self._tasks = self._tasks, None
+        tasks.cancel_scope.cancel()
+        await tasks.__aexit__(exc_type, exc_value, traceback)
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def statistics(self, /) -> dict:
+        """
+        :return: per upstream, the responses served fresh, stale and revalidated, the misses,
+            the share of requests that did not download the body and the body bytes not downloaded
+        """
+        upstreams = {}
+
+        for name, counters in sorted(self._counters.items()):
+            served = counters.hits + counters.stale + counters.revalidated
+            requests = served + counters.misses
+
+            upstreams[name] = {
+                "hits": counters.hits,
+                "stale": counters.stale,
+                "revalidated": counters.revalidated,
+                "misses": counters.misses,
+                "hit_ratio": f"{served / requests:.0%}" if requests else "n/a",
+                "bytes_saved": counters.bytes_saved,
+            }
+
+        return upstreams
+
+
+class CachingTransport(AsyncBaseTransport):
+    """
+    An httpx transport answering the requests that opt in from the `ResponseCache`.
+    """
+    def __init__(self, transport: AsyncBaseTransport, cache: ResponseCache, upstream: str):
+        self.transport = transport
+        self.cache = cache
+        self.upstream = upstream
+
+    def _policy(self, request: Request, /):
+        policy = request.extensions.get("cache")
+
+        if not policy or request.method != "GET":
+            return None
+
+        if "no-cache" in _directives(request.headers.get("cache-control", "")):
+            return None
+
+        return policy if isinstance(policy, Policy) else self.cache.policy(self.upstream)
+
+    async def _fetch(self, request: Request, key: str, policy: Policy, entry: _Entry = None, /) -> Response:
+        """
+        Send the request, conditional when there is an entry to revalidate, and store the response.
+        """
+        headers = request.headers.copy()
+
+        if entry is not None:
+            stored = {name.lower(): value for name, value in entry.headers}
+
+            if "etag" in stored:
+                headers["If-None-Match"] = stored["etag"]
+
+            if "last-modified" in stored:
+                headers["If-Modified-Since"] = stored["last-modified"]
+
+        response = await self.transport.handle_async_request(
+            Request(request.method, request.url, headers=headers, extensions=request.extensions)
+        )
+
+        # The raw stream, as a transport is not expected to have read the response
+        try:
+            body = b"".join([chunk async for chunk in response.stream])
+        finally:
+            await response.aclose()
+
+        now = time()
+
+        if entry is not None and response.status_code == 304:
+            if (times := lifetimes(policy, response.headers, now)) is not None:
+                entry = evolve(entry, fresh_until=times[0], stale_until=times[1])
+                await self.cache.store(key, self.upstream, entry)
+
+            return self._response(entry, "revalidated")
+
+        headers = [(name, value) for name, value in response.headers.multi_items() if name not in _HOP_BY_HOP]
+
+        if response.status_code == 200 and (times := lifetimes(policy, response.headers, now)) is not None:
+            await self.cache.store(key, self.upstream, _Entry(200, headers, body, *times))
+
+        return Response(
+            response.status_code, headers=headers, stream=ByteStream(body), extensions=response.extensions
+        )
+
+    @staticmethod
+    def _response(entry: _Entry, state: str, /) -> Response:
+        return Response(
+            entry.status, headers=entry.headers, stream=ByteStream(entry.body), extensions={"cache": state}
+        )
+
+    async def handle_async_request(self, request):
+        if (policy := self._policy(request)) is None:
+            return await self.transport.handle_async_request(request)
+
+        key = self.cache.key(self.upstream, request)
+        entry = await self.cache.load(key)
+        counters = self.cache.counters(self.upstream)
+        now = time()
+
+        if entry is not None and now < entry.fresh_until:
+            counters.hits += 1
+            counters.bytes_saved += len(entry.body)
+            return self._response(entry, "hit")
+
+        if entry is not None and now < entry.stale_until:
+            if self.cache.revalidate_later(key, lambda: self._fetch(request, key, policy, entry)):
+                counters.stale += 1
+                counters.bytes_saved += len(entry.body)
+                return self._response(entry, "stale")
+
+        try:
+            response = await self._fetch(request, key, policy, entry)
+        except Exception:
+            if entry is None or now >= entry.stale_until:
+                raise
+
+            # The upstream is down, the stale response is better than none
+            counters.stale += 1
+            counters.bytes_saved += len(entry.body)
+
+            return self._response(entry, "stale")
+
+        if response.extensions.get("cache") == "revalidated":
+            counters.revalidated += 1
+            counters.bytes_saved += len(entry.body)
+        else:
+            counters.misses += 1
+
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Latency histograms and error counts per command and per dependency.
+
+Commands are timed around `CommandHandler` in `ChatBot.on_message`;
+dependencies (HTTP upstreams, Telegram API methods, the browser, TTS) are timed
+at the call sites with `metrics.timer("dependency", name)`. The histograms use
+fixed buckets, so recording is O(1) and memory does not grow with traffic, and
+they can be served in the Prometheus text format by `MetricsServer`.
+"""
+
+import logging
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from time import perf_counter
+
+from anyio import create_task_group, create_tcp_listener
+from attrs import field, mutable
+from httpx import AsyncBaseTransport
+
+
+__all__ = (
+    "BUCKETS",
+    "Histogram",
+    "Registry",
+    "metrics",
+    "InstrumentedTransport",
+    "MetricsServer",
+)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, inf)
+
+
+@mutable(eq=False)
+class Histogram:
+    counts = field(factory=lambda: [0] * len(BUCKETS))
+    total = field(default=0.0)
+    count = field(default=0)
+    errors = field(default=0)
+
+    def observe(self, seconds: float, /, error: bool = False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float, /) -> float:
+        """
+        Estimate a quantile by linear interpolation inside its bucket.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index]
+
+                if upper == inf:
+                    return lower
+
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return BUCKETS[-2]
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@mutable(eq=False)
+class Registry:
+    """
+    Histograms keyed by kind ("command" or "dependency") and name.
+    """
+    histograms = field(factory=dict)
+
+    def histogram(self, kind: str, name: str, /) -> Histogram:
+        key = (kind, name)
+
+        if (histogram := self.histograms.get(key)) is None:
+            self.histograms[key] = histogram = Histogram()
+
+        return histogram
+
+    @contextmanager
+    def timer(self, kind: str, name: str, /):
+        histogram = self.histogram(kind, name)
+        start = perf_counter()
+        error = True
+
+        try:
+            yield histogram
+            error = False
+        finally:
+            histogram.observe(perf_counter() - start, error)
+
+    def summary(self, kind: str, /) -> dict:
+        def ms(seconds):
+            return f"{seconds * 1000:.1f}ms"
+
+        return {
+            name: (
+                f"n={histogram.count} err={histogram.errors} "
+                f"p50={ms(histogram.quantile(0.5))} p95={ms(histogram.quantile(0.95))} "
+                f"p99={ms(histogram.quantile(0.99))}"
+            )
+            for (histogram_kind, name), histogram in sorted(self.histograms.items())
+            if histogram_kind == kind
+        }
+
+    def prometheus(self, /) -> str:
+        lines = []
+
+        for kind in ("command", "dependency"):
+            metric = f"pyrobot_{kind}_duration_seconds"
+            lines.append(f"# HELP {metric} Latency of {kind} calls.")
+            lines.append(f"# TYPE {metric} histogram")
+
+            errors = []
+
+            for (histogram_kind, name), histogram in sorted(self.histograms.items()):
+                if histogram_kind != kind:
+                    continue
+
+                label = f'{kind}="{_label(name)}"'
+                cumulative = 0
+
+                for bucket, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bucket == inf else repr(bucket)
+                    lines.append(f'{metric}_bucket{{{label},le="{le}"}} {cumulative}')
+
+                lines.append(f"{metric}_sum{{{label}}} {histogram.total}")
+                lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+                errors.append(f"pyrobot_{kind}_errors_total{{{label}}} {histogram.errors}")
+
+            lines.append(f"# HELP pyrobot_{kind}_errors_total Failed {kind} calls.")
+            lines.append(f"# TYPE pyrobot_{kind}_errors_total counter")
+            lines.extend(errors)
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+class InstrumentedTransport(AsyncBaseTransport):
+    """
+    An httpx transport that times every request as the dependency `http:<name>`, `http:<host>` without a name.
+    """
+    def __init__(self, transport: AsyncBaseTransport, registry: Registry = metrics, name: str = None):
+        self.transport = transport
+        self.registry = registry
+        self.name = name
+
+    async def handle_async_request(self, request):
+        with self.registry.timer("dependency", f"http:{self.name or request.url.host}"):
+            return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+@mutable(eq=False)
+class MetricsServer:
+    """
+    A minimal HTTP server for Prometheus scrapes, answering every request with the metrics.
+    """
+    port = field()
+    host = field(default="127.0.0.1")
+    registry = field(default=metrics)
+
+    _tasks = field(init=False, default=None)
+
+    async def _handle(self, stream, /):
+        async with stream:
+            try:
+                request = b""
+
+                while b"\r\n\r\n" not in request and len(request) < 8192:
+                    request += await stream.receive()
+
+                body = self.registry.prometheus().encode()
+                await stream.send(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+            except Exception:
+                logging.debug("Metrics request failed", exc_info=True)
+
+    async def __aenter__(self, /):
+        listener = await create_tcp_listener(local_host=self.host, local_port=self.port)
+
+        self._tasks = await create_task_group().__aenter__()
+        self._tasks.start_soon(listener.serve, self._handle)
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        self._tasks.cancel_scope.cancel()
+        await self._tasks.__aexit__(exc_type, exc_value, traceback)
@@ -2,17 +2,42 @@
 # Copyright 2022 Andrew Ivanov <okolefleef@disr.it>
 # All rights reserved
 
+import re
+
+from html import unescape
+from io import BytesIO
+from itertools import chain
 from pathlib import Path
-from typing import Union
+from typing import List, Optional, Union
+
+import numpy as np
 
 from pyrogram import Client, types
 from pyrogram.types.messages_and_media.message import Message
 from markdown import markdown
-from PIL import Image, ImageChops
-from playwright.async_api._context_manager import PlaywrightContextManager as PWContextManager
+from PIL import Image
 
 from config import Settings
+from modules.browser import BrowserPool
+from modules.instrumentation import metrics
 from modules.pretty_json import pretty_dumps
+from modules.rasterizer import render_image
+
+
+OVERFLOW_MODES = ("image", "pages", "document")
+
+# The limit of Telegram on the length of a message
+MESSAGE_LIMIT = 4096
+
+# Tags, entities and code fences, which a page break must not cut
+_MARKUP = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^<>]*>|&#?\w+;|```")
+
+# The tags of the HTML style of Telegram which wrap text
+_ENTITY_TAGS = frozenset((
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "span", "tg-spoiler", "a", "code", "pre", "blockquote",
+))
+
+_TAG = re.compile(r"</?[a-zA-Z][^<>]*>")
 
 
 def gen_html(html_path: Path, text: str) -> bool:
@@ -25,34 +50,215 @@ def gen_html(html_path: Path, text: str) -> bool:
     return html_path.is_file() or False
 
 
-async def gen_pictures(browser_session: PWContextManager, image_path: Path, html_path: Path) -> bool:
-    async with browser_session as p:
-        browser = await p.chromium.launch(proxy=dict(server="socks5://127.0.0.1:8443"))
-        page = await browser.new_page()
+async def gen_pictures(browser_session: Optional[BrowserPool], html_path: Path) -> bytes:
+    """
+    :param browser_session: the shared browser, None starts one for this call only
+    :return: a full-page PNG screenshot of the HTML file, lossless so that the only lossy encode is the final one
+    """
+    if browser_session is None:
+        async with BrowserPool(max_pages=1) as browser_session:
+            return await gen_pictures(browser_session, html_path)
 
+    # A local file needs no proxy
+    async with browser_session.page() as page:
         await page.goto(f"file://{html_path}")
-        await page.screenshot(path=image_path, type="jpeg", caret="initial", quality=100, full_page=True)
+        return await page.screenshot(type="png", caret="initial", full_page=True)
+
+
+def content_box(pixels: np.ndarray, background, step: int = 1) -> Optional[tuple]:
+    """
+    Find the bounding box of the pixels that differ from the background.
+
+    :param pixels: an array of height x width (x channels)
+    :param step: with more than 1, locate the content on every step-th row and column first and
+        search the full resolution only around it. Content thinner than the step and further than
+        a step away from the rest is missed
+    :return: the box as (left, top, right, bottom), None if every pixel is the background
+    """
+    if step > 1:
+        coarse = content_box(pixels[::step, ::step], background)
+
+        if coarse is None:
+            return content_box(pixels, background)
+
+        left, top, right, bottom = coarse
+        left, top = max(left - 1, 0) * step, max(top - 1, 0) * step
+        right, bottom = (right + 1) * step, (bottom + 1) * step
+
+        if (box := content_box(pixels[top:bottom, left:right], background)) is None:
+            return None
+
+        return box[0] + left, box[1] + top, box[2] + left, box[3] + top
+
+    if pixels.ndim == 2:
+        differs = pixels != background
+    else:
+        # Channel by channel, a reduction over the short last axis is several times slower
+        differs = pixels[..., 0] != background[0]
+
+        for channel in range(1, pixels.shape[2]):
+            differs |= pixels[..., channel] != background[channel]
+
+    rows = np.flatnonzero(differs.any(axis=1))
+
+    if not rows.size:
+        return None
+
+    columns = np.flatnonzero(differs.any(axis=0))
+
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def crop_image(image: bytes, step: int = 1, quality: int = 90) -> BytesIO:
+    """
+    Crop the background around the content of the image, judged by its top left pixel, and encode it as JPEG once.
+
+    :param step: see `content_box`
+    """
+    im = Image.open(BytesIO(image))
+
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    pixels = np.asarray(im)
+
+    if (box := content_box(pixels, pixels[0, 0], step)) is not None:
+        im = im.crop(box)
+
+    output = BytesIO()
+    output.name = "screenshot.jpg"
+    im.save(output, format="JPEG", quality=quality)
+    output.seek(0)
+
+    return output
+
 
-    return image_path.is_file() or False
+def paginate(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Split text into pages of at most `limit` characters.
 
+    Pages end at a line break where possible, then at a space. Tags,
+    entities and code fences are never cut. Tags and fences still open at a
+    page break are closed at the end of the page and reopened on the next one.
+    """
+    if len(text) <= limit:
+        return [text]
 
-def crop_image(image_path: Path) -> bool:
-    im = Image.open(image_path)
-    bg = Image.new(im.mode, im.size, im.getpixel((0, 0)))
+    pages = []
+    stack = []  # open tags: (name, opening markup)
+    fence = False
+    head, parts, size = "", [], 0
+    filled = False  # whether the page has text, not only markup
 
-    diff_ = ImageChops.difference(im, bg)
-    diff = ImageChops.add(diff_, diff_)
+    def closing() -> str:
+        return ("```" if fence else "") + "".join(f"</{name}>" for name, _ in reversed(stack))
 
-    if box := diff.getbbox():
-        im.crop(box).save(image_path)
+    def flush():
+        nonlocal head, parts, size, filled
 
-        return True
-    return False
+        if filled:
+            pages.append(head + "".join(parts) + closing())
+
+        head = "".join(markup for _, markup in stack) + ("```" if fence else "")
+        parts, size, filled = [], len(head), False
+
+    position = 0
+
+    for token in chain(_MARKUP.finditer(text), (None,)):
+        run = text[position:len(text) if token is None else token.start()]
+
+        while run:
+            room = limit - size - len(closing())
+
+            if room <= 0 and filled:
+                flush()
+                continue
+
+            if len(run) <= room:
+                parts.append(run)
+                size += len(run)
+                filled = True
+                break
+
+            cut = run.rfind("\n", 0, room) + 1 or run.rfind(" ", 0, room) + 1
+
+            if not cut:
+                if filled:
+                    # Break before the run rather than inside a word
+                    flush()
+                    continue
+
+                cut = max(room, 1)
+
+            parts.append(run[:cut])
+            run = run[cut:]
+            filled = True
+            flush()
+
+        if token is None:
+            break
+
+        markup, closes, name = token[0], token[1], (token[2] or "").lower()
+        opens_entity = name in _ENTITY_TAGS and not closes
+
+        if markup == "```":
+            grows = 0 if fence else 3
+        else:
+            grows = len(name) + 3 if opens_entity else 0
+
+        if filled and size + len(markup) + len(closing()) + grows > limit:
+            flush()
+
+        parts.append(markup)
+        size += len(markup)
+        position = token.end()
+
+        if markup.startswith("&"):
+            filled = True
+
+        if markup == "```":
+            fence = not fence
+        elif opens_entity:
+            stack.append((name, markup))
+        elif name in _ENTITY_TAGS:
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index][0] == name:
+                    del stack[index]
+                    break
+
+    flush()
+
+    return pages
+
+
+async def send_pages(message: Message, pages: List[str], reply: bool = False) -> Message:
+    """
+    Send the first page as an edit of the message (or as a reply) and the others as replies, in order.
+    """
+    if reply:
+        sent = await message.reply(pages[0], disable_web_page_preview=True)
+    else:
+        sent = await message.edit(pages[0], disable_web_page_preview=True)
+
+    for page in pages[1:]:
+        sent = await message.reply(page, disable_web_page_preview=True)
+
+    return sent
 
 
 async def limit_symbols_message(
-            settings: Settings(), browser_session: PWContextManager,
-            message: Message, client: Client, reply: bool = False, tti: bool = True) -> Union[Message, None]:
+            settings: Settings, browser_session: Optional[BrowserPool],
+            message: Message, client: Client, reply: bool = False, tti: bool = True,
+            overflow: str = "image") -> Union[Message, None]:
+    """
+    Send the text of the message as an edit or a reply, handling text that does not fit into one message.
+
+    :param tti: whether long text may be handled with the overflow strategy, otherwise it is sent as is
+    :param overflow: what to do with long text: "image" renders it to a picture,
+        "pages" splits it into several messages and "document" sends it as a text file
+    """
+    if overflow not in OVERFLOW_MODES:
+        raise ValueError(f"Unknown overflow mode: {overflow!r}, expected one of {', '.join(OVERFLOW_MODES)}")
 
     text = message.text
     if not text:
@@ -66,18 +272,36 @@ async def limit_symbols_message(
     if not tti:
         return await message.edit(text, disable_web_page_preview=True)
 
-    if len(text.replace(" ", "")) <= 700:
+    if overflow == "pages":
+        return await send_pages(message, paginate(text), reply)
+
+    if len(text) - text.count(" ") <= 700:
         if reply:
             return await message.reply(text, disable_web_page_preview=True)
         return await message.edit(text, disable_web_page_preview=True)
 
-    image_path = settings.IMAGE_LIMITER_PATH
-    html_path = settings.HTML_LIMITER_PATH
+    if overflow == "document":
+        # The file is read as plain text, so the markup is dropped
+        document = BytesIO(unescape(_TAG.sub("", text)).encode())
+        document.name = "output.txt"
+    else:
+        document = None
+
+        if settings.IMAGE_RENDERER != "browser":
+            with metrics.timer("dependency", "rasterizer"):
+                image = await render_image(text, settings)
+
+            if image is not None:
+                document = BytesIO(image)
+                document.name = "output.png"
+
+        if document is None:
+            # Also the fallback when the fonts of the rasterizer are missing
+            html_path = settings.HTML_LIMITER_PATH
 
-    gen_html(html_path=html_path, text=text)
-    await gen_pictures(browser_session=browser_session, image_path=image_path, html_path=html_path)
-    crop_image(image_path=image_path)
+            gen_html(html_path=html_path, text=text)
+            document = crop_image(await gen_pictures(browser_session=browser_session, html_path=html_path))
 
     await message.edit("<code>The length of the text exceeds the allowed limit \U0001F447</code>")
-    return await client.send_document(chat_id=message.chat.id, document=image_path)
+    return await client.send_document(chat_id=message.chat.id, document=document)
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Event loop lag monitor for the `.lag` command.
+
+A task on the loop sleeps for a fixed interval and measures how late it wakes
+up, which is the time the loop spent on something that did not yield. A
+watchdog thread checks the heartbeat of that task; once the loop is stalled
+past the threshold it captures the stack of the main thread, so the stall can
+be attributed to the blocking call while it is still running.
+"""
+
+import heapq
+import sys
+import threading
+
+from collections import Counter, deque
+from contextlib import contextmanager
+from itertools import count
+from time import perf_counter, time
+from traceback import format_stack
+
+from anyio import create_task_group, sleep
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "Stall",
+    "LoopMonitor",
+)
+
+
+@frozen
+class Stall:
+    lag = field()
+    at = field()
+    stack = field()
+    commands = field()
+
+
+@mutable(eq=False)
+class LoopMonitor:
+    """
+    Continuous measurement of event loop lag with stack capture of the worst stalls.
+
+    :param interval: seconds between heartbeats of the loop
+    :param threshold: lag in seconds from which a late heartbeat counts as a stall
+    :param keep: number of worst stalls kept
+    :param depth: number of innermost frames kept from a captured stack
+    """
+    interval = field(default=0.1)
+    threshold = field(default=0.25)
+    keep = field(default=10)
+    depth = field(default=12)
+
+    lags = field(init=False, factory=lambda: deque(maxlen=3000))
+    stalls = field(init=False, default=0)
+
+    _worst = field(init=False, factory=list)
+    _counter = field(init=False, factory=count)
+    _running = field(init=False, factory=Counter)
+    _heartbeat = field(init=False, factory=perf_counter)
+    _captured = field(init=False, default=None)
+    _main_thread = field(init=False, default=None)
+    _stop = field(init=False, factory=threading.Event)
+    _thread = field(init=False, default=None)
+    _tasks = field(init=False, default=None)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(interval=settings.LAG_INTERVAL, threshold=settings.LAG_THRESHOLD, keep=settings.LAG_KEEP)
+
+    @contextmanager
+    def running(self, command: str, /):
+        """
+        Mark the command as running, so that stalls can be attributed to it.
+        """
+        self._running[command] += 1
+
+        try:
+            yield
+        finally:
+            self._running[command] -= 1
+
+            if not self._running[command]:
+                del self._running[command]
+
+    def _watch(self, /):
+        while not self._stop.wait(self.interval / 2):
+            if self._captured is not None:
+                continue
+
+            if perf_counter() - self._heartbeat <= self.interval + self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self._main_thread)
+
+            if frame is not None:
+                stack = "".join(format_stack(frame, limit=self.depth))
+                self._captured = (stack, tuple(self._running))
+
+    async def _tick(self, /):
+        while True:
+            start = perf_counter()
+            self._heartbeat = start
+
+            await sleep(self.interval)
+
+            now = perf_counter()
+            self._heartbeat = now
+            lag = max(0.0, now - start - self.interval)
+            self.lags.append(lag)
+
+            if lag <= self.threshold:
+                continue
+
+            stack, commands = self._captured or ("The loop recovered before the stack was captured\n", ())
+            self._captured = None
+            self.stalls += 1
+
+            entry = (lag, next(self._counter), Stall(lag, time(), stack, commands or tuple(self._running)))
+
+            if len(self._worst) < self.keep:
+                heapq.heappush(self._worst, entry)
+            else:
+                heapq.heappushpop(self._worst, entry)
+
+    def worst(self, /) -> list:
+        """
+        :return: the kept stalls, worst first
+        """
+        return [entry[2] for entry in sorted(self._worst, reverse=True)]
+
+    def statistics(self, /) -> dict:
+        lags = sorted(self.lags)
+
+        def ms(seconds):
+            return f"{seconds * 1000:.1f}ms"
+
+        if lags:
+            p50, p99, worst = lags[len(lags) // 2], lags[min(len(lags) - 1, int(len(lags) * 0.99))], lags[-1]
+        else:
+            p50 = p99 = worst = 0.0
+
+        return {
+            "samples": len(lags),
+            "p50": ms(p50),
+            "p99": ms(p99),
+            "max": ms(worst),
+            "stalls": f"{self.stalls} over {ms(self.threshold)}",
+        }
+
+    async def __aenter__(self, /):
+        self._main_thread = threading.get_ident()
+        self._heartbeat = perf_counter()
+        self._stop.clear()
+
+        self._thread = threading.Thread(target=self._watch, name="pyrobot-loop-watchdog", daemon=True)
+        self._thread.start()
+
+        self._tasks = await create_task_group().__aenter__()
+        self._tasks.start_soon(self._tick)
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        self._tasks.cancel_scope.cancel()
+        await self._tasks.__aexit__(exc_type, exc_value, traceback)
+
+        self._stop.set()
+        self._thread.join()
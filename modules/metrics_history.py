@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+History of host metrics in fixed-size NumPy ring buffers and its trend views for `.ps trend`.
+
+Every series keeps 24 hours of samples, so memory use is fixed once the
+first sample is taken, and window statistics are vectorized reductions over
+a slice of the buffer. NumPy is imported lazily: the buffers are allocated by
+the first sample, in the thread of the sampler, not at startup.
+"""
+
+from time import monotonic
+
+import psutil
+
+from attrs import field, mutable
+
+from modules import startup
+from modules.host_info import get_size
+
+np = startup.lazy_import("numpy")
+
+
+__all__ = (
+    "WINDOWS",
+    "RingBuffer",
+    "History",
+    "sparkline",
+)
+
+WINDOWS = (("5m", 5 * 60), ("1h", 60 * 60), ("24h", 24 * 60 * 60))
+
+_BLOCKS = " ▁▂▃▄▅▆▇█"
+
+
+@mutable(eq=False)
+class RingBuffer:
+    """
+    A fixed-size ring of rows of `width` float32 values.
+    """
+    capacity = field()
+    width = field(default=1)
+    count = field(init=False, default=0)
+
+    _data = field(init=False, default=None)
+    _index = field(init=False, default=0)
+
+    def append(self, values, /):
+        if self._data is None:
+            self._data = np.zeros((self.capacity, self.width), dtype=np.float32)
+
+        self._data[self._index] = values
+        self._index = (self._index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, size: int, /) -> "np.ndarray":
+        """
+        :return: up to `size` latest rows in chronological order
+        """
+        if self._data is None:
+            return np.zeros((0, self.width), dtype=np.float32)
+
+        size = min(size, self.count)
+        start = self._index - size
+
+        if start >= 0:
+            return self._data[start:self._index]
+
+        return np.concatenate((self._data[start:], self._data[:self._index]))
+
+
+def sparkline(values: "np.ndarray", width: int = 24) -> str:
+    """
+    Render a series as a line of block characters, averaging it down to `width` buckets.
+    """
+    if not len(values):
+        return ""
+
+    if len(values) > width:
+        edges = np.linspace(0, len(values), width + 1).astype(np.intp)[:-1]
+        values = np.add.reduceat(values, edges) / np.diff(np.append(edges, len(values)))
+
+    low, high = values.min(), values.max()
+    span = high - low
+
+    if span <= 0:
+        levels = np.full(len(values), 4 if high else 0, dtype=np.intp)
+    else:
+        levels = np.rint((values - low) / span * (len(_BLOCKS) - 2)).astype(np.intp) + 1
+
+    return "".join(_BLOCKS[level] for level in levels.tolist())
+
+
+def _summary(values: "np.ndarray", fmt) -> str:
+    low, average, p95 = values.min(), values.mean(), np.percentile(values, 95)
+    return f"min {fmt(low)} / avg {fmt(average)} / p95 {fmt(p95)}"
+
+
+def _percent(value) -> str:
+    return f"{value:.1f}%"
+
+
+def _bytes(value) -> str:
+    return get_size(float(value))
+
+
+def _rate(value) -> str:
+    return get_size(float(value), "B/s")
+
+
+@mutable(eq=False)
+class History:
+    """
+    Ring buffers of per-core CPU, bot RSS, memory, swap and disk I/O rates.
+
+    :param interval: seconds between samples, which sets the capacity of the buffers for 24 hours
+    """
+    interval = field(default=5.0)
+
+    cpu = field(init=False)
+    rss = field(init=False)
+    mem = field(init=False)
+    swap = field(init=False)
+    io = field(init=False)
+
+    _process = field(init=False, factory=psutil.Process)
+    _last_io = field(init=False, default=None)
+
+    @cpu.default
+    def _(self, /):
+        return RingBuffer(self.capacity, psutil.cpu_count() or 1)
+
+    @rss.default
+    def _(self, /):
+        return RingBuffer(self.capacity)
+
+    @mem.default
+    def _(self, /):
+        return RingBuffer(self.capacity)
+
+    @swap.default
+    def _(self, /):
+        return RingBuffer(self.capacity)
+
+    @io.default
+    def _(self, /):
+        return RingBuffer(self.capacity, 2)
+
+    @property
+    def capacity(self, /) -> int:
+        return int(WINDOWS[-1][1] // self.interval) + 1
+
+    def record(self, /):
+        self.cpu.append(psutil.cpu_percent(percpu=True))
+        self.rss.append(self._process.memory_info().rss)
+        self.mem.append(psutil.virtual_memory().percent)
+        self.swap.append(psutil.swap_memory().percent)
+
+        now = monotonic()
+        counters = psutil.disk_io_counters()
+
+        if counters is not None:
+            if self._last_io is not None:
+                then, previous = self._last_io
+                elapsed = max(now - then, 1e-6)
+                self.io.append((
+                    (counters.read_bytes - previous.read_bytes) / elapsed,
+                    (counters.write_bytes - previous.write_bytes) / elapsed,
+                ))
+
+            self._last_io = (now, counters)
+
+    def _windows(self, buffer: RingBuffer, /):
+        for name, seconds in WINDOWS:
+            rows = buffer.last(int(seconds // self.interval))
+
+            if len(rows):
+                yield name, rows
+
+            if len(rows) < int(seconds // self.interval):
+                break  # longer windows would show the same samples
+
+    def _series(self, title: str, buffer: RingBuffer, fmt, column=None, /) -> dict:
+        trend = {}
+
+        for name, rows in self._windows(buffer):
+            values = rows.mean(axis=1) if column is None else rows[:, column]
+            trend[f"{name} <code>{sparkline(values)}</code>"] = _summary(values, fmt)
+
+        return {f"<strong>{title}</strong>": trend or "no samples yet"}
+
+    def trend(self, view: str, /) -> dict:
+        """
+        :param view: one of "cpu", "mem", "io"
+        :return: a dict for `pretty_dumps`
+        """
+        if view == "cpu":
+            cores = self.cpu.last(int(WINDOWS[0][1] // self.interval))
+            per_core = {}
+
+            if len(cores):
+                averages, p95 = cores.mean(axis=0), np.percentile(cores, 95, axis=0)
+                per_core = {
+                    f"core {index}": f"avg {average:.1f}% / p95 {high:.1f}%"
+                    for index, (average, high) in enumerate(zip(averages, p95))
+                }
+
+            return {
+                **self._series("cpu (all cores)", self.cpu, _percent),
+                "<strong>cores (5m)</strong>": per_core or "no samples yet",
+            }
+
+        if view == "mem":
+            return {
+                **self._series("memory", self.mem, _percent),
+                **self._series("swap", self.swap, _percent),
+                **self._series("rss (bot)", self.rss, _bytes),
+            }
+
+        if view == "io":
+            return {
+                **self._series("disk read", self.io, _rate, 0),
+                **self._series("disk write", self.io, _rate, 1),
+            }
+
+        raise ValueError(f"Unknown trend view: {view!r}, expected cpu, mem or io")
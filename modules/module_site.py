@@ -37,12 +37,16 @@ from typing import Union
 from hashids import Hashids
 
 from config import get_env, Settings
+from modules.plugins import Command
 from modules.pretty_json import pretty_dumps
 
 
 __all__ = (
     "generate_short_link_for_url",
     "retrieve_usage_statistics_for_short_link",
+    "shorten_url",
+    "retrieve_url_statistics",
+    "COMMANDS",
 )
 
 MIN_SHORT_LINK_LEN = 4
@@ -184,6 +188,42 @@ def retrieve_usage_statistics_for_short_link(url: str) -> str:
     })
 
 
+async def shorten_url(handler) -> None:
+    """
+    Handle `.short <url>`: shorten the URL of the message or of the replied message.
+    """
+    reply_message = handler.message.reply_to_message
+    url = reply_message.text if reply_message else handler.message.text
+
+    try:
+        handler.message.text = generate_short_link_for_url(url.strip())
+    except BaseException as error:
+        handler.message.text = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
+
+    await handler.limit_message()
+
+
+async def retrieve_url_statistics(handler) -> None:
+    """
+    Handle `.stat <short url>`: the statistics of the short URL of the message or of the replied message.
+    """
+    reply_message = handler.message.reply_to_message
+    url = reply_message.text if reply_message else handler.message.text
+
+    try:
+        handler.message.text = retrieve_usage_statistics_for_short_link(url.strip())
+    except BaseException as error:
+        handler.message.text = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
+
+    await handler.limit_message()
+
+
+COMMANDS = (
+    Command("short", shorten_url),
+    Command("stat", retrieve_url_statistics),
+)
+
+
 if __name__ == "__main__":
     raise RuntimeError("This code is an additional module to the «UserBOT for Telegram» project and"
                        " it does not support launching directly.")
\ No newline at end of file
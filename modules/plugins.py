@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Registry of plugins: modules that declare their commands and handlers.
+
+A plugin is a module with a `COMMANDS` tuple of `Command`, whose handlers are
+async functions called with the `CommandHandler` of the message. Commands of
+the built-in plugins and of the modules in the `root` package of the PLUGINS
+setting are routed next to the core commands of `utils.Commands`.
+
+`Registry.reload()` executes the current source of a plugin into a new module
+and only then replaces the routing table, in a single assignment. A command
+that has already been routed keeps running the functions of the previous
+module, and the sessions passed to the handlers are not touched.
+"""
+
+import importlib
+import importlib.machinery
+import importlib.util
+import logging
+import pkgutil
+import sys
+
+from datetime import datetime
+
+from attrs import field, frozen, mutable
+
+from modules.routing import SCHEMAS, Router
+from modules.scheduler import Cost
+from utils import ALIASES, Commands
+
+
+__all__ = (
+    "BUILTIN",
+    "PluginError",
+    "Command",
+    "Plugin",
+    "Registry",
+)
+
+BUILTIN = (
+    "modules.module_site",
+    "modules.search",
+    "modules.translate",
+    "modules.weather",
+)
+
+
+class PluginError(RuntimeError):
+    pass
+
+
+@frozen
+class Command:
+    """
+    :param name: the command after the prefix, e.g. "wt" for ".wt"
+    :param handler: an async function called with the `CommandHandler` of the message
+    :param aliases: alternative names of the command
+    :param schema: the `routing.Schema` of the arguments, parsed into `handler.args`
+    :param cost: the `scheduler.Cost` class of the command
+    """
+    name = field()
+    handler = field()
+    aliases = field(default=(), converter=tuple)
+    schema = field(default=None)
+    cost = field(default=Cost.normal)
+
+
+@frozen
+class Plugin:
+    name = field()
+    module = field(eq=False, repr=False)
+    commands = field(converter=tuple)
+    loaded = field(factory=datetime.now)
+
+
+def _load(name: str, /, fresh: bool = False) -> Plugin:
+    """
+    Import the plugin, or execute its source into a new module when `fresh`.
+    On failure the previously imported module, if any, stays in `sys.modules`.
+    """
+    previous = sys.modules.get(name)
+
+    try:
+        if not fresh:
+            module = importlib.import_module(name)
+        else:
+            parent = name.rpartition(".")[0]
+            path = importlib.import_module(parent).__path__ if parent else None
+
+            # The finders, not `sys.modules`, so that the file is read again
+            importlib.invalidate_caches()
+
+            if (spec := importlib.machinery.PathFinder.find_spec(name, path)) is None:
+                raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+
+            module = importlib.util.module_from_spec(spec)
+            # Like `import`, the module executes while registered, for annotations and pickling
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+
+        return Plugin(name, module, module.COMMANDS)
+    except Exception as error:
+        if previous is not None:
+            sys.modules[name] = previous
+        else:
+            sys.modules.pop(name, None)
+
+        raise PluginError(f"{name}: {error.__class__.__name__}: {error}") from error
+
+
+def _route(plugins: dict, /) -> Router:
+    """
+    :raises PluginError: a command or an alias of a plugin is already taken
+    """
+    commands = list(Commands)
+    aliases = dict(ALIASES)
+    schemas = dict(SCHEMAS)
+    taken = {command.name for command in commands} | set(aliases)
+
+    for plugin in plugins.values():
+        for command in plugin.commands:
+            names = (command.name, *command.aliases)
+
+            if clashes := taken.intersection(names):
+                raise PluginError(f"{plugin.name}: .{', .'.join(sorted(clashes))} is already taken")
+
+            taken.update(names)
+            commands.append(command)
+            aliases.update(dict.fromkeys(command.aliases, command))
+
+            if command.schema is not None:
+                schemas[command] = command.schema
+
+    return Router.from_commands(commands, aliases, schemas)
+
+
+@mutable(eq=False)
+class Registry:
+    """
+    :param names: the module names of the plugins, in load order
+    :param options: the PLUGINS setting, in the format of pyrogram smart plugins:
+        the modules of the `root` package are plugins, `include` lists the ones to load and `exclude` the ones to skip
+    """
+    names = field(converter=tuple, default=BUILTIN)
+    options = field(factory=dict)
+
+    router = field(init=False, default=None)
+    _plugins = field(init=False, factory=dict)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        options = settings.PLUGINS
+
+        return cls(names=(*BUILTIN, *cls.discover(options)), options=options)
+
+    @staticmethod
+    def discover(options: dict, /) -> list:
+        """
+        :return: the module names of the plugins in the `root` package, none if there is no such package
+        """
+        if not (root := options.get("root")):
+            return []
+
+        try:
+            package = importlib.import_module(root)
+        except ImportError:
+            return []
+
+        if include := options.get("include"):
+            names = [name.split()[0] for name in include]
+        else:
+            names = sorted(info.name for info in pkgutil.iter_modules(getattr(package, "__path__", ())))
+
+        exclude = {name.split()[0] for name in options.get("exclude", ())}
+
+        return [f"{root}.{name}" for name in names if name not in exclude]
+
+    def __attrs_post_init__(self, /):
+        # A broken plugin is left out, rather than keeping the bot from starting
+        for name in self.names:
+            try:
+                plugin = _load(name)
+                plugins = {**self._plugins, name: plugin}
+                self.router = _route(plugins)
+            except PluginError:
+                logging.exception("Plugin %s is not loaded", name)
+                continue
+
+            self._plugins = plugins
+
+        if self.router is None:
+            self.router = _route({})
+
+    def resolve(self, name: str, /) -> str:
+        """
+        Find the module of a plugin by its full or last name, e.g. "weather" for "modules.weather".
+        Modules added to the `root` package since the start are found as well.
+        """
+        names = dict.fromkeys([*self.names, *self.discover(self.options)])
+
+        for candidate in names:
+            if name in (candidate, candidate.rpartition(".")[2]):
+                return candidate
+
+        raise PluginError(f"Unknown plugin {name!r}, see .reload for the list")
+
+    def reload(self, name: str, /) -> Plugin:
+        """
+        Load the current code of the plugin and route its commands instead of the previous ones.
+        Nothing changes when the plugin fails to load or its commands clash with others.
+        """
+        name = self.resolve(name)
+        previous = sys.modules.get(name)
+        plugin = _load(name, fresh=True)
+        plugins = {**self._plugins, name: plugin}
+
+        try:
+            router = _route(plugins)
+        except PluginError:
+            if previous is not None:
+                sys.modules[name] = previous
+            else:
+                del sys.modules[name]
+
+            raise
+
+        parent, _, child = name.rpartition(".")
+
+        if parent:
+            setattr(sys.modules[parent], child, plugin.module)
+
+        # Running handlers hold the functions of the previous module, new messages get the new ones
+        self._plugins, self.router = plugins, router
+
+        if name not in self.names:
+            self.names += (name,)
+
+        return plugin
+
+    def statistics(self, /) -> dict:
+        return {
+            name: {
+                "commands": " ".join(f".{command.name}" for command in plugin.commands),
+                "loaded": plugin.loaded.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for name, plugin in self._plugins.items()
+        }
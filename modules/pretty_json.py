@@ -5,56 +5,118 @@
 
 from collections.abc import Mapping, Sequence, Set
 
+SCALAR, MAPPING, SEQUENCE, SET = range(4)
+
+# The kind of every type seen so far: the ABC checks are slow and only depend on the type
+_kinds = {str: SCALAR}
+
+
+def kind_of(value):
+    try:
+        return _kinds[type(value)]
+    except KeyError:
+        pass
 
-def isunwrappable(value):
     if isinstance(value, str):
-        return False
+        kind = SCALAR
+    elif isinstance(value, Mapping):
+        kind = MAPPING
+    elif isinstance(value, Sequence):
+        kind = SEQUENCE
+    elif isinstance(value, Set):
+        kind = SET
+    else:
+        kind = SCALAR
+
+    _kinds[type(value)] = kind
+
+    return kind
+
+
+def isunwrappable(value):
+    return kind_of(value) != SCALAR
+
+
+def _children(data, kind, sort_keys, sort_sets):
+    if kind == MAPPING:
+        return iter(sorted(data.items()) if sort_keys else data.items())
 
-    return isinstance(value, (Mapping, Sequence, Set))
+    if kind == SET:
+        return iter(sorted(data) if sort_sets else list(data))
+
+    return iter(data)
 
 
 def pretty_lines(data, sort_keys=False, sort_sets=False, indent=0):
-    if isunwrappable(data):
-        if isinstance(data, Mapping):
-            items = data.items()
-
-            if sort_keys:
-                items = sorted(items)
-
-            for key, value in items:
-                if isunwrappable(value):
-                    yield indent, f"{key}:"
-                    yield from pretty_lines(
-                        value, sort_keys, sort_sets, indent + 1
-                    )
-                else:
-                    yield indent, f"{key}: {value}"
-        elif isinstance(data, Sequence):
-            for value in data:
-                if isunwrappable(value):
-                    yield from pretty_lines(
-                        value, sort_keys, sort_sets, indent + 1
-                    )
-                else:
-                    yield indent, f"{value}"
-        elif isinstance(data, Set):
-            values = list(data)
-
-            if sort_sets:
-                values.sort()
-
-            yield from pretty_lines(values, sort_keys, sort_sets, indent)
-        else:
-            raise TypeError
-    else:
+    """
+    Yield the indentation level and the text of every line.
+
+    Nested containers are walked with an explicit stack of iterators,
+    so the depth of the data is not limited by the recursion limit.
+    """
+    kind = kind_of(data)
+
+    if kind == SCALAR:
         yield indent, f"{data}"
+        return
 
+    stack = [(_children(data, kind, sort_keys, sort_sets), kind == MAPPING, indent)]
 
-def pretty_dumps(data, sort_keys=False, sort_sets=False, indent=4):
+    while stack:
+        iterator, mapping, level = stack[-1]
+
+        for item in iterator:
+            if mapping:
+                key, value = item
+                kind = kind_of(value)
+
+                if kind == SCALAR:
+                    yield level, f"{key}: {value}"
+                    continue
+
+                yield level, f"{key}:"
+            else:
+                kind = kind_of(item)
+
+                if kind == SCALAR:
+                    yield level, f"{item}"
+                    continue
+
+                value = item
+
+            stack.append((_children(value, kind, sort_keys, sort_sets), kind == MAPPING, level + 1))
+            break
+        else:
+            stack.pop()
+
+
+def pretty_write(data, write, sort_keys=False, sort_sets=False, indent=4, budget=None):
+    """
+    Write the pretty text of the data into a text sink, such as `io.StringIO.write` or `list.append`.
+
+    :param budget: stop once more than this many characters were written
+    :return: whether the whole text was written
+    """
     if isinstance(indent, int):
         indent = ' ' * indent
 
-    return '\n'.join(
-        f"{indent * level}{string}"
-        for level, string in pretty_lines(data, sort_keys, sort_sets)
-    )
+    separator = ''
+    written = 0
+
+    for level, string in pretty_lines(data, sort_keys, sort_sets):
+        line = f"{separator}{indent * level}{string}"
+        separator = '\n'
+        written += len(line)
+        write(line)
+
+        if budget is not None and written > budget:
+            return False
+
+    return True
+
+
+def pretty_dumps(data, sort_keys=False, sort_sets=False, indent=4):
+    parts = []
+    pretty_write(data, parts.append, sort_keys, sort_sets, indent)
+
+    return ''.join(parts)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Profiling of commands for `.prof`.
+
+`Profiler.run()` runs a command coroutine under cProfile for a pstats summary
+and, from a thread, samples its await chain: the frames of the suspended
+coroutines plus, while the command runs, the synchronous frames on top of
+them. Time spent waiting on I/O is thereby attributed to the awaiting line
+instead of disappearing like it does for a CPU profiler. The samples are
+aggregated in the collapsed-stack format read by flamegraph.pl and speedscope.
+
+With a background interval set, the profiler also samples the main thread at
+a low rate all the time, so a slowdown can be looked at after it happened.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+
+from collections import Counter
+from time import perf_counter
+
+from anyio import Lock
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "await_chain",
+    "Profile",
+    "Profiler",
+)
+
+_OTHER = ("(other)",)
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def await_chain(coro) -> list:
+    """
+    :return: frames of the coroutine and of everything it awaits, outermost first
+    """
+    frames = []
+
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+
+        if frame is None:
+            break
+
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+
+    return frames
+
+
+def _sample_coroutine(coro, thread_id: int):
+    chain = await_chain(coro)
+
+    if not chain:
+        return None
+
+    stack = [_label(frame) for frame in chain]
+
+    if not coro.cr_running:
+        stack.append("(waiting)")
+        return tuple(stack)
+
+    frame = sys._current_frames().get(thread_id)
+    inner = []
+
+    while frame is not None and frame is not chain[-1]:
+        inner.append(_label(frame))
+        frame = frame.f_back
+
+    if frame is not None:
+        stack.extend(reversed(inner))
+
+    return tuple(stack)
+
+
+def _sample_thread(thread_id: int):
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+
+    while frame is not None:
+        stack.append(_label(frame))
+        frame = frame.f_back
+
+    return tuple(reversed(stack))
+
+
+def _collapse(stacks: Counter) -> str:
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+@frozen
+class Profile:
+    stats = field()
+    stacks = field()
+    elapsed = field()
+    error = field(default=None)
+
+    @property
+    def samples(self, /) -> int:
+        return sum(self.stacks.values())
+
+    def collapsed(self, /) -> str:
+        return _collapse(self.stacks)
+
+
+@mutable(eq=False)
+class Profiler:
+    """
+    On-demand profiling of single commands plus optional always-on sampling.
+
+    :param interval: seconds between samples of a profiled command
+    :param background_interval: seconds between samples of the main thread, 0 to disable
+    :param top: number of functions in the pstats summary
+    :param max_stacks: number of distinct background stacks kept, later ones count as "(other)"
+    """
+    interval = field(default=0.005)
+    background_interval = field(default=0.0)
+    top = field(default=20)
+    max_stacks = field(default=10_000)
+
+    _lock = field(init=False, factory=Lock)
+    _background = field(init=False, factory=Counter)
+    _main_thread = field(init=False, default=None)
+    _stop = field(init=False, factory=threading.Event)
+    _thread = field(init=False, default=None)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(
+            interval=settings.PROFILE_INTERVAL,
+            background_interval=settings.PROFILE_BACKGROUND_INTERVAL,
+            top=settings.PROFILE_TOP,
+        )
+
+    async def run(self, coro, /) -> Profile:
+        """
+        Await the coroutine under the profiler. Errors of the coroutine are recorded, not raised.
+
+        cProfile sees everything the loop runs meanwhile, the samples only see the coroutine.
+        """
+        stacks = Counter()
+        done = threading.Event()
+        thread_id = threading.get_ident()
+
+        def sample():
+            while not done.wait(self.interval):
+                if (stack := _sample_coroutine(coro, thread_id)) is not None:
+                    stacks[stack] += 1
+
+        # Only one cProfile may be active per thread
+        async with self._lock:
+            sampler = threading.Thread(target=sample, name="pyrobot-profiler", daemon=True)
+            profiler = cProfile.Profile()
+            error = None
+            start = perf_counter()
+
+            sampler.start()
+            profiler.enable()
+
+            try:
+                await coro
+            except Exception as exception:
+                error = f"{exception.__class__.__name__}: {exception}"
+            finally:
+                profiler.disable()
+                done.set()
+                sampler.join()
+
+            elapsed = perf_counter() - start
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats("cumulative").print_stats(self.top)
+
+        return Profile(stream.getvalue().strip(), stacks, elapsed, error)
+
+    def _watch(self, /):
+        while not self._stop.wait(self.background_interval):
+            stack = _sample_thread(self._main_thread)
+
+            if stack not in self._background and len(self._background) >= self.max_stacks:
+                stack = _OTHER
+
+            self._background[stack] += 1
+
+    def dump(self, /) -> tuple:
+        """
+        :return: the background samples in the collapsed-stack format and their number
+        """
+        stacks = self._background.copy()
+        return _collapse(stacks), sum(stacks.values())
+
+    def reset(self, /):
+        self._background.clear()
+
+    async def __aenter__(self, /):
+        self._main_thread = threading.get_ident()
+
+        if self.background_interval:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="pyrobot-background-profiler", daemon=True)
+            self._thread.start()
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Python code execution for the `.py` command.
+
+`WorkerPool` keeps a few pre-started worker processes that run code with a
+timeout and a memory limit, so CPU-heavy snippets do not block the event loop
+and a crash or a leak cannot take the bot down. A worker that times out or
+dies is killed and replaced. The workers are started with `python -m
+modules.pyexec` rather than through `multiprocessing`, which would import the
+main module of the bot, with its settings and plugins, into every worker.
+
+For code that has to run inside the bot process, `capture()` collects stdout
+per task: `sys.stdout` is replaced once by a writer that dispatches to the
+buffer of the current context instead of being swapped for every call.
+`Namespaces` keeps the globals of such code per chat between calls, and
+`CodeCache` saves recompiling snippets that are run again.
+"""
+
+import ast
+import asyncio
+import hashlib
+import inspect
+import io
+import os
+import subprocess
+import sys
+import types
+
+from collections import OrderedDict
+from contextlib import redirect_stderr, redirect_stdout
+from contextvars import ContextVar
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+from pathlib import Path
+from time import perf_counter
+from traceback import format_exception
+
+from anyio import Semaphore, to_thread
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "ContextStdout",
+    "capture",
+    "release",
+    "CodeCache",
+    "code_cache",
+    "run_async",
+    "Namespaces",
+    "Result",
+    "WorkerPool",
+)
+
+_capture_var = ContextVar("_capture_var", default=None)
+
+
+class ContextStdout(io.TextIOBase):
+    """
+    A stdout replacement that writes into the capture buffer of the current context, if any.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = _capture_var.get()
+
+        if buffer is None:
+            return self.stream.write(text)
+
+        return buffer.write(text)
+
+    def flush(self):
+        if _capture_var.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def capture():
+    """
+    Start capturing stdout of the current context.
+
+    :return: a token for `release()`
+    """
+    if not isinstance(sys.stdout, ContextStdout):
+        sys.stdout = ContextStdout(sys.stdout)
+
+    return _capture_var.set(io.StringIO())
+
+
+def release(token) -> str:
+    """
+    Stop capturing stdout of the current context.
+
+    :return: the captured output
+    """
+    output = _capture_var.get().getvalue()
+    _capture_var.reset(token)
+
+    return output
+
+
+@mutable(eq=False)
+class CodeCache:
+    """
+    LRU cache of compiled code objects keyed by the hash of the source.
+    """
+    size = field(default=128)
+    hits = field(init=False, default=0)
+    misses = field(init=False, default=0)
+
+    _codes = field(init=False, factory=OrderedDict)
+
+    def compile(self, source: str, /, flags: int = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT) -> types.CodeType:
+        key = (hashlib.sha1(source.encode()).digest(), flags)
+
+        if (code := self._codes.get(key)) is not None:
+            self._codes.move_to_end(key)
+            self.hits += 1
+
+            return code
+
+        self.misses += 1
+        self._codes[key] = code = compile(source, "<py>", "exec", flags=flags)
+
+        if len(self._codes) > self.size:
+            self._codes.popitem(last=False)
+
+        return code
+
+
+code_cache = CodeCache()
+
+
+def _execute(source: str, namespace: dict) -> tuple:
+    start = perf_counter()
+    code = code_cache.compile(source)
+    compiled = perf_counter()
+
+    result = eval(code, namespace)
+
+    if inspect.iscoroutine(result):
+        asyncio.run(result)
+
+    return compiled - start, perf_counter() - compiled
+
+
+async def run_async(source: str, namespace: dict) -> tuple:
+    """
+    Run the code in the namespace on the running event loop; top-level await is allowed.
+
+    :return: compile time and run time in seconds
+    """
+    start = perf_counter()
+    code = code_cache.compile(source)
+    compiled = perf_counter()
+
+    result = eval(code, namespace)
+
+    if inspect.iscoroutine(result):
+        await result
+
+    return compiled - start, perf_counter() - compiled
+
+
+# Names bound to objects owned by the bot, not by the namespace
+_SHARED_NAMES = frozenset(("__builtins__", "self", "client", "message"))
+
+_OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def _deep_sizeof(root, limit: int = 100_000) -> int:
+    """
+    Approximate size of an object graph, following containers only and visiting at most `limit` objects.
+    """
+    seen = set()
+    stack = [root]
+    size = 0
+
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, _OPAQUE_TYPES):
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+
+    return size
+
+
+@mutable(eq=False)
+class _Namespace:
+    globals = field(factory=lambda: {"__name__": "__main__"})
+    last_used = field(factory=perf_counter)
+    size = field(default=0)
+
+
+@mutable(eq=False)
+class Namespaces:
+    """
+    Persistent globals of in-process code, one namespace per chat.
+
+    :param idle_timeout: seconds after which an unused namespace is dropped
+    :param memory_cap: approximate total size of all namespaces in bytes;
+        least recently used namespaces are dropped to stay below it
+    """
+    idle_timeout = field(default=600.0)
+    memory_cap = field(default=64 << 20)
+
+    _entries = field(init=False, factory=OrderedDict)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(
+            idle_timeout=settings.PYTHON_NAMESPACE_IDLE_TIMEOUT,
+            memory_cap=settings.PYTHON_NAMESPACE_MEMORY_CAP,
+        )
+
+    def _evict_idle(self, /):
+        deadline = perf_counter() - self.idle_timeout
+
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+
+            if entry.last_used > deadline:
+                break
+
+            del self._entries[key]
+
+    def get(self, chat_id: int, /) -> dict:
+        self._evict_idle()
+
+        if (entry := self._entries.get(chat_id)) is None:
+            self._entries[chat_id] = entry = _Namespace()
+        else:
+            self._entries.move_to_end(chat_id)
+
+        entry.last_used = perf_counter()
+
+        return entry.globals
+
+    def drop(self, chat_id: int, /) -> bool:
+        return self._entries.pop(chat_id, None) is not None
+
+    def account(self, chat_id: int, /) -> int:
+        """
+        Measure the namespace of the chat after a run and enforce the memory cap.
+
+        :return: the approximate size of the namespace, or 0 if it was dropped for being too large alone
+        """
+        if (entry := self._entries.get(chat_id)) is None:
+            return 0
+
+        entry.size = _deep_sizeof({
+            key: value for key, value in entry.globals.items() if key not in _SHARED_NAMES
+        })
+
+        if entry.size > self.memory_cap:
+            del self._entries[chat_id]
+            return 0
+
+        total = sum(entry.size for entry in self._entries.values())
+
+        for key in list(self._entries):
+            if total <= self.memory_cap or key == chat_id:
+                break
+
+            total -= self._entries.pop(key).size
+
+        return entry.size
+
+
+def _format_error(error: BaseException) -> str:
+    # Hide the frames of this module, the snippet starts at the first "<py>" frame
+    traceback = error.__traceback__
+
+    while traceback is not None and traceback.tb_frame.f_code.co_filename != "<py>":
+        traceback = traceback.tb_next
+
+    return "".join(format_exception(type(error), error, traceback))
+
+
+def _worker_main(connection, memory_limit: int):
+    if memory_limit:
+        import resource
+
+        import psutil
+
+        # The limit is the headroom over the started interpreter rather than an absolute size
+        limit = psutil.Process().memory_info().vms + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    connection.send(None)  # ready
+
+    while True:
+        try:
+            code = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        buffer = io.StringIO()
+        error = None
+        start = perf_counter()
+
+        with redirect_stdout(buffer), redirect_stderr(buffer):
+            try:
+                timings = _execute(code, {"__name__": "__main__"})
+            except MemoryError:
+                error = "MemoryError: the memory limit of the worker was exceeded"
+            except BaseException as exception:
+                error = _format_error(exception)
+
+        if error is not None:
+            timings = (0.0, perf_counter() - start)
+
+        connection.send((buffer.getvalue(), error, *timings))
+
+
+@frozen
+class Result:
+    output = field()
+    error = field()
+    compile_time = field()
+    run_time = field()
+
+
+@mutable(eq=False)
+class _Worker:
+    process = field()
+    connection = field()
+
+    def kill(self, /):
+        self.process.kill()
+
+        try:
+            self.process.wait(1)
+        except subprocess.TimeoutExpired:
+            pass
+
+        self.connection.close()
+
+
+@mutable(eq=False)
+class WorkerPool:
+    """
+    A pool of warm Python worker processes.
+
+    :param size: number of worker processes, which is also the number of snippets run at once
+    :param timeout: wall-clock limit of a snippet in seconds
+    :param memory_limit: address space a snippet may add to a started worker in bytes, 0 for no limit
+    :param output_cap: maximum number of characters of output returned
+    """
+    size = field(default=2)
+    timeout = field(default=30.0)
+    memory_limit = field(default=512 << 20)
+    output_cap = field(default=1 << 16)
+
+    _idle = field(init=False, factory=list)
+    _semaphore = field(init=False, default=None)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(
+            size=settings.PYTHON_WORKERS,
+            timeout=settings.PYTHON_TIMEOUT,
+            memory_limit=settings.PYTHON_MEMORY_LIMIT,
+            output_cap=settings.PYTHON_OUTPUT_CAP,
+        )
+
+    def _spawn(self, /) -> _Worker:
+        parent, child = Pipe()
+        # The directory with the `modules` package, for `-m` from any working directory
+        root = str(Path(__file__).resolve().parent.parent)
+        path = os.environ.get("PYTHONPATH")
+
+        try:
+            process = subprocess.Popen(
+                (sys.executable, "-m", __name__, str(child.fileno()), str(self.memory_limit)),
+                stdin=subprocess.DEVNULL,
+                pass_fds=(child.fileno(),),
+                env={**os.environ, "PYTHONPATH": os.pathsep.join((root, path)) if path else root},
+            )
+        finally:
+            child.close()
+
+        try:
+            parent.recv()
+        except EOFError:
+            raise RuntimeError("The Python worker failed to start") from None
+
+        return _Worker(process, parent)
+
+    async def __aenter__(self, /):
+        self._semaphore = Semaphore(self.size)
+
+        for _ in range(self.size):
+            self._idle.append(await to_thread.run_sync(self._spawn))
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        while self._idle:
+            self._idle.pop().kill()
+
+    async def run(self, code: str, /) -> Result:
+        """
+        Run the code in an idle worker.
+
+        :raises TimeoutError: the code ran longer than the timeout; the worker is replaced
+        """
+        async with self._semaphore:
+            if self._idle:
+                worker = self._idle.pop()
+            else:
+                worker = await to_thread.run_sync(self._spawn)
+
+            try:
+                worker.connection.send(code)
+
+                if not await to_thread.run_sync(worker.connection.poll, self.timeout, cancellable=True):
+                    raise TimeoutError(f"Execution exceeded {self.timeout}s, the worker was killed")
+
+                try:
+                    output, error, compile_time, run_time = worker.connection.recv()
+                except EOFError:
+                    raise RuntimeError("The worker died, probably on its memory limit") from None
+            except BaseException:
+                worker.kill()
+                raise
+
+            self._idle.append(worker)
+
+        if len(output) > self.output_cap:
+            output = f"{output[:self.output_cap]}\n... {len(output) - self.output_cap} characters skipped ..."
+
+        return Result(output, error, compile_time, run_time)
+
+
+if __name__ == "__main__":
+    # The entry point of the workers started by `WorkerPool`
+    _worker_main(Connection(int(sys.argv[1])), int(sys.argv[2]))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Rendering of long replies to images without a browser.
+
+The text goes through `markdown()` first, like the HTML of the browser path,
+so inline `code` and **bold** come out as formatting. It is then laid out line
+by line with PIL fonts: `<b>`, `<strong>` and headings are drawn with the bold
+face, `<code>`, `<pre>` and ``` fences on a tinted background, paragraphs are
+separated by an empty line, list items get a bullet, other tags are dropped
+and entities are unescaped. Lines wrap at
+a fixed number of columns, and the canvas is sized from the measured extent
+of the text, so the image needs no cropping afterwards.
+
+Only TrueType faces are used: the built-in bitmap font of Pillow 9 has no
+metrics and no sizes, so without the configured font nothing is rendered and
+the caller falls back to the browser.
+"""
+
+import logging
+import re
+
+from functools import lru_cache
+from html import unescape
+from io import BytesIO
+from math import ceil
+from typing import Optional
+
+from anyio import to_thread
+from attrs import field, frozen
+from markdown import markdown
+from PIL import Image, ImageDraw, ImageFont
+
+
+__all__ = (
+    "Fonts",
+    "load_fonts",
+    "parse",
+    "wrap",
+    "layout",
+    "render",
+    "render_image",
+)
+
+_MARKUP = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^<>]*>|```")
+_BOLD_TAGS = frozenset(("b", "strong", "h1", "h2", "h3", "h4", "h5", "h6"))
+_CODE_TAGS = frozenset(("code", "pre"))
+
+_PADDING = 16
+_SPACING = 4
+_BACKGROUND = 255
+_CODE_BACKGROUND = 238
+_FOREGROUND = 30
+_MAX_GLYPHS = 4096
+
+
+@frozen
+class Fonts:
+    """
+    The faces plus a cache of rendered glyphs: FreeType rasterizes every glyph of every
+    line again, while pasting a cached mask per character is several times faster.
+    """
+    regular = field()
+    bold = field()
+    # Without a bold face the regular one is drawn twice, one pixel apart
+    fake_bold = field(default=False)
+
+    _glyphs = field(init=False, factory=dict, eq=False, repr=False)
+
+    def face(self, /, bold: bool):
+        return self.bold if bold else self.regular
+
+    def glyph(self, /, char: str, bold: bool) -> tuple:
+        """
+        :return: the mask of the character, None for blank ones, and its advance
+        """
+        try:
+            return self._glyphs[char, bold]
+        except KeyError:
+            pass
+
+        font = self.face(bold)
+        advance = font.getlength(char)
+        mask = None
+
+        if not char.isspace():
+            ascent, descent = font.getmetrics()
+            right = max(ceil(advance), font.getbbox(char)[2]) + (bold and self.fake_bold)
+            mask = Image.new("L", (max(right, 1), ascent + descent), 0)
+            draw = ImageDraw.Draw(mask)
+            draw.text((0, 0), char, 255, font)
+
+            if bold and self.fake_bold:
+                draw.text((1, 0), char, 255, font)
+
+        if len(self._glyphs) >= _MAX_GLYPHS:
+            self._glyphs.clear()
+
+        self._glyphs[char, bold] = glyph = (mask, advance)
+
+        return glyph
+
+
+@lru_cache(4)
+def load_fonts(path: str, bold_path: str, size: int) -> Optional[Fonts]:
+    """
+    Load the faces by file name or path. FreeType looks names up in the system font directories.
+
+    :return: None when the regular face is missing
+    """
+    try:
+        regular = ImageFont.truetype(path, size)
+    except OSError:
+        logging.warning("Font %r is not found, long replies are rendered with the browser", path)
+        return None
+
+    try:
+        return Fonts(regular, ImageFont.truetype(bold_path, size))
+    except OSError:
+        return Fonts(regular, regular, fake_bold=True)
+
+
+def parse(text: str) -> list:
+    """
+    Parse HTML, as written by the handlers or produced by `markdown()`.
+
+    :return: lines as lists of (text, bold, code) runs
+    """
+    lines = [[]]
+    bold = code = 0
+    fence = False
+    position = 0
+
+    def add(chunk: str):
+        first, *rest = unescape(chunk).expandtabs(4).split("\n")
+        style = (bold > 0, code > 0 or fence)
+
+        if first:
+            lines[-1].append((first, *style))
+
+        for line in rest:
+            lines.append([(line, *style)] if line else [])
+
+    for token in _MARKUP.finditer(text):
+        add(text[position:token.start()])
+        position = token.end()
+
+        if token[0] == "```":
+            fence = not fence
+            continue
+
+        name = token[2].lower()
+        step = -1 if token[1] else 1
+
+        if name == "br":
+            lines.append([])
+        elif name == "p" and step < 0:
+            # markdown() puts a line break after the paragraph, this one leaves an empty line
+            lines.append([])
+        elif name == "li" and step > 0:
+            lines[-1].append(("• ", bold > 0, code > 0 or fence))
+        elif name in _BOLD_TAGS:
+            bold = max(bold + step, 0)
+        elif name in _CODE_TAGS:
+            code = max(code + step, 0)
+
+    add(text[position:])
+
+    while len(lines) > 1 and not lines[-1]:
+        lines.pop()
+
+    return lines
+
+
+def wrap(lines: list, columns: int) -> list:
+    """
+    Wrap the lines of runs at `columns` characters, at a space where possible.
+    """
+    wrapped = []
+
+    for line in lines:
+        current, length = [], 0
+
+        for run, bold, code in line:
+            while length + len(run) > columns:
+                room = columns - length
+                cut = run.rfind(" ", 0, room + 1) + 1
+
+                if not cut:
+                    if current:
+                        # Move the word to the next line rather than cut it
+                        wrapped.append(current)
+                        current, length = [], 0
+                        continue
+
+                    cut = room
+
+                current.append((run[:cut], bold, code))
+                wrapped.append(current)
+                current, length = [], 0
+                run = run[cut:]
+
+            if run:
+                current.append((run, bold, code))
+                length += len(run)
+
+        wrapped.append(current)
+
+    return wrapped
+
+
+def layout(text: str, columns: int = 100) -> list:
+    """
+    :param text: HTML with markdown, the text of a reply
+    :return: the wrapped lines of runs, see `parse`
+    """
+    return wrap(parse(markdown(text)), columns)
+
+
+def render(text: str, fonts: Fonts, columns: int = 100) -> bytes:
+    """
+    Draw the text on a canvas of exactly its size plus padding.
+
+    :return: the PNG image
+    """
+    lines = layout(text, columns)
+    ascent, descent = fonts.regular.getmetrics()
+    line_height = ascent + descent + _SPACING
+
+    # The canvas is sized from the same advances that place the glyphs
+    glyphs = [[[fonts.glyph(char, bold) for char in run] for run, bold, _ in line] for line in lines]
+    width = max((sum(advance for run in line for _, advance in run) for line in glyphs), default=0)
+    height = len(lines) * line_height - _SPACING
+
+    image = Image.new("L", (ceil(width) + fonts.fake_bold + 2 * _PADDING, height + 2 * _PADDING), _BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    y = _PADDING
+
+    for line, runs in zip(lines, glyphs):
+        x = _PADDING
+
+        for (_, _, code), run in zip(line, runs):
+            if code:
+                length = sum(advance for _, advance in run)
+                draw.rectangle((x, y - _SPACING // 2, x + length, y + line_height - _SPACING // 2), _CODE_BACKGROUND)
+
+            for mask, advance in run:
+                if mask is not None:
+                    image.paste(_FOREGROUND, (round(x), y), mask)
+
+                x += advance
+
+        y += line_height
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+
+    return buffer.getvalue()
+
+
+async def render_image(text: str, settings) -> Optional[bytes]:
+    """
+    Render the text with the fonts of the settings in a worker thread.
+
+    :return: None when the fonts are missing
+    """
+    fonts = load_fonts(settings.RENDER_FONT, settings.RENDER_FONT_BOLD, settings.RENDER_FONT_SIZE)
+    if fonts is None:
+        return None
+
+    return await to_thread.run_sync(render, text, fonts, settings.RENDER_COLUMNS)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Command routing for the incoming message filter.
+
+The routing table is compiled from `utils.Commands` and `utils.ALIASES` plus
+the commands of plugins, once per (re)load of a plugin (see `modules.plugins`),
+so resolving a prefix is a single regular expression match plus a dict lookup.
+Arguments of commands with a schema are parsed into typed values once, before
+the handler runs.
+"""
+
+import re
+
+from typing import Any, Dict, Optional
+
+from attrs import field, frozen
+
+from utils import ALIASES, Commands
+
+
+__all__ = (
+    "PREFIX_CHARS",
+    "ArgumentError",
+    "Argument",
+    "Schema",
+    "SCHEMAS",
+    "Match",
+    "Router",
+)
+
+PREFIX_CHARS = "./!*"
+
+_MISSING = object()
+
+
+class ArgumentError(ValueError):
+    pass
+
+
+@frozen
+class Argument:
+    name = field()
+    type = field(default=str)
+    default = field(default=_MISSING)
+
+
+@frozen
+class Schema:
+    """
+    Positional arguments of a command.
+
+    :param arguments: the arguments in order; those without a default are required
+    :param separator: the argument separator, None splits on whitespace
+    :param rest: whether the last argument takes the remainder of the text
+    """
+    arguments = field(converter=tuple)
+    separator = field(default=None)
+    rest = field(default=False)
+
+    def parse(self, text: str) -> Dict[str, Any]:
+        arguments = self.arguments
+        maxsplit = len(arguments) - 1 if self.rest else -1
+        values = text.split(self.separator, maxsplit) if text else []
+
+        if len(values) > len(arguments):
+            raise ArgumentError(f"Expected at most {len(arguments)} arguments, got {len(values)}")
+
+        parsed = {}
+
+        for index, argument in enumerate(arguments):
+            if index < len(values):
+                try:
+                    parsed[argument.name] = argument.type(values[index])
+                except ValueError:
+                    raise ArgumentError(f"Invalid value for {argument.name}: {values[index]!r}") from None
+            elif argument.default is not _MISSING:
+                parsed[argument.name] = argument.default
+            else:
+                raise ArgumentError(f"Missing argument: {argument.name}")
+
+        return parsed
+
+
+SCHEMAS = {
+    Commands.dd: Schema((
+        Argument("limit", int, None),
+        Argument("over", bool, False),
+    )),
+    Commands.ps: Schema((
+        Argument("type_output", str, "all"),
+        Argument("target", str, None),
+        Argument("duration", float, None),
+    )),
+}
+
+
+@frozen
+class Match:
+    command = field()
+    text = field()
+    args = field(default=None)
+
+
+@frozen
+class Router:
+    table = field()
+    schemas = field(factory=dict)
+
+    _pattern = field(init=False, default=re.compile(rf"[{re.escape(PREFIX_CHARS)}](\S+)"))
+
+    @classmethod
+    def from_commands(cls, commands=Commands, aliases=ALIASES, schemas=SCHEMAS):
+        table = {command.name: command for command in commands}
+
+        for alias, command in aliases.items():
+            table.setdefault(alias, command)
+
+        return cls(table, schemas)
+
+    def lookup(self, text: str) -> Optional[Commands]:
+        """
+        Resolve the command of a text without touching its arguments.
+        """
+        if (match := self._pattern.match(text)) is None:
+            return None
+
+        return self.table.get(match[1])
+
+    def is_relevant(self, message) -> bool:
+        """
+        The message filter: reject as cheaply as possible, most selective checks first.
+        """
+        text = message.text
+
+        if not text or text[0] not in PREFIX_CHARS:
+            return False
+
+        if not (message.outgoing or message.from_user and message.from_user.is_self):
+            return False
+
+        return self.lookup(text) is not None
+
+    def match(self, text: str) -> Optional[Match]:
+        """
+        Resolve the command of a text and parse its arguments.
+
+        :raises ArgumentError: the arguments do not fit the schema of the command
+        """
+        if (match := self._pattern.match(text)) is None:
+            return None
+
+        if (command := self.table.get(match[1])) is None:
+            return None
+
+        rest = text[match.end():].strip()
+
+        if (schema := self.schemas.get(command)) is None:
+            return Match(command, rest)
+
+        return Match(command, rest, schema.parse(rest))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Admission control for incoming commands.
+
+Every command is classified into a cost class (cheap, normal or heavy).
+The scheduler enforces a global cap on running commands and a separate cap
+per class, wakes queued commands in priority order (cheap first) and sheds
+or coalesces excess work instead of letting it pile up on the event loop.
+"""
+
+import heapq
+
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from itertools import count
+from time import perf_counter
+
+from anyio import Event
+from attrs import field, mutable
+
+from utils import Commands
+
+
+__all__ = (
+    "Cost",
+    "COMMAND_COSTS",
+    "Rejected",
+    "Overloaded",
+    "Coalesced",
+    "Scheduler",
+)
+
+
+class Cost(IntEnum):
+    cheap = 0
+    normal = 1
+    heavy = 2
+
+
+COMMAND_COSTS = {
+    Commands.test: Cost.cheap,
+    Commands.ps: Cost.cheap,
+    Commands.dd: Cost.cheap,
+    Commands.ban: Cost.cheap,
+    Commands.unban: Cost.cheap,
+    Commands.cs: Cost.cheap,
+    Commands.qs: Cost.cheap,
+    Commands.stats: Cost.cheap,
+    Commands.lag: Cost.cheap,
+    Commands.sh: Cost.normal,
+    Commands.reload: Cost.normal,
+    Commands.py: Cost.heavy,
+    Commands.prof: Cost.heavy,
+    Commands.sp: Cost.heavy,
+    Commands.screen: Cost.heavy,
+}
+
+
+class Rejected(RuntimeError):
+    """
+    The command was not admitted and will not run.
+    """
+
+
+class Overloaded(Rejected):
+    pass
+
+
+class Coalesced(Rejected):
+    pass
+
+
+@mutable(eq=False)
+class _Waiter:
+    cost = field()
+    key = field()
+    event = field(factory=Event)
+    enqueued = field(factory=perf_counter)
+    rejection = field(default=None)
+
+
+@mutable(eq=False)
+class _ClassStats:
+    admitted = field(default=0)
+    shed = field(default=0)
+    coalesced = field(default=0)
+    waits = field(factory=lambda: deque(maxlen=256))
+
+    def summary(self, /) -> dict:
+        waits = sorted(self.waits)
+
+        if waits:
+            average = sum(waits) / len(waits)
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            worst = waits[-1]
+        else:
+            average = p95 = worst = 0.0
+
+        return {
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "coalesced": self.coalesced,
+            "wait_avg": f"{average * 1000:.1f}ms",
+            "wait_p95": f"{p95 * 1000:.1f}ms",
+            "wait_max": f"{worst * 1000:.1f}ms",
+        }
+
+
+@mutable(eq=False)
+class Scheduler:
+    """
+    Priority scheduler with a global concurrency cap and per-class caps.
+
+    :param max_active: maximum number of commands running at once
+    :param class_limits: maximum number of running commands per cost class
+    :param max_queued: maximum number of commands waiting for a slot;
+        beyond that the most expensive queued command is shed
+    """
+    max_active = field(default=8)
+    class_limits = field(factory=dict)
+    max_queued = field(default=32)
+
+    _active = field(init=False, factory=lambda: dict.fromkeys(Cost, 0))
+    _queue = field(init=False, factory=list)
+    _queued_keys = field(init=False, factory=dict)
+    _counter = field(init=False, factory=count)
+    _stats = field(init=False, factory=lambda: {cost: _ClassStats() for cost in Cost})
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(
+            max_active=settings.SCHEDULER_MAX_ACTIVE,
+            class_limits={Cost[name]: limit for name, limit in settings.SCHEDULER_CLASS_LIMITS.items()},
+            max_queued=settings.SCHEDULER_MAX_QUEUED,
+        )
+
+    @staticmethod
+    def classify(command) -> Cost:
+        # The commands of plugins carry their cost, see `modules.plugins.Command`
+        if (cost := getattr(command, "cost", None)) is not None:
+            return cost
+
+        return COMMAND_COSTS.get(command, Cost.normal)
+
+    def _has_capacity(self, cost: Cost, /) -> bool:
+        if sum(self._active.values()) >= self.max_active:
+            return False
+
+        return self._active[cost] < self.class_limits.get(cost, self.max_active)
+
+    def _dequeue(self, waiter: _Waiter, /):
+        if self._queued_keys.get(waiter.key) is waiter:
+            del self._queued_keys[waiter.key]
+
+        waiter.event.set()
+
+    def _wake(self, /):
+        # Wake every queued command that fits, cheapest and oldest first.
+        # Heavy commands blocked by their class cap must not hold back cheap ones.
+        skipped = []
+
+        while self._queue and sum(self._active.values()) < self.max_active:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+
+            if waiter.event.is_set():
+                continue
+
+            if self._has_capacity(waiter.cost):
+                self._active[waiter.cost] += 1
+                self._dequeue(waiter)
+            else:
+                skipped.append(entry)
+
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _shed(self, cost: Cost, /) -> bool:
+        """
+        Make room in a full queue by dropping the most expensive, newest entry,
+        but only if it is more expensive than the incoming command.
+        """
+        victim = max(
+            (entry for entry in self._queue if not entry[2].event.is_set()),
+            default=None,
+        )
+
+        if victim is None or victim[0] <= cost:
+            return False
+
+        waiter = victim[2]
+        waiter.rejection = Overloaded("Dropped: a cheaper command needed the queue slot")
+        self._dequeue(waiter)
+        self._stats[waiter.cost].shed += 1
+
+        self._queue.remove(victim)
+        heapq.heapify(self._queue)
+
+        return True
+
+    @asynccontextmanager
+    async def admit(self, /, chat_id: int, command: Commands, text: str = "", account: str = ""):
+        """
+        Wait for a slot for the command and hold it for the duration of the block.
+
+        :param account: the account the chat belongs to, as the chat IDs of two accounts may be the same
+
+        :raises Coalesced: an identical command for the same chat is already queued
+        :raises Overloaded: the queue is full of commands at least as important
+        """
+        cost = self.classify(command)
+        stats = self._stats[cost]
+        key = (account, chat_id, command, text)
+
+        if not self._queued_keys and self._has_capacity(cost):
+            self._active[cost] += 1
+            stats.waits.append(0.0)
+        else:
+            if key in self._queued_keys:
+                stats.coalesced += 1
+                raise Coalesced("An identical command is already queued in this chat")
+
+            if len(self._queued_keys) >= self.max_queued and not self._shed(cost):
+                stats.shed += 1
+                raise Overloaded("Too many queued commands, try again later")
+
+            waiter = _Waiter(cost, key)
+            heapq.heappush(self._queue, (cost, next(self._counter), waiter))
+            self._queued_keys[key] = waiter
+            self._wake()
+
+            try:
+                await waiter.event.wait()
+            except BaseException:
+                if not waiter.event.is_set():
+                    # Leave a tombstone so that _wake() skips the heap entry.
+                    waiter.rejection = Rejected("Cancelled while queued")
+                    self._dequeue(waiter)
+                elif waiter.rejection is None:
+                    self._active[cost] -= 1
+                    self._wake()
+                raise
+
+            if waiter.rejection is not None:
+                raise waiter.rejection
+
+            stats.waits.append(perf_counter() - waiter.enqueued)
+
+        stats.admitted += 1
+
+        try:
+            yield cost
+        finally:
+            self._active[cost] -= 1
+            self._wake()
+
+    def statistics(self, /) -> dict:
+        return {
+            "active": {cost.name: self._active[cost] for cost in Cost},
+            "queued": len(self._queued_keys),
+            "classes": {cost.name: self._stats[cost].summary() for cost in Cost},
+        }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Cache of website screenshots for `.screen`.
+
+Screenshots are keyed by the normalized URL, the proxy and the viewport, so
+`example.com`, `https://EXAMPLE.com/` and `https://example.com/#top` share an
+entry. Entries expire after a TTL, and the least recently used ones are
+dropped to keep the images under a byte budget. Concurrent requests for a key
+that is being captured wait for that capture instead of starting their own.
+"""
+
+import re
+
+from collections import OrderedDict
+from time import perf_counter
+from urllib.parse import urlsplit, urlunsplit
+
+from anyio import Event
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "normalize_url",
+    "extract_urls",
+    "split_proxy",
+    "Shot",
+    "ScreenshotCache",
+)
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# A SOCKS address is a proxy anywhere, any other one needs the `proxy=` marker, as an HTTP proxy looks like a website
+_PROXY = re.compile(r"(?<!\S)proxy=(\S+)|(socks[45]h?://\S+)", re.IGNORECASE)
+
+# Bare domains and http(s) links, without the punctuation that usually follows a link in text
+_URL = re.compile(r"(?:https?://)?(?:[\w-]+\.)+[a-zA-Z]{2,}(?::\d+)?(?:[/?#]\S*)?(?<![.,;:!?)\]])", re.IGNORECASE)
+
+
+def normalize_url(url: str) -> str:
+    """
+    Lower-case the scheme and the host, drop the default port and the fragment and make an empty path "/".
+    """
+    url = url.strip()
+
+    if "://" not in url:
+        url = f"https://{url}"
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+
+    if ":" in host:
+        host = f"[{host}]"
+
+    if parts.port is not None and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        host = f"{credentials}@{host}"
+
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+
+def extract_urls(text: str, limit: int = None) -> list:
+    """
+    :return: the distinct normalized URLs in the text, in order
+    """
+    urls = dict.fromkeys(normalize_url(match[0]) for match in _URL.finditer(text))
+
+    return list(urls)[:limit]
+
+
+def split_proxy(text: str) -> tuple:
+    """
+    Take the proxy out of the text: a SOCKS proxy such as `socks5://127.0.0.1:9050`,
+    or any proxy after the marker, such as `proxy=http://10.0.0.1:3128`.
+
+    :return: the last proxy or None, and the text without the proxies
+    """
+    proxies = [marked or socks for marked, socks in _PROXY.findall(text)]
+
+    return (proxies[-1] if proxies else None), _PROXY.sub(" ", text)
+
+
+@frozen
+class Shot:
+    image = field()
+    title = field()
+    elapsed = field()
+    taken = field(factory=perf_counter)
+
+
+@mutable(eq=False)
+class _Job:
+    done = field(factory=Event)
+    shot = field(default=None)
+    error = field(default=None)
+
+
+@mutable(eq=False)
+class ScreenshotCache:
+    """
+    :param ttl: seconds a screenshot is served from the cache
+    :param max_bytes: total size of the cached images; least recently used ones are dropped to stay below it
+    """
+    ttl = field(default=300.0)
+    max_bytes = field(default=64 << 20)
+
+    _entries = field(init=False, factory=OrderedDict)
+    _size = field(init=False, default=0)
+    _jobs = field(init=False, factory=dict)
+    _hits = field(init=False, default=0)
+    _misses = field(init=False, default=0)
+    _shared = field(init=False, default=0)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(ttl=settings.SCREEN_CACHE_TTL, max_bytes=settings.SCREEN_CACHE_BYTES)
+
+    @staticmethod
+    def key(url: str, proxy: str, viewport: dict, /) -> tuple:
+        return normalize_url(url), proxy, viewport["width"], viewport["height"]
+
+    def _lookup(self, key, /):
+        if (shot := self._entries.get(key)) is None:
+            return None
+
+        if perf_counter() - shot.taken > self.ttl:
+            self._drop(key)
+            return None
+
+        self._entries.move_to_end(key)
+
+        return shot
+
+    def _drop(self, key, /):
+        self._size -= len(self._entries.pop(key).image)
+
+    def _store(self, key, shot: Shot, /):
+        if key in self._entries:
+            self._drop(key)
+
+        if len(shot.image) > self.max_bytes:
+            return
+
+        self._entries[key] = shot
+        self._size += len(shot.image)
+
+        while self._size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    async def get(self, key, capture, /, fresh: bool = False) -> tuple:
+        """
+        Return the cached screenshot of the key or capture it.
+
+        :param capture: an async callable without arguments returning a `Shot`
+        :param fresh: bypass the cached screenshot; a capture already in progress is still shared
+        :return: the screenshot and whether it was not captured by this call
+        """
+        while True:
+            if not fresh and (shot := self._lookup(key)) is not None:
+                self._hits += 1
+                return shot, True
+
+            if (job := self._jobs.get(key)) is None:
+                break
+
+            self._shared += 1
+            await job.done.wait()
+
+            if job.error is not None:
+                raise job.error
+
+            if job.shot is not None:
+                return job.shot, True
+
+            # The capturing request was cancelled, try again
+
+        self._misses += 1
+        self._jobs[key] = job = _Job()
+
+        try:
+            job.shot = await capture()
+        except Exception as error:
+            job.error = error
+            raise
+        finally:
+            del self._jobs[key]
+            job.done.set()
+
+        self._store(key, job.shot)
+
+        return job.shot, False
+
+    def clear(self, /):
+        self._entries.clear()
+        self._size = 0
+
+    def statistics(self, /) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self._hits,
+            "misses": self._misses,
+            "shared": self._shared,
+            "in_flight": len(self._jobs),
+        }
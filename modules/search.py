@@ -11,9 +11,11 @@ from pydantic import BaseModel
 from httpx import AsyncClient
 
 from config import get_env, Settings
+from modules.plugins import Command
+from modules.routing import Argument, Schema
 
 
-__all__ = ('request', 'engines', )
+__all__ = ('request', 'engines', 'search', 'COMMANDS', )
 settings: Settings = get_env()
 url = settings.MODULES_SEARCH_HOST
 engines: Tuple = (
@@ -75,7 +77,7 @@ async def request(session: AsyncClient, query: str, count_results: int = 3, engi
         format='json',
         engines=engine
     )
-    response = await session.get(url, params={**def_params})
+    response = await session.get(url, params={**def_params}, extensions={"cache": True})
     text_result_ = response.text
 
     pretty_result = []
@@ -87,6 +89,30 @@ async def request(session: AsyncClient, query: str, count_results: int = 3, engi
         else f"<strong>Engine:</strong> {engine}\n<strong>Result:</strong> Nothing found"
 
 
+async def search(handler) -> None:
+    """
+    Handle `.s <query>&[count]&[engine]`: the first results of the engine, `.s engines` lists the engines.
+    """
+    await handler.orders.wait()
+    await handler.message.edit("<strong>Fetching...</strong>")
+
+    if handler.args["query"] != "engines":
+        handler.message.text = await request(handler.http.client("search"), **handler.args)
+    else:
+        handler.message.text = "<strong>Engines: </strong>\n" + " ".join(engines)
+
+    await handler.limit_message(tti=False)
+
+
+COMMANDS = (
+    Command("s", search, aliases=("search",), schema=Schema((
+        Argument("query", str, ""),
+        Argument("count_results", int, 3),
+        Argument("engine", str, "duckduckgo"),
+    ), separator="&")),
+)
+
+
 
 # if __name__ == '__main__':
 #     session = urllib3.PoolManager()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Non-blocking shell command execution.
+
+Commands run in their own process group, so a timeout kills the whole
+pipeline of children, and their output is read incrementally into a
+bounded buffer that keeps the head and the tail of the stream.
+
+`Sessions` keeps an opt-in long-lived shell per chat on a PTY, so the working
+directory, the environment and shell variables survive between commands.
+"""
+
+import os
+import pty
+import re
+import signal
+import subprocess
+import termios
+
+from collections import defaultdict
+from select import select
+from threading import Thread
+from time import perf_counter
+from typing import Optional, Sequence
+from uuid import uuid4
+
+from anyio import (
+    CancelScope, Lock, create_task_group, get_cancelled_exc_class, move_on_after, open_process, sleep, to_thread,
+)
+from attrs import field, frozen, mutable
+
+
+__all__ = (
+    "DENIED_COMMANDS",
+    "is_denied",
+    "Output",
+    "Result",
+    "run",
+    "Session",
+    "Sessions",
+)
+
+DENIED_COMMANDS = ("rm", "unlink", "poweroff", "reboot", "shutdown")
+
+# Separators of simple commands: lists, pipelines, subshells and substitutions
+_COMMAND_SEPARATORS = re.compile(r"[;&|\n`()]+|\$\(")
+_COMMAND_WRAPPERS = ("sudo", "exec", "command", "nohup", "time", "env", "xargs")
+
+
+def is_denied(code: str) -> bool:
+    """
+    Check every simple command of the code against the deny-list, not only the first one.
+    """
+    for segment in _COMMAND_SEPARATORS.split(code):
+        words = segment.split()
+
+        while words and (words[0] in _COMMAND_WRAPPERS or "=" in words[0]):
+            del words[0]
+
+        if words and words[0].startswith(DENIED_COMMANDS):
+            return True
+
+    return False
+
+
+@mutable(eq=False)
+class Output:
+    """
+    Output of a process capped at `cap` bytes: the first half of the budget
+    keeps the head of the stream, the second half a sliding tail.
+    """
+    cap = field(default=1 << 20)
+    total = field(init=False, default=0)
+
+    _head = field(init=False, factory=bytearray)
+    _tail = field(init=False, factory=bytearray)
+
+    def feed(self, data: bytes, /):
+        self.total += len(data)
+
+        head_room = self.cap // 2 - len(self._head)
+
+        if head_room > 0:
+            self._head += data[:head_room]
+            data = data[head_room:]
+
+        if data:
+            self._tail += data
+
+            if (excess := len(self._tail) - (self.cap - self.cap // 2)) > 0:
+                del self._tail[:excess]
+
+    @property
+    def truncated(self, /) -> bool:
+        return self.total > len(self._head) + len(self._tail)
+
+    @property
+    def data(self, /) -> bytes:
+        if not self.truncated:
+            return bytes(self._head + self._tail)
+
+        skipped = self.total - len(self._head) - len(self._tail)
+        return b"".join((self._head, f"\n\n... {skipped} bytes skipped ...\n\n".encode(), self._tail))
+
+    @property
+    def text(self, /) -> str:
+        return self.data.decode(errors="replace")
+
+    def tail(self, size: int, /) -> str:
+        return self.data[-size:].decode(errors="replace")
+
+
+@frozen
+class Result:
+    output = field()
+    returncode = field()
+    elapsed = field()
+    timed_out = field(default=False)
+
+
+def _kill_group(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run(argv: Sequence[str], *, timeout: float = 60.0, output: Output = None) -> Result:
+    """
+    Run a command without blocking the event loop.
+
+    :param argv: the command and its arguments
+    :param timeout: wall-clock limit in seconds, after which the process group is killed
+    :param output: the buffer to stream stdout and stderr into, so the caller can watch it grow
+    :return: the result of the command
+    """
+    if output is None:
+        output = Output()
+
+    start = perf_counter()
+    process = await open_process(
+        argv,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+
+    try:
+        with move_on_after(timeout) as scope:
+            async for chunk in process.stdout:
+                output.feed(chunk)
+
+            await process.wait()
+    finally:
+        if process.returncode is None:
+            _kill_group(process.pid)
+
+        with CancelScope(shield=True):
+            await process.aclose()
+
+    return Result(output, process.returncode, perf_counter() - start, scope.cancel_called)
+
+
+@mutable(eq=False)
+class Session:
+    """
+    A long-lived shell on a PTY.
+
+    Commands are written to the shell followed by a `printf` of a random marker and the exit status,
+    output is read until the marker shows up.
+    """
+    process = field()
+    fd = field()
+    lock = field(factory=Lock)
+    last_used = field(factory=perf_counter)
+
+    @classmethod
+    def open(cls, program: str = "/bin/sh", /):
+        master, slave = pty.openpty()
+
+        attributes = termios.tcgetattr(slave)
+        attributes[1] &= ~termios.ONLCR  # oflag: keep "\n" as is
+        attributes[3] &= ~termios.ECHO   # lflag: do not echo the commands back
+        termios.tcsetattr(slave, termios.TCSANOW, attributes)
+
+        process = subprocess.Popen(
+            [program],
+            stdin=slave, stdout=slave, stderr=slave,
+            start_new_session=True,
+            env={**os.environ, "PS1": "", "PS2": "", "TERM": "dumb"},
+        )
+        os.close(slave)
+
+        return cls(process, master)
+
+    @property
+    def alive(self, /) -> bool:
+        return self.fd is not None and self.process.poll() is None
+
+    def close(self, /):
+        _kill_group(self.process.pid)
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        if self.process.poll() is None:
+            # A killed shell can take a while to exit, it is reaped off the event loop
+            Thread(target=self.process.wait, name="pyrobot-shell-reaper", daemon=True).start()
+
+    def _read(self, timeout: float, /) -> Optional[bytes]:
+        """
+        :return: the available output, empty if there was none within the timeout, None once the shell exited
+        """
+        if not select([self.fd], [], [], timeout)[0]:
+            return b""
+
+        try:
+            return os.read(self.fd, 1 << 16) or None
+        except OSError:  # EIO
+            return None
+
+    async def run(self, code: str, /, *, timeout: float = 60.0, output: Output = None) -> Result:
+        """
+        Run the code in the shell. On timeout or cancellation the session is closed,
+        since the shell state is unknown and its output would leak into the next command.
+        """
+        if output is None:
+            output = Output()
+
+        marker = f"__pyrobot_{uuid4().hex}__"
+        prefix = f"\n{marker}:".encode()
+        status = re.compile(re.escape(prefix) + rb"(\d+)\n")
+        pending = bytearray()
+        returncode = None
+
+        async with self.lock:
+            start = perf_counter()
+            self.last_used = start
+
+            os.write(self.fd, f"{code}\nprintf '\\n%s:%s\\n' {marker} \"$?\"\n".encode())
+
+            try:
+                with move_on_after(timeout) as scope:
+                    while returncode is None:
+                        chunk = await to_thread.run_sync(self._read, 0.25, cancellable=True)
+
+                        if chunk is None:
+                            returncode = await to_thread.run_sync(self.process.wait)
+                            break
+
+                        pending += chunk
+
+                        if match := status.search(pending):
+                            output.feed(bytes(pending[:match.start()]))
+                            returncode = int(match[1])
+                        elif len(pending) > len(prefix) + 8:
+                            # Hold back enough bytes to find a marker split between reads
+                            output.feed(bytes(pending[:-len(prefix) - 8]))
+                            del pending[:-len(prefix) - 8]
+            except get_cancelled_exc_class():
+                self.close()
+                raise
+
+            self.last_used = perf_counter()
+
+        if scope.cancel_called or returncode is None:
+            self.close()
+
+        return Result(output, returncode, self.last_used - start, scope.cancel_called)
+
+
+@mutable(eq=False)
+class Sessions:
+    """
+    Shell sessions per chat, closed after `idle_timeout` seconds without commands.
+    """
+    idle_timeout = field(default=900.0)
+    program = field(default="/bin/sh")
+
+    _sessions = field(init=False, factory=dict)
+    _opening = field(init=False, factory=lambda: defaultdict(Lock))
+    _tasks = field(init=False, default=None)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        return cls(idle_timeout=settings.SHELL_SESSION_IDLE_TIMEOUT, program=settings.SHELL_SESSION_PROGRAM)
+
+    async def get(self, chat_id: int, /) -> Session:
+        # Two commands arriving at once must not both open a shell, the second one would leak
+        async with self._opening[chat_id]:
+            session = self._sessions.get(chat_id)
+
+            if session is None or not session.alive:
+                session = await to_thread.run_sync(Session.open, self.program)
+                try:
+                    # Swallow the startup banner and warnings of the shell
+                    await session.run("true", timeout=10.0)
+                except BaseException:
+                    session.close()
+                    raise
+
+                self._sessions[chat_id] = session
+
+        return session
+
+    def close(self, chat_id: int, /) -> bool:
+        if (session := self._sessions.pop(chat_id, None)) is None:
+            return False
+
+        session.close()
+        return True
+
+    async def _sweep(self, /):
+        while True:
+            await sleep(min(60.0, self.idle_timeout))
+
+            deadline = perf_counter() - self.idle_timeout
+
+            for chat_id, session in list(self._sessions.items()):
+                if not session.lock.locked() and (session.last_used < deadline or not session.alive):
+                    self.close(chat_id)
+
+    async def __aenter__(self, /):
+        self._tasks = await create_task_group().__aenter__()
+        self._tasks.start_soon(self._sweep)
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        self._tasks.cancel_scope.cancel()
+        await self._tasks.__aexit__(exc_type, exc_value, traceback)
+
+        for chat_id in list(self._sessions):
+            self.close(chat_id)
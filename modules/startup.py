@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+Fast startup: lazy imports of heavy modules and a timing breakdown.
+
+`lazy_import()` returns a module whose code runs on the first attribute
+access, so torch, playwright, lxml, PIL and numpy are only imported by the
+code that uses them. `timings` records the duration of every startup step for the
+report printed once the bot is ready.
+"""
+
+import importlib.util
+import logging
+import sys
+
+from contextlib import contextmanager
+from time import perf_counter
+
+from attrs import field, mutable
+
+
+__all__ = (
+    "lazy_import",
+    "Timings",
+    "timings",
+)
+
+
+def lazy_import(name: str):
+    """
+    Import a module lazily: it is found now, but executed on the first access to one of its attributes.
+    """
+    if (module := sys.modules.get(name)) is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    parent, _, child = name.rpartition(".")
+
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
+
+
+@mutable(eq=False)
+class Timings:
+    steps = field(init=False, factory=list)
+
+    @contextmanager
+    def step(self, name: str, /):
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def add(self, name: str, seconds: float, /):
+        self.steps.append((name, seconds))
+
+    def report(self, /) -> str:
+        width = max((len(name) for name, _ in self.steps), default=0)
+        lines = [f"{name:<{width}} {seconds * 1000:9.1f}ms" for name, seconds in self.steps]
+        lines.append(f"{'total':<{width}} {sum(seconds for _, seconds in self.steps) * 1000:9.1f}ms")
+
+        return "\n".join(lines)
+
+    def check_budget(self, name: str, budget: float, /) -> bool:
+        """
+        :return: whether the step fit into the budget in seconds, a warning is logged otherwise
+        """
+        seconds = sum(duration for step, duration in self.steps if step == name)
+
+        if seconds <= budget:
+            return True
+
+        logging.warning("Startup step %r took %.3fs, over its budget of %.3fs", name, seconds, budget)
+
+        return False
+
+
+timings = Timings()
@@ -3,25 +3,45 @@
 # Copyright 2021 Andrew Ivanov <okolefleef@disr.it>
 # All rights reserved
 
-from httpx import AsyncClient, AsyncHTTPTransport, Timeout
-from lxml.html import fromstring, HtmlElement
+from httpx import AsyncClient
 
+from modules.plugins import Command
 
-def create_session() -> AsyncClient:
-    return AsyncClient(
-        http2=True,
-        transport=AsyncHTTPTransport(retries=2),
-        timeout=Timeout(10.0, connect=30.0)
-    )
 
+async def translate(session: AsyncClient, options: dict) -> str:
+    # lxml is imported by the first translation, not at startup
+    from lxml.html import fromstring
 
-async def translate(session: AsyncClient, options: dict) -> HtmlElement:
-    response = await session.get("https://translate.google.com/m", params=options)
+    response = await session.get("https://translate.google.com/m", params=options, extensions={"cache": True})
     text_translate = fromstring(response.text).find_class("result-container")[0].text_content()
 
     return text_translate
 
 
+async def translate_text(handler) -> None:
+    """
+    Handle `.tr <text>`: translate the text to English, or the replied message to Russian.
+    """
+    message = handler.message
+    options = {
+        "q": message.text,
+        "sl": "auto",
+        "tl": "en"
+    }
+
+    if reply_message := message.reply_to_message:
+        options["q"] = reply_message.text
+        options["tl"] = "ru"
+
+    handler.message.text = await translate(handler.http.client("translate"), options)
+    await handler.limit_message()
+
+
+COMMANDS = (
+    Command("tr", translate_text, aliases=("translate",)),
+)
+
+
 # # ex:
 # if __name__ == "__main__":
 #     import anyio
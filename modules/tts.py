@@ -1,11 +1,15 @@
 #!/bin/env python3
 
+import logging
+
 from io import BytesIO
 
-import torch
-import torchaudio
+from anyio import Lock, to_thread
+from attrs import field, mutable
 from transliterate import translit, exceptions
 
+# torch and torchaudio take seconds to import, they are imported by the functions that use them
+
 
 # Use this function to transliterate the input text to Russian, if possible
 def transcript(text: str):
@@ -17,6 +21,8 @@ def transcript(text: str):
     return text
 
 def load_model():
+    import torch
+
     device = torch.device("cpu")
 
     model = torch.hub.load(
@@ -32,7 +38,9 @@ def load_model():
     return model
 
 
-def synthesize_audio(model: torch.nn.Module, text: str, speaker: str = "baya"):
+def synthesize_audio(model: "torch.nn.Module", text: str, speaker: str = "baya"):
+    import torchaudio
+
     text = transcript(text)
     audio = model.apply_tts(
         text=text,
@@ -44,6 +52,31 @@ def synthesize_audio(model: torch.nn.Module, text: str, speaker: str = "baya"):
     buffer.name = "test.ogg"
     return buffer
 
+
+@mutable(eq=False)
+class Model:
+    """
+    The model, built in a worker thread on the first use or by an early call to `get` in the background.
+    """
+    _model = field(init=False, default=None)
+    _lock = field(init=False, factory=Lock)
+
+    async def get(self, /):
+        async with self._lock:
+            if self._model is None:
+                self._model = await to_thread.run_sync(load_model)
+
+        return self._model
+
+    async def preload(self, /):
+        """
+        Build the model ahead of the first use. Failures are logged, the first use tries again.
+        """
+        try:
+            await self.get()
+        except Exception:
+            logging.exception("Preloading the TTS model failed")
+
 # def main():
 #     text = "Привет"
 #     model = load_model()
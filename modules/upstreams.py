@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Andrew Ivanov <okolefleef@disr.it>
+# All rights reserved
+
+"""
+HTTP clients of the upstreams: the weather API, the search engine and the translator.
+
+Every upstream gets its own `httpx.AsyncClient` with its own connection pool,
+keep-alive, timeouts and retries, and HTTP/2 where the server negotiates it
+over ALPN. Host names are resolved once per `dns_ttl` for all the upstreams.
+Requests are timed as the dependency `http:<upstream>`, and the opened
+connections and HTTP versions are counted for the reuse statistics. Requests
+that opt in are answered from the disk cache of `modules.http_cache` first.
+
+The transport is built on the public APIs of httpx and httpcore: an
+`httpx.AsyncBaseTransport` around an `httpcore.AsyncConnectionPool` of its own
+with a network backend that connects to the cached addresses.
+"""
+
+import ipaddress
+import socket
+
+from collections import Counter
+from contextlib import contextmanager
+from time import monotonic
+
+import httpcore
+import httpx
+
+from anyio import getaddrinfo
+from attrs import evolve, field, frozen, mutable
+from httpx import AsyncBaseTransport, AsyncByteStream, AsyncClient, Timeout, create_ssl_context
+
+try:
+    # Public since httpcore 0.17
+    from httpcore import AnyIOBackend, AsyncNetworkBackend
+except ImportError:
+    # httpcore 0.16, pinned in requirements.txt and setup.py
+    from httpcore.backends.asyncio import AsyncIOBackend as AnyIOBackend
+    from httpcore.backends.base import AsyncNetworkBackend
+
+from modules.http_cache import CachingTransport, ResponseCache
+from modules.instrumentation import InstrumentedTransport, metrics
+
+
+__all__ = (
+    "Upstream",
+    "UPSTREAMS",
+    "Resolver",
+    "Clients",
+)
+
+
+@frozen
+class Upstream:
+    """
+    :param connect_timeout: seconds to open a connection, including the TLS handshake
+    :param read_timeout: seconds to wait for a response, and for a free connection of the pool
+    :param max_connections: connections open at once, further requests wait for one
+    :param max_keepalive: idle connections kept open for the next requests
+    :param keepalive_expiry: seconds an idle connection is kept open
+    :param retries: attempts to connect again after a failed connection
+    """
+    http2 = field(default=True)
+    connect_timeout = field(default=5.0)
+    read_timeout = field(default=15.0)
+    max_connections = field(default=10)
+    max_keepalive = field(default=5)
+    keepalive_expiry = field(default=60.0)
+    retries = field(default=1)
+
+
+UPSTREAMS = {
+    "weather": Upstream(read_timeout=10.0, max_connections=4, max_keepalive=2),
+    # The search engine waits for the engines it asks
+    "search": Upstream(read_timeout=20.0),
+    "translate": Upstream(read_timeout=10.0),
+}
+
+
+@mutable(eq=False)
+class Resolver:
+    """
+    A cache of resolved host names shared by the clients of all the upstreams.
+    """
+    ttl = field(default=300.0)
+
+    _entries = field(init=False, factory=dict)
+    _hits = field(init=False, default=0)
+    _misses = field(init=False, default=0)
+
+    async def resolve(self, host: str, port: int, /) -> list:
+        """
+        :return: the addresses of the host, in the order of the system resolver
+        """
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return [host]
+
+        if (entry := self._entries.get(host)) is not None and entry[0] > monotonic():
+            self._hits += 1
+            return entry[1]
+
+        self._misses += 1
+        addresses = list(dict.fromkeys(
+            sockaddr[0] for *_, sockaddr in await getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        ))
+        self._entries[host] = (monotonic() + self.ttl, addresses)
+
+        return addresses
+
+    def forget(self, host: str, /):
+        self._entries.pop(host, None)
+
+    def statistics(self, /) -> dict:
+        return {"hosts": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+@mutable(eq=False)
+class _Stats:
+    connections = field(default=0)
+    versions = field(factory=Counter)
+
+    async def on_response(self, response, /):
+        # Responses of the cache did not use a connection
+        if "cache" not in response.extensions:
+            self.versions[response.http_version] += 1
+
+
+class _Backend(AsyncNetworkBackend):
+    """
+    The network backend of httpcore, connecting to the cached addresses of the host and counting the connections.
+    TLS still verifies the host name, which httpcore passes separately.
+    """
+    def __init__(self, resolver: Resolver, stats: _Stats):
+        self.backend = AnyIOBackend()
+        self.resolver = resolver
+        self.stats = stats
+
+    async def connect_tcp(self, host: str, port: int, timeout: float = None, local_address: str = None, **kwargs):
+        error = None
+
+        for address in await self.resolver.resolve(host, port):
+            try:
+                stream = await self.backend.connect_tcp(address, port, timeout, local_address, **kwargs)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as exc:
+                error = exc
+                continue
+
+            self.stats.connections += 1
+            return stream
+
+        # The host may have moved, resolve it again next time
+        self.resolver.forget(host)
+
+        raise error or httpcore.ConnectError(f"No addresses for {host}")
+
+    async def connect_unix_socket(self, path: str, timeout: float = None, **kwargs):
+        return await self.backend.connect_unix_socket(path, timeout, **kwargs)
+
+    async def sleep(self, seconds: float):
+        await self.backend.sleep(seconds)
+
+
+# The exceptions of httpcore and their counterparts of httpx, the subclasses first
+_ERRORS = {
+    getattr(httpcore, name): getattr(httpx, name)
+    for name in (
+        "PoolTimeout", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "TimeoutException",
+        "ConnectError", "ReadError", "WriteError", "NetworkError",
+        "LocalProtocolError", "RemoteProtocolError", "ProtocolError",
+        "ProxyError", "UnsupportedProtocol",
+    )
+}
+
+
+@contextmanager
+def _map_errors(request: httpx.Request):
+    try:
+        yield
+    except tuple(_ERRORS) as error:
+        for cls in type(error).__mro__:
+            if cls in _ERRORS:
+                raise _ERRORS[cls](str(error), request=request) from error
+
+        raise
+
+
+class _ResponseStream(AsyncByteStream):
+    def __init__(self, stream, request: httpx.Request):
+        self.stream = stream
+        self.request = request
+
+    async def __aiter__(self):
+        with _map_errors(self.request):
+            async for part in self.stream:
+                yield part
+
+    async def aclose(self):
+        if hasattr(self.stream, "aclose"):
+            await self.stream.aclose()
+
+
+class _NetworkTransport(AsyncBaseTransport):
+    """
+    The transport of an upstream: its own connection pool on the caching network backend.
+    """
+    def __init__(self, pool: httpcore.AsyncConnectionPool):
+        self.pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=url.raw_scheme, host=url.raw_host, port=url.port, target=url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+
+        with _map_errors(request):
+            response = await self.pool.handle_async_request(core_request)
+
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_ResponseStream(response.stream, request),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.pool.aclose()
+
+
+@mutable(eq=False)
+class Clients:
+    """
+    :param upstreams: settings per upstream name, overriding the fields of `UPSTREAMS`
+    :param dns_ttl: seconds a resolved host name is reused
+    :param transport: a transport serving every upstream instead of the network, for benchmarks
+    :param cache: the `ResponseCache` of the requests that opt in, None disables caching
+    """
+    upstreams = field(factory=dict)
+    dns_ttl = field(default=300.0)
+    transport = field(default=None)
+    cache = field(default=None)
+
+    resolver = field(init=False)
+    _clients = field(init=False, factory=dict)
+    _stats = field(init=False, factory=dict)
+
+    @resolver.default
+    def _(self, /):
+        return Resolver(self.dns_ttl)
+
+    @classmethod
+    def from_settings(cls, settings, /):
+        cache = None
+
+        if settings.HTTP_CACHE_PATH is not None:
+            cache = ResponseCache.from_settings(settings)
+
+        return cls(upstreams=settings.HTTP_UPSTREAMS, dns_ttl=settings.HTTP_DNS_TTL, cache=cache)
+
+    def upstream(self, name: str, /) -> Upstream:
+        return evolve(UPSTREAMS.get(name, Upstream()), **self.upstreams.get(name, {}))
+
+    def _network(self, upstream: Upstream, stats: _Stats, /) -> AsyncBaseTransport:
+        return _NetworkTransport(httpcore.AsyncConnectionPool(
+            ssl_context=create_ssl_context(http2=upstream.http2),
+            max_connections=upstream.max_connections,
+            max_keepalive_connections=upstream.max_keepalive,
+            keepalive_expiry=upstream.keepalive_expiry,
+            http2=upstream.http2,
+            retries=upstream.retries,
+            network_backend=_Backend(self.resolver, stats),
+        ))
+
+    def client(self, name: str, /) -> AsyncClient:
+        """
+        The client of the upstream, created on the first use.
+        """
+        if (client := self._clients.get(name)) is not None:
+            return client
+
+        upstream = self.upstream(name)
+        self._stats[name] = stats = _Stats()
+
+        transport = InstrumentedTransport(self.transport or self._network(upstream, stats), name=name)
+
+        # Above the timing, so that only the requests reaching the upstream are counted
+        if self.cache is not None:
+            transport = CachingTransport(transport, self.cache, name)
+
+        self._clients[name] = client = AsyncClient(
+            transport=transport,
+            timeout=Timeout(upstream.read_timeout, connect=upstream.connect_timeout),
+            event_hooks={"response": [stats.on_response]},
+        )
+
+        return client
+
+    async def aclose(self, /):
+        clients, self._clients = self._clients, {}
+
+        for client in clients.values():
+            await client.aclose()
+
+    async def __aenter__(self, /):
+        if self.cache is not None:
+            await self.cache.__aenter__()
+
+        return self
+
+    async def __aexit__(self, /, exc_type, exc_value, traceback):
+        try:
+            if self.cache is not None:
+                await self.cache.__aexit__(exc_type, exc_value, traceback)
+        finally:
+            await self.aclose()
+
+    def statistics(self, /) -> dict:
+        """
+        :return: per upstream, the requests, the share of them served on an already open connection,
+            the HTTP versions and the latency percentiles, then the response and DNS caches
+        """
+        upstreams = {}
+
+        for name, stats in sorted(self._stats.items()):
+            histogram = metrics.histogram("dependency", f"http:{name}")
+            requests = histogram.count
+            reused = 1 - stats.connections / requests if requests else 0.0
+
+            upstreams[name] = {
+                "requests": requests,
+                "errors": histogram.errors,
+                "connections": stats.connections,
+                "reused": f"{max(reused, 0.0):.0%}",
+                "versions": ", ".join(f"{version} {count}" for version, count in stats.versions.most_common()),
+                "p50": f"{histogram.quantile(0.5) * 1000:.1f}ms",
+                "p95": f"{histogram.quantile(0.95) * 1000:.1f}ms",
+            }
+
+        if self.cache is not None:
+            upstreams["cache"] = self.cache.statistics()
+
+        return {**upstreams, "dns": self.resolver.statistics()}
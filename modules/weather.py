@@ -4,14 +4,17 @@
 # All rights reserved
 
 import datetime
+from time import perf_counter
 from typing import List, Optional
 
 import arrow
-from httpx import AsyncClient, AsyncHTTPTransport, Timeout
+from httpx import AsyncClient
 from pydantic import BaseModel, Field
 
 from config import get_env, Settings
+from modules.plugins import Command
 from modules.pretty_json import pretty_dumps
+from modules.routing import Argument, Schema
 
 settings: Settings = get_env()
 weather_params = {
@@ -96,19 +99,11 @@ class Model(BaseModel):
     city: City
 
 
-def create_session() -> AsyncClient:
-    return AsyncClient(
-        # http2=True,
-        transport=AsyncHTTPTransport(retries=1),
-        timeout=Timeout(180, connect=300, pool=None)
-    )
-
-
 async def get_response(session: AsyncClient, city: str) -> str:
     if weather_params.get("q") != city:
         weather_params["q"] = city
 
-    response = await session.get(settings.MODULES_WEATHER_URL, params=weather_params)
+    response = await session.get(settings.MODULES_WEATHER_URL, params=weather_params, extensions={"cache": True})
     return response.text
 
 
@@ -138,6 +133,32 @@ def wrapper_data(json_string: str = None, limit: int = 3) -> str:
     return pretty_dumps(day_wrap)
 
 
+async def forecast(handler) -> None:
+    """
+    Handle `.wt <city> [limit]`: the forecast of the city for the next `limit` periods of 3 hours.
+    """
+    try:
+        handler.message.text = "<code>Parsing weather...</code>"
+        await handler.limit_message(tti=False)
+
+        start = perf_counter()
+        response_weather = await get_response(session=handler.http.client("weather"), city=handler.args["city"])
+        output_weather = wrapper_data(json_string=response_weather, limit=handler.args["limit"])
+        handler.message.text = f"{output_weather}\n\n<code>Completed in: {perf_counter() - start:f}s</code>"
+    except BaseException as error:
+        handler.message.text = f"<strong>{error.__class__.__name__}!</strong>\n<code>{error}</code>"
+
+    await handler.limit_message()
+
+
+COMMANDS = (
+    Command("wt", forecast, aliases=("weather",), schema=Schema((
+        Argument("city"),
+        Argument("limit", int, 4),
+    ))),
+)
+
+
 # if __name__ == '__main__':
 #     session = create_session()
 #     response = get_response(session=session, city="Kemerovo")
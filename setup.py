@@ -15,7 +15,8 @@ setup(
         "anyio == 3.6.2",
         "arrow == 1.2.3",
         "hashids == 1.3.1",
-        "httpx == 0.23.3",
+        "httpcore == 0.16.3",
+        "httpx[http2] == 0.23.3",
         "lxml == 4.9.2",
         "Markdown == 3.4.1",
         "Pillow == 9.4.0",
@@ -0,0 +1,13 @@
+import importlib
+import sys
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # A checkout only has the template, config.py is copied from it on deployment
+    sys.modules["config"] = importlib.import_module("config_sample")
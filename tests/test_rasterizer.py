@@ -0,0 +1,63 @@
+from html.parser import HTMLParser
+
+import pytest
+
+from modules import limit_symbols, pretty_json, rasterizer
+
+
+class _Styles(HTMLParser):
+    """
+    The text of the HTML of the browser path, with the text inside `<code>` and `<strong>` collected.
+    """
+    def __init__(self):
+        super().__init__()
+        self.text, self.code, self.bold = [], [], []
+        self._open = []
+
+    def handle_starttag(self, tag, attrs):
+        self._open.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._open:
+            self._open.reverse()
+            self._open.remove(tag)
+            self._open.reverse()
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+        if "code" in self._open:
+            self.code.append(data)
+        if "strong" in self._open:
+            self.bold.append(data)
+
+
+@pytest.fixture
+def reply():
+    # The shape of the replies of `execute_python` and `execute_shell`
+    return pretty_json.pretty_dumps({
+        "<strong>Code</strong>": "`print(1 < 2)`",
+        "\nExecution Output": "\n `" + "True " * 200 + "`",
+        "\nExecution Time": "`0.000042s`",
+        "\nNote": "**done**",
+    })
+
+
+def test_inline_markdown_matches_browser(reply, tmp_path):
+    html_path = tmp_path / "file.html"
+    limit_symbols.gen_html(html_path=html_path, text=reply)
+
+    browser = _Styles()
+    browser.feed(html_path.read_text())
+
+    runs = [run for line in rasterizer.layout(reply, columns=10_000) for run in line]
+    text = "".join(text for text, _, _ in runs)
+
+    assert "`" not in text and "**" not in text
+    assert "".join(text for text, _, code in runs if code) == "".join(browser.code)
+    assert "".join(text for text, bold, _ in runs if bold) == "".join(browser.bold)
+    assert text.split() == "".join(browser.text).split()
+
+
+def test_missing_font_is_not_loaded():
+    assert rasterizer.load_fonts("missing.ttf", "missing-bold.ttf", 16) is None
@@ -0,0 +1,22 @@
+from modules import screenshots
+
+
+def test_url_with_port_is_not_a_proxy():
+    proxy, text = screenshots.split_proxy("https://a.com http://example.org:8080")
+
+    assert proxy is None
+    assert screenshots.extract_urls(text) == ["https://a.com/", "http://example.org:8080/"]
+
+
+def test_marked_http_proxy():
+    proxy, text = screenshots.split_proxy("example.com proxy=http://proxy.corp.net:3128 example.org")
+
+    assert proxy == "http://proxy.corp.net:3128"
+    assert screenshots.extract_urls(text) == ["https://example.com/", "https://example.org/"]
+
+
+def test_socks_proxy_anywhere():
+    proxy, text = screenshots.split_proxy("socks5://127.0.0.1:9050 example.com")
+
+    assert proxy == "socks5://127.0.0.1:9050"
+    assert screenshots.extract_urls(text) == ["https://example.com/"]
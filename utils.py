@@ -18,26 +18,39 @@ from enum import Enum
 
 class Commands(str, Enum):
     test = "ping"  # Used to check if a host is reachable
-    short = "shorten_url"  # Used to shorten a given URL 
     ps = "host_information"  # Used to retrieve information about the host 
-    tr = "translate_text"  # Used to translate text from one language to another 
     ban = "ban_user"  # Used to ban a user from accessing certain resources 
     unban = "unban_user"  # Used to unban a user from accessing certain resources 
     sp = "text_to_speech"  # Used to convert text into speech 
-    stat = "retrieve_url_statistics"  # Used to retrieve statistics about a given URL 
     dd = "delete_messages"  # Used to delete messages from a chat or forum 
-    wt = "weather"  # Used to retrieve weather information for a given location
     py = "execute_python"  # Used to execute Python code
     sh = "execute_shell"  # Used to execute Shell code
 
 
-    s = "searchig"  # Used for searching for specific content in databases or websites
     cs = "check_session"  # Used for checking the status of an active session
     screen = "screen"  # Used for capturing screenshots of webpages or applications
+    qs = "queue_statistics"  # Used for showing command scheduler load and queue wait times
+    stats = "statistics"  # Used for showing latency percentiles per command and dependency
+    lag = "loop_lag"  # Used for showing event loop lag and the worst stalls
+    prof = "profile_command"  # Used for profiling another command
+    reload = "reload_plugin"  # Used for reloading the code of a plugin without a restart
     # genc = "generate_code"
     # rec = "rewrite_code"
 
 
+# Alternative names accepted after the command prefix, e.g. ".ping" for ".test".
+# The commands of plugins declare their own, see `modules.plugins`
+ALIASES = {
+    "ping": Commands.test,
+    "host": Commands.ps,
+    "voice": Commands.sp,
+    "del": Commands.dd,
+    "python": Commands.py,
+    "shell": Commands.sh,
+    "screenshot": Commands.screen,
+}
+
+
 # cpu_info_lib = ctypes.CDLL('./lib/cpu_info.so')
 #
 # memory_info_lib = ctypes.CDLL('./lib/memory_info.so')